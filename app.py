@@ -8,25 +8,40 @@ import os
 import csv
 import io
 import uuid
+import zlib
 import hashlib
+import hmac
 import functools
+import itertools
 import atexit
 import time
-import random
+import secrets
 import base64
 import queue
 import threading
 import glob as _glob
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, date, timedelta
 from pathlib import Path
 
 import bcrypt
-from flask import Flask, jsonify, request, render_template, send_from_directory, Response, session, redirect, url_for, g
+from flask import (
+    Flask, jsonify, request, render_template, send_from_directory, Response, session, redirect, url_for, g,
+    stream_with_context, make_response,
+)
 
 from database import (
     get_db, close_db, init_db, migrate_from_json, create_backup,
     row_to_dict, rows_to_list, DB_PATH, USE_POSTGRES, export_all_data, import_all_data,
+    pool_stats, sql_translation_stats, record_customer_sales, unrecord_customer_sale,
+    record_sale_rollups, unrecord_sale_rollups,
+    sync_inventory_supplier_links, sync_supplier_name_links, sync_order_supplier_links,
+    load_children, iter_export, rebuild_derived_tables, bulk_import_data, EXPORT_TABLES,
+    create_import_session, import_session_status, import_session_chunk, finish_import_session,
+    import_session_expired, expire_import_session,
+    search_inventory, SEARCH_MAX_RESULTS, allocate_codes, allocate_code,
+    stored_response, stored_responses, store_response, store_responses, IDEMPOTENCY_KEY_MAX_LEN,
+    AuditWriter, AUDIT_ASYNC,
 )
 
 app = Flask(__name__)
@@ -131,6 +146,7 @@ _sse_lock = threading.Lock()
 
 def broadcast_event(event_type, data=None):
     """Push an event to all connected SSE clients."""
+    response_cache.invalidate(*EVENT_CACHE_TAGS.get(event_type, ()))
     msg = f"event: {event_type}\ndata: {json.dumps(data or {})}\n\n"
     with _sse_lock:
         dead = []
@@ -143,13 +159,224 @@ def broadcast_event(event_type, data=None):
             _sse_clients.remove(q)
 
 
+# ---------------------------------------------------------------------------
+# Response cache — polled read endpoints served from memory
+# ---------------------------------------------------------------------------
+# Entries are tagged with the data they depend on and dropped when a write in
+# this process touches that data (broadcast_event() and the sale/void paths).
+# Each gunicorn worker has its own cache, so a write made through another
+# worker shows up here when the entry's short TTL runs out.
+
+class ResponseCache:
+    """Thread-safe LRU of JSON response bodies with per-entry TTL and tags."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, tags, body)
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped on every invalidation
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, body, ttl, tags, generation):
+        """Store unless an invalidation happened since `generation` was read (the body may be stale)."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + ttl, frozenset(tags), body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        if not tags:
+            return
+        tags = set(tags)
+        with self._lock:
+            self._generation += 1
+            stale = [k for k, (_, entry_tags, _) in self._entries.items() if entry_tags & tags]
+            for k in stale:
+                del self._entries[k]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+response_cache = ResponseCache()
+
+# broadcast_event() type → cache tags it invalidates
+EVENT_CACHE_TAGS = {
+    "inventory_updated": ("inventory",),
+    "settings_updated": ("settings",),
+}
+
+
+def sku_sales_tag(sku):
+    """Cache tag for responses derived from one SKU's sales."""
+    return f"sku_sales:{sku}"
+
+
+def cached_response(ttl, tags):
+    """Serve a GET endpoint's 200 JSON response from response_cache, keyed by path and query string.
+    `tags` may be a callable taking the view arguments. Put it below @login_required
+    so the auth check still runs on every request.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            body = response_cache.get(key)
+            if body is not None:
+                return Response(body, mimetype="application/json")
+            generation = response_cache.generation
+            resp = make_response(f(*args, **kwargs))
+            if resp.status_code == 200 and resp.mimetype == "application/json":
+                entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+                response_cache.set(key, resp.get_data(), ttl, entry_tags, generation)
+            return resp
+        return decorated
+    return decorator
+
+
+# ---------------------------------------------------------------------------
+# Product lookup cache — barcode/SKU scans served from memory
+# ---------------------------------------------------------------------------
+# GET /api/inventory/<code> results, reachable by both SKU and barcode. Every
+# write to a product calls product_cache.invalidate(sku). Like the response
+# cache this is per worker; the TTL bounds staleness from other workers.
+
+class ProductLookupCache:
+    """Thread-safe LRU of product JSON bodies keyed by lookup code (SKU or barcode)."""
+
+    def __init__(self, max_entries=2048, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # code -> (expires_at, sku, body)
+        self._codes = defaultdict(set)  # sku -> codes cached for it
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def _drop(self, code):
+        _, sku, _ = self._entries.pop(code)
+        codes = self._codes.get(sku)
+        if codes is not None:
+            codes.discard(code)
+            if not codes:
+                del self._codes[sku]
+
+    def get(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(code)
+                self.hits += 1
+                return entry[2]
+            if entry:
+                self._drop(code)
+            self.misses += 1
+            return None
+
+    def put(self, code, sku, body, generation):
+        """Store unless an invalidation happened since `generation` was read."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            if code in self._entries:
+                self._drop(code)
+            self._entries[code] = (time.monotonic() + self.ttl, sku, body)
+            self._codes[sku].add(code)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *skus):
+        with self._lock:
+            self._generation += 1
+            for sku in skus:
+                for code in list(self._codes.get(sku, ())):
+                    self._drop(code)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._codes.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+product_cache = ProductLookupCache()
+
+
+def invalidate_caches(*tags, skus=(), everything=False):
+    """Drop cached responses for `tags` and cached product lookups for `skus` after a write."""
+    if everything:
+        response_cache.clear()
+        product_cache.clear()
+        return
+    response_cache.invalidate(*tags)
+    if skus:
+        product_cache.invalidate(*skus)
+
+
 # ---------------------------------------------------------------------------
 # Database lifecycle
 # ---------------------------------------------------------------------------
 
 @app.teardown_appcontext
 def teardown_db(exception):
-    """Close DB connection at end of each request."""
+    """Release the DB connection (back to the pool) at end of each request."""
     close_db()
 
 
@@ -167,6 +394,295 @@ def generate_receipt_number():
     return f"INV-{now.strftime('%Y%m%d')}-{uuid.uuid4().hex[:6].upper()}"
 
 
+INVENTORY_LOG_SQL = (
+    "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) "
+    "VALUES (?,?,?,?,?,?,?)"
+)
+
+SALE_SQL = """INSERT INTO sales
+    (receipt_number, timestamp, date, subtotal, discount_amount,
+     tax_amount, cgst_amount, sgst_amount, grand_total, payment_method, cashier,
+     customer_name, customer_phone, customer_email)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+SALE_ITEM_SQL = """INSERT INTO sale_items
+    (sale_id, sku, name, hsn_code, quantity, unit_price, line_total,
+     discount_type, discount_value, discount_amount, final_total)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?)"""
+
+
+# With AUDIT_ASYNC=1 audit rows are written behind the request by a background thread (see AuditWriter)
+audit_writer = AuditWriter(INVENTORY_LOG_SQL) if AUDIT_ASYNC else None
+
+
+def log_inventory(conn, entries):
+    """
+    Write audit rows (sku, action, description, old_value, new_value, qty_change, created) in one
+    batch, or with the audit writer on, hand them to it once the transaction commits.
+    """
+    if not entries:
+        return
+    if audit_writer:
+        entries = list(entries)
+        conn.after_commit(lambda: audit_writer.submit(entries))
+    else:
+        conn.executemany(INVENTORY_LOG_SQL, entries)
+
+
+IN_CLAUSE_CHUNK = 500  # ids per "IN (...)" query; keeps well under SQLite's bound-parameter limit
+
+
+def cart_quantities(lines):
+    """{sku: total quantity} for a cart's stocked lines (a SKU may be on several lines)."""
+    wanted = {}
+    for line in lines:
+        if line.get("sku"):
+            wanted[line["sku"]] = wanted.get(line["sku"], 0) + line.get("quantity", 1)
+    return wanted
+
+
+def read_stock(conn, skus):
+    """
+    {sku: row(name, quantity)} in one IN query per IN_CLAUSE_CHUNK SKUs. On PostgreSQL
+    the rows stay locked FOR UPDATE (in SKU order, so two carts can't deadlock) until commit.
+    """
+    skus = sorted(skus)
+    lock = " FOR UPDATE" if USE_POSTGRES else ""
+    stock = {}
+    for i in range(0, len(skus), IN_CLAUSE_CHUNK):
+        chunk = skus[i:i + IN_CLAUSE_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        for r in conn.execute(
+            f"SELECT sku, name, quantity FROM inventory WHERE sku IN ({placeholders}) ORDER BY sku{lock}", chunk
+        ).fetchall():
+            stock[r["sku"]] = r
+    return stock
+
+
+def stock_shortfalls(wanted, available, names):
+    """Messages for the SKUs in `wanted` that `available` ({sku: qty}) can't cover."""
+    errors = []
+    for sku, qty in wanted.items():
+        if sku not in available:
+            errors.append(f"Product {sku} not found in inventory")
+        elif available[sku] < qty:
+            errors.append(f"{names[sku]} — only {available[sku]} in stock, requested {qty}")
+    return errors
+
+
+def take_stock(conn, wanted, today):
+    """
+    Decrement stock by `wanted` ({sku: qty}) with one conditional UPDATE per chunk of SKUs
+    that only touches rows with enough left; no commit. Returns False if any SKU fell short
+    (another sale got there first), in which case the caller must roll back the rows that
+    were decremented.
+    """
+    skus = sorted(wanted)
+    size = IN_CLAUSE_CHUNK // 5  # each SKU binds 5 parameters
+    for i in range(0, len(skus), size):
+        chunk = skus[i:i + size]
+        qty_case = "CASE sku" + " WHEN ? THEN ?" * len(chunk) + " END"
+        qty_params = [v for sku in chunk for v in (sku, wanted[sku])]
+        cur = conn.execute(
+            f"""UPDATE inventory SET quantity = quantity - {qty_case}, last_updated = ?
+                WHERE sku IN ({",".join("?" * len(chunk))}) AND quantity >= {qty_case}""",
+            qty_params + [today] + chunk + qty_params
+        )
+        if cur.rowcount != len(chunk):
+            return False
+    return True
+
+
+def reserve_stock(conn, lines, today):
+    """
+    Check and decrement stock for a cart's lines in one transaction; no commit.
+    One IN query reads every SKU (locked on PostgreSQL) and one conditional UPDATE takes
+    the stock only where enough is left, so concurrent checkouts can't oversell.
+    Returns a list of stock errors; if it isn't empty the caller must roll back.
+    """
+    wanted = cart_quantities(lines)
+    if not wanted:
+        return []
+    stock = read_stock(conn, wanted)
+    errors = stock_shortfalls(wanted, {sku: r["quantity"] for sku, r in stock.items()},
+                          {sku: r["name"] for sku, r in stock.items()})
+    if errors:
+        return errors
+    if not take_stock(conn, wanted, today):
+        # Another terminal's sale committed between the check and the update
+        return ["Stock changed on another terminal while checking out — please try again"]
+    return []
+
+
+def sale_response_body(sale, receipt_number, timestamp, sale_date):
+    """The {"success", "sale"} body create_sale returns (also stored for idempotent replays)."""
+    return {"success": True, "sale": {
+        "receipt_number": receipt_number,
+        "timestamp": timestamp,
+        "date": sale_date,
+        "subtotal": sale.get("subtotal", 0),
+        "discount_amount": sale.get("discount_amount", 0),
+        "tax_amount": sale.get("tax_amount", 0),
+        "cgst_amount": sale.get("cgst_amount", 0),
+        "sgst_amount": sale.get("sgst_amount", 0),
+        "grand_total": sale.get("grand_total", 0),
+        "payment_method": sale.get("payment_method", ""),
+        "cashier": sale.get("cashier", ""),
+        "customer_name": sale.get("customer_name", ""),
+        "customer_phone": sale.get("customer_phone", ""),
+        "customer_email": sale.get("customer_email", ""),
+        "items": sale.get("items", []),
+    }}
+
+
+def idempotency_key(body=None):
+    """
+    The request's Idempotency-Key header, else the body's "idempotency_key" field.
+    Returns "" when there is none; raises ValueError if it is too long.
+    """
+    key = request.headers.get("Idempotency-Key") or (body or {}).get("idempotency_key") or ""
+    key = str(key).strip()
+    if len(key) > IDEMPOTENCY_KEY_MAX_LEN:
+        raise ValueError(f"Idempotency key longer than {IDEMPOTENCY_KEY_MAX_LEN} characters")
+    return key
+
+
+def replayed(stored):
+    """Response for a request whose idempotency key was already used."""
+    status_code, body = stored
+    resp = jsonify(body)
+    resp.status_code = status_code
+    resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+
+def sale_params(sale, receipt_number, timestamp, sale_date):
+    """Parameter tuple for SALE_SQL from a sale payload."""
+    return (receipt_number, timestamp, sale_date,
+            float(sale.get("subtotal", 0)),
+            float(sale.get("discount_amount", 0)),
+            float(sale.get("tax_amount", 0)),
+            float(sale.get("cgst_amount", 0)),
+            float(sale.get("sgst_amount", 0)),
+            float(sale.get("grand_total", 0)),
+            sale.get("payment_method", ""),
+            sale.get("cashier", ""),
+            sale.get("customer_name", ""),
+            sale.get("customer_phone", ""),
+            sale.get("customer_email", ""))
+
+
+def sale_item_params(sale_id, line):
+    """Parameter tuple for SALE_ITEM_SQL from a cart line."""
+    return (sale_id, line.get("sku"), line.get("name", ""), line.get("hsn_code", ""),
+            line.get("quantity", 1), float(line.get("unit_price", 0)),
+            float(line.get("line_total", 0)),
+            line.get("discount_type", "none"),
+            float(line.get("discount_value", 0)),
+            float(line.get("discount_amount", 0)),
+            float(line.get("final_total", line.get("line_total", 0))))
+
+
+# ---------------------------------------------------------------------------
+# Streaming CSV
+# ---------------------------------------------------------------------------
+
+STREAM_FLUSH_BYTES = 64 * 1024
+
+
+def stream_csv(fieldnames, records):
+    """Yield CSV text for dict records in ~64 KB pieces, header first."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fieldnames)
+    writer.writeheader()
+    for rec in records:
+        writer.writerow(rec)
+        if buf.tell() >= STREAM_FLUSH_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+
+def csv_response(fieldnames, records, filename):
+    # stream_with_context keeps the request (and its pooled connection) alive
+    # until the last row has been sent.
+    return Response(
+        stream_with_context(stream_csv(fieldnames, records)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+# ---------------------------------------------------------------------------
+# Keyset pagination
+# ---------------------------------------------------------------------------
+
+PAGE_MAX_LIMIT = 500
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def keyset_page(conn, sql, params, keys, descending=False):
+    """
+    Run `sql` (a SELECT ending in its WHERE clause) ordered by `keys`, a list of
+    (sql_expression, row_field) pairs whose last entry is unique.
+
+    Without ?limit= the full result is returned and page is None (legacy array
+    responses). With ?limit= (and optionally ?cursor=) one page is returned and
+    page is {"next_cursor": ...}. Pages seek past the cursor instead of using
+    OFFSET, so every page costs the same. Raises ValueError on bad input.
+    """
+    direction = " DESC" if descending else ""
+    order = " ORDER BY " + ", ".join(expr + direction for expr, _ in keys)
+    limit = request.args.get("limit")
+    if not limit:
+        return conn.execute(sql + order, params).fetchall(), None
+    try:
+        limit = max(1, min(int(limit), PAGE_MAX_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+
+    params = list(params)
+    token = request.args.get("cursor")
+    if token:
+        values = decode_cursor(token, len(keys))
+        op = "<" if descending else ">"
+        # (k1 > ?) OR (k1 = ? AND k2 > ?) ... — portable row-value comparison
+        clauses = []
+        for i, (expr, _) in enumerate(keys):
+            parts = [f"{keys[j][0]} = ?" for j in range(i)] + [f"{expr} {op} ?"]
+            clauses.append("(" + " AND ".join(parts) + ")")
+            params.extend(values[:i + 1])
+        sql += " AND (" + " OR ".join(clauses) + ")"
+
+    rows = conn.execute(sql + order + " LIMIT ?", params + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][field] for _, field in keys])
+    return rows, {"next_cursor": next_cursor}
+
+
+def page_response(items, page):
+    """Legacy bare array when unpaginated, otherwise {"items": [...], "next_cursor": ...}."""
+    if page is None:
+        return jsonify(items)
+    return jsonify({"items": items, **page})
+
+
 # ---------------------------------------------------------------------------
 # Auth helpers
 # ---------------------------------------------------------------------------
@@ -489,6 +1005,7 @@ def get_all_settings():
 
 @app.route("/api/settings", methods=["GET"])
 @login_required
+@cached_response(ttl=30, tags=("settings",))
 def get_settings():
     return jsonify(get_all_settings())
 
@@ -538,6 +1055,7 @@ def upload_settings_image():
     conn = db()
     conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, data_uri))
     conn.commit()
+    response_cache.invalidate("settings")
 
     return jsonify({"success": True, "key": key, "data_uri": data_uri})
 
@@ -556,6 +1074,7 @@ def delete_settings_image():
     conn = db()
     conn.execute("DELETE FROM settings WHERE key = ?", (key,))
     conn.commit()
+    response_cache.invalidate("settings")
     return jsonify({"success": True})
 
 
@@ -566,28 +1085,36 @@ def delete_settings_image():
 @app.route("/api/inventory", methods=["GET"])
 @login_required
 def get_inventory():
-    q = request.args.get("q", "").lower()
+    q = request.args.get("q", "").strip()
     category = request.args.get("category", "")
     low_stock = request.args.get("low_stock", "")
 
-    sql = "SELECT * FROM inventory WHERE 1=1"
+    where = ""
     params = []
 
-    if q:
-        sql += " AND (LOWER(name) LIKE ? OR LOWER(sku) LIKE ? OR LOWER(brand) LIKE ? OR LOWER(description) LIKE ? OR LOWER(barcode) LIKE ? OR LOWER(hsn_code) LIKE ?)"
-        like = f"%{q}%"
-        params.extend([like, like, like, like, like, like])
-
     if category:
-        sql += " AND category = ?"
+        where += " AND i.category = ?"
         params.append(category)
 
     if low_stock == "true":
-        sql += " AND quantity <= reorder_level"
+        where += " AND i.quantity <= i.reorder_level"
 
-    sql += " ORDER BY name"
-    rows = db().execute(sql, params).fetchall()
-    return jsonify(rows_to_list(rows))
+    if q:
+        # Ranked search: best matches first, capped (?limit= up to PAGE_MAX_LIMIT), no cursor
+        limit = request.args.get("limit")
+        try:
+            limit = max(1, min(int(limit), PAGE_MAX_LIMIT)) if limit else SEARCH_MAX_RESULTS
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        rows = search_inventory(db(), q, where, params, limit)
+        return page_response(rows_to_list(rows), {"next_cursor": None} if request.args.get("limit") else None)
+
+    sql = "SELECT * FROM inventory i WHERE 1=1" + where
+    try:
+        rows, page = keyset_page(db(), sql, params, [("i.name", "name"), ("i.sku", "sku")])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return page_response(rows_to_list(rows), page)
 
 
 @app.route("/api/inventory", methods=["POST"])
@@ -608,14 +1135,7 @@ def add_product():
 
     if not product.get("sku"):
         # Auto-generate unique 6-digit numeric SKU
-        used_skus = {r[0] for r in db().execute(
-            "SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''"
-        ).fetchall()}
-        while True:
-            candidate = str(random.randint(100000, 999999))
-            if candidate not in used_skus:
-                product["sku"] = candidate
-                break
+        product["sku"] = allocate_code(db(), "sku")
 
     # Check duplicate SKU
     existing = db().execute("SELECT sku FROM inventory WHERE sku = ?", (product["sku"],)).fetchone()
@@ -624,14 +1144,7 @@ def add_product():
 
     # Auto-generate unique random 6-digit numeric barcode if not provided
     if not product.get("barcode", "").strip():
-        used_barcodes = {r[0] for r in db().execute(
-            "SELECT barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != ''"
-        ).fetchall()}
-        while True:
-            candidate = str(random.randint(100000, 999999))
-            if candidate not in used_barcodes:
-                product["barcode"] = candidate
-                break
+        product["barcode"] = allocate_code(db(), "barcode")
 
     db().execute(
         """INSERT INTO inventory
@@ -649,7 +1162,9 @@ def add_product():
          product.get("color", ""), product.get("image_path", ""),
          product.get("supplier", ""), today, today)
     )
+    sync_inventory_supplier_links(db(), [product["sku"]])
     db().commit()
+    product_cache.invalidate(product["sku"])
     broadcast_event("inventory_updated", {"action": "added", "sku": product["sku"]})
     return jsonify({"success": True, "product": product}), 201
 
@@ -657,10 +1172,15 @@ def add_product():
 @app.route("/api/inventory/<sku>", methods=["GET"])
 @login_required
 def get_product(sku):
-    row = db().execute("SELECT * FROM inventory WHERE sku = ? OR barcode = ?", (sku, sku)).fetchone()
-    if not row:
-        return jsonify({"error": "Product not found"}), 404
-    return jsonify(row_to_dict(row))
+    body = product_cache.get(sku)
+    if body is None:
+        generation = product_cache.generation
+        row = db().execute("SELECT * FROM inventory WHERE sku = ? OR barcode = ?", (sku, sku)).fetchone()
+        if not row:
+            return jsonify({"error": "Product not found"}), 404
+        body = app.json.dumps(row_to_dict(row))
+        product_cache.put(sku, row["sku"], body, generation)
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/api/inventory/<sku>", methods=["PUT"])
@@ -713,9 +1233,9 @@ def update_product(sku):
     # Audit log: price changes
     old_cost = float(original.get("cost_price", 0))
     old_sell = float(original.get("selling_price", 0))
+    audit = []
     if new_cost != old_cost or new_sell != old_sell:
-        conn.execute(
-            "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
+        audit.append(
             (sku, "Price Changed",
              f"Cost: ₹{old_cost:.2f}→₹{new_cost:.2f}, Sell: ₹{old_sell:.2f}→₹{new_sell:.2f}",
              f"{old_cost}/{old_sell}", f"{new_cost}/{new_sell}", 0, now_str)
@@ -725,8 +1245,7 @@ def update_product(sku):
     old_qty = int(original.get("quantity", 0))
     if new_qty != old_qty:
         diff = new_qty - old_qty
-        conn.execute(
-            "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
+        audit.append(
             (sku, "Qty Adjusted",
              f"Quantity changed from {old_qty} to {new_qty}",
              str(old_qty), str(new_qty), diff, now_str)
@@ -740,12 +1259,13 @@ def update_product(sku):
         if old_val != new_val:
             edit_changes.append(f"{field}: {old_val}→{new_val}")
     if edit_changes and not (new_cost != old_cost or new_sell != old_sell) and new_qty == old_qty:
-        conn.execute(
-            "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
-            (sku, "Edited", "; ".join(edit_changes), "", "", 0, now_str)
-        )
+        audit.append((sku, "Edited", "; ".join(edit_changes), "", "", 0, now_str))
 
+    log_inventory(conn, audit)
+    if "supplier" in data:
+        sync_inventory_supplier_links(conn, [sku])
     conn.commit()
+    product_cache.invalidate(sku)
     broadcast_event("inventory_updated", {"action": "updated", "sku": sku})
 
     updated = conn.execute("SELECT * FROM inventory WHERE sku = ?", (sku,)).fetchone()
@@ -783,12 +1303,15 @@ def delete_product(sku):
         conn.execute("DELETE FROM inventory_log WHERE sku = ?", (sku,))
         conn.execute("DELETE FROM purchases WHERE sku = ?", (sku,))
         conn.execute("DELETE FROM purchase_order_items WHERE sku = ?", (sku,))
+        conn.execute("DELETE FROM supplier_products WHERE sku = ?", (sku,))
+        conn.execute("DELETE FROM product_daily_rollup WHERE sku = ?", (sku,))
         conn.execute("DELETE FROM inventory WHERE sku = ?", (sku,))
         conn.commit()
     except Exception as e:
         conn.rollback()
         return jsonify({"error": f"Delete failed: {e}"}), 409
 
+    invalidate_caches("sales", skus=[sku])
     broadcast_event("inventory_updated", {"action": "deleted", "sku": sku})
     return jsonify({"success": True})
 
@@ -799,11 +1322,22 @@ def delete_product(sku):
 
 @app.route("/api/categories", methods=["GET"])
 @login_required
+@cached_response(ttl=30, tags=("categories",))
 def list_categories():
     rows = db().execute("SELECT * FROM categories ORDER BY name").fetchall()
     return jsonify(rows_to_list(rows))
 
 
+@app.route("/api/categories/counts", methods=["GET"])
+@login_required
+def category_product_counts():
+    """Products per category: {category: count}."""
+    rows = db().execute(
+        "SELECT category, COUNT(*) as cnt FROM inventory WHERE category != '' GROUP BY category"
+    ).fetchall()
+    return jsonify({r["category"]: r["cnt"] for r in rows})
+
+
 @app.route("/api/categories", methods=["POST"])
 @login_required
 def add_category():
@@ -821,6 +1355,7 @@ def add_category():
         db().commit()
     except Exception:
         return jsonify({"error": "Category already exists"}), 409
+    response_cache.invalidate("categories")
     return jsonify({"success": True, "name": name}), 201
 
 
@@ -852,6 +1387,8 @@ def update_category(cat_id):
         except Exception:
             pass
         return jsonify({"error": "Category name already exists"}), 409
+    response_cache.invalidate("categories", "inventory")
+    product_cache.clear()
     return jsonify({"success": True})
 
 
@@ -869,118 +1406,224 @@ def delete_category(cat_id):
 
     conn.execute("DELETE FROM categories WHERE id = ?", (cat_id,))
     conn.commit()
+    response_cache.invalidate("categories")
     return jsonify({"success": True})
 
 
 @app.route("/api/inventory/export", methods=["GET"])
 @login_required
 def export_inventory_csv():
-    rows = db().execute("SELECT * FROM inventory ORDER BY name").fetchall()
-    if not rows:
+    rows = db().iter_rows("SELECT * FROM inventory ORDER BY name")
+    first = next(rows, None)
+    if first is None:
         return Response("No data", mimetype="text/plain")
 
-    inventory = rows_to_list(rows)
-    output = io.StringIO()
-    fieldnames = list(inventory[0].keys())
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(inventory)
-
-    return Response(
-        output.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=inventory.csv"},
-    )
+    def records():
+        yield row_to_dict(first)
+        for r in rows:
+            yield row_to_dict(r)
+
+    return csv_response(list(first.keys()), records(), "inventory.csv")
+
+
+CSV_IMPORT_CHUNK = 1000      # rows validated and written per batch
+CSV_IMPORT_MAX_ERRORS = 500  # rows listed in the error report (the failed count is always exact)
+
+_CSV_TEXT_FIELDS = ("hsn_code", "name", "category", "brand", "description",
+                    "dimensions", "color", "image_path", "supplier")
+_CSV_NUMBER_FIELDS = {  # field -> (type, default when blank)
+    "cost_price": (float, 0), "purchase_gst_pct": (float, 0), "selling_price": (float, 0),
+    "weight": (float, 0), "quantity": (int, 0), "reorder_level": (int, 3),
+}
+_CSV_INSERT_SQL = """INSERT INTO inventory
+    (sku, barcode, hsn_code, name, category, brand, description, cost_price, purchase_gst_pct,
+     selling_price, quantity, reorder_level, dimensions, weight, color, image_path,
+     supplier, date_added, last_updated)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+
+def _parse_csv_product(row):
+    """Coerce one CSV row; returns (product, fields given). Raises ValueError with the reason."""
+    product = {f: (row.get(f) or "").strip() for f in ("sku", "barcode", "date_added") + _CSV_TEXT_FIELDS}
+    given = set()
+    for field, (cast, default) in _CSV_NUMBER_FIELDS.items():
+        raw = (row.get(field) or "").strip()
+        if not raw:
+            product[field] = default
+            continue
+        try:
+            product[field] = cast(float(raw))
+        except ValueError:
+            raise ValueError(f"{field} is not a number: {raw!r}")
+        given.add(field)
+    if product["cost_price"] < 0 or product["selling_price"] < 0:
+        raise ValueError("Prices cannot be negative")
+    if product["quantity"] < 0:
+        raise ValueError("Quantity cannot be negative")
+    return product, given
 
 
 @app.route("/api/inventory/import", methods=["POST"])
 @login_required
 def import_inventory_csv():
+    """
+    Import products from CSV, parsed as a stream and written in batches.
+    mode=insert (default) skips SKUs that already exist; mode=upsert updates their
+    cost price, selling price and quantity instead, with audit log entries.
+    Rows that can't be imported are reported by CSV line number.
+    """
     if "file" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
+    mode = request.args.get("mode") or request.form.get("mode") or "insert"
+    if mode not in ("insert", "upsert"):
+        return jsonify({"error": "mode must be 'insert' or 'upsert'"}), 400
 
-    file = request.files["file"]
-    stream = io.StringIO(file.stream.read().decode("utf-8"))
-    reader = csv.DictReader(stream)
-
+    reader = csv.DictReader(io.TextIOWrapper(request.files["file"].stream, encoding="utf-8-sig", newline=""))
     conn = db()
-    added = 0
     today = date.today().isoformat()
+    now_str = datetime.now().isoformat()
 
-    for row in reader:
-        # Coerce numeric fields
-        for field in ["cost_price", "selling_price", "weight"]:
-            if field in row:
-                try:
-                    row[field] = float(row[field])
-                except (ValueError, TypeError):
-                    row[field] = 0
-        for field in ["quantity", "reorder_level"]:
-            if field in row:
-                try:
-                    row[field] = int(row[field])
-                except (ValueError, TypeError):
-                    row[field] = 0
-
-        sku = row.get("sku", "").strip()
-        if not sku:
-            # Auto-generate unique 6-digit numeric SKU
-            used_skus = {r[0] for r in conn.execute(
-                "SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''"
-            ).fetchall()}
-            while True:
-                candidate = str(random.randint(100000, 999999))
-                if candidate not in used_skus:
-                    sku = candidate
-                    break
-
-        # Check if SKU already exists
-        existing = conn.execute("SELECT sku FROM inventory WHERE sku = ?", (sku,)).fetchone()
-        if existing:
-            continue
-
-        # Auto-generate random 6-digit barcode if not in CSV
-        barcode = row.get("barcode", "").strip()
-        if not barcode:
-            used_bc = {r[0] for r in conn.execute(
-                "SELECT barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != ''"
-            ).fetchall()}
-            while True:
-                candidate = str(random.randint(100000, 999999))
-                if candidate not in used_bc:
-                    barcode = candidate
-                    break
-
-        try:
-            conn.execute(
-                """INSERT INTO inventory
-                (sku, barcode, hsn_code, name, category, brand, description, cost_price, selling_price,
-                 quantity, reorder_level, dimensions, weight, color, image_path,
-                 supplier, date_added, last_updated)
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                (sku, barcode, row.get("hsn_code", ""),
-                 row.get("name", ""), row.get("category", ""),
-                 row.get("brand", ""), row.get("description", ""),
-                 float(row.get("cost_price", 0)),
-                 float(row.get("selling_price", 0)),
-                 int(row.get("quantity", 0)),
-                 int(row.get("reorder_level", 3)),
-                 row.get("dimensions", ""),
-                 float(row.get("weight", 0)),
-                 row.get("color", ""), row.get("image_path", ""),
-                 row.get("supplier", ""),
-                 row.get("date_added", today), today)
+    # One read of inventory serves every duplicate check: sku -> (cost, sell, qty), barcode -> sku
+    existing = {}
+    barcodes = {}
+    for r in conn.iter_rows("SELECT sku, barcode, cost_price, selling_price, quantity FROM inventory"):
+        existing[r["sku"]] = (float(r["cost_price"] or 0), float(r["selling_price"] or 0), int(r["quantity"] or 0))
+        if r["barcode"]:
+            barcodes[r["barcode"]] = r["sku"]
+    seen = {}  # sku -> CSV line it first appeared on
+    generated = {}  # sku generated by this import -> CSV line it was generated for
+    added_skus, updated_skus = [], []
+    skipped = failed = 0
+    errors = []
+
+    def fail(line, sku, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < CSV_IMPORT_MAX_ERRORS:
+            errors.append({"line": line, "sku": sku, "error": message})
+
+    def barcode_owner(barcode):
+        owner = barcodes[barcode]  # a SKU, or the line number of an in-file row whose SKU isn't generated yet
+        return f"on line {owner}" if isinstance(owner, int) else f"by SKU {owner}"
+
+    def flush(batch):
+        nonlocal skipped
+        new_rows, updates, audit = [], [], []
+        for line, row in batch:
+            try:
+                product, given = _parse_csv_product(row)
+            except ValueError as e:
+                fail(line, (row.get("sku") or "").strip(), str(e))
+                continue
+            sku, barcode = product["sku"], product["barcode"]
+            if sku in generated:
+                fail(line, sku, f"Duplicate SKU (generated for line {generated[sku]})")
+                continue
+            if sku in seen:
+                fail(line, sku, f"Duplicate SKU (first seen on line {seen[sku]})")
+                continue
+            if sku in existing:
+                seen[sku] = line
+                if mode == "insert":
+                    skipped += 1
+                    continue
+                old_cost, old_sell, old_qty = existing[sku]
+                new_cost = product["cost_price"] if "cost_price" in given else old_cost
+                new_sell = product["selling_price"] if "selling_price" in given else old_sell
+                new_qty = product["quantity"] if "quantity" in given else old_qty
+                if (new_cost, new_sell, new_qty) == (old_cost, old_sell, old_qty):
+                    skipped += 1
+                    continue
+                updates.append((new_cost, new_sell, new_qty, today, sku))
+                existing[sku] = (new_cost, new_sell, new_qty)
+                updated_skus.append(sku)
+                if new_cost != old_cost or new_sell != old_sell:
+                    audit.append(
+                        (sku, "Price Changed",
+                         f"Cost: ₹{old_cost:.2f}→₹{new_cost:.2f}, Sell: ₹{old_sell:.2f}→₹{new_sell:.2f}",
+                         f"{old_cost}/{old_sell}", f"{new_cost}/{new_sell}", 0, now_str)
+                    )
+                if new_qty != old_qty:
+                    audit.append(
+                        (sku, "Qty Adjusted", f"Quantity changed from {old_qty} to {new_qty}",
+                         str(old_qty), str(new_qty), new_qty - old_qty, now_str)
+                    )
+                continue
+            if not product["name"]:
+                fail(line, sku, "Product name is required")
+                continue
+            if barcode and barcode in barcodes:
+                fail(line, sku, f"Barcode {barcode} already used {barcode_owner(barcode)}")
+                continue
+            if sku:
+                seen[sku] = line
+            if barcode:
+                barcodes[barcode] = sku or line
+            new_rows.append((line, product))
+
+        # Generated codes for blank cells, reserved in bulk and kept clear of codes this batch uses.
+        # A later row naming a generated SKU is rejected above rather than matched as existing.
+        for kind in ("sku", "barcode"):
+            blanks = [(line, p) for line, p in new_rows if not p[kind]]
+            if blanks:
+                taken = {p[kind] for _, p in new_rows} - {""}
+                for (line, p), code in zip(blanks, allocate_codes(conn, kind, len(blanks), exclude=taken)):
+                    p[kind] = code
+                    if kind == "sku":
+                        generated[code] = line
+        for line, p in new_rows:
+            barcodes[p["barcode"]] = p["sku"]
+            existing[p["sku"]] = (p["cost_price"], p["selling_price"], p["quantity"])
+
+        conn.executemany(_CSV_INSERT_SQL, [
+            (p["sku"], p["barcode"], p["hsn_code"], p["name"], p["category"], p["brand"],
+             p["description"], p["cost_price"], p["purchase_gst_pct"], p["selling_price"],
+             p["quantity"], p["reorder_level"], p["dimensions"], p["weight"], p["color"],
+             p["image_path"], p["supplier"], p["date_added"] or today, today)
+            for _, p in new_rows
+        ])
+        if updates:
+            conn.executemany(
+                "UPDATE inventory SET cost_price=?, selling_price=?, quantity=?, last_updated=? WHERE sku=?",
+                updates
             )
-            added += 1
-        except Exception:
-            continue
+        log_inventory(conn, audit)
+        added = [p["sku"] for _, p in new_rows]
+        sync_inventory_supplier_links(conn, added)
+        added_skus.extend(added)
+
+    batch = []
+    try:
+        if not reader.fieldnames:
+            return jsonify({"error": "CSV file is empty"}), 400
+        for row in reader:
+            batch.append((reader.line_num, row))
+            if len(batch) >= CSV_IMPORT_CHUNK:
+                flush(batch)
+                batch = []
+        flush(batch)
+    except (UnicodeDecodeError, csv.Error) as e:
+        conn.rollback()
+        return jsonify({"error": f"Could not read CSV: {e}"}), 400
 
     conn.commit()
-    return jsonify({"success": True, "added": added})
+    invalidate_caches("inventory", skus=added_skus + updated_skus)
+    print(f"  [IMPORT] CSV ({mode}): {len(added_skus)} added, {len(updated_skus)} updated, "
+          f"{skipped} skipped, {failed} failed")
+    return jsonify({
+        "success": True,
+        "mode": mode,
+        "added": len(added_skus),
+        "updated": len(updated_skus),
+        "skipped": skipped,
+        "failed": failed,
+        "errors": errors,
+    })
 
 
 @app.route("/api/inventory/categories", methods=["GET"])
 @login_required
+@cached_response(ttl=30, tags=("categories",))
 def get_inventory_categories():
     rows = db().execute("SELECT name FROM categories ORDER BY name").fetchall()
     return jsonify([r["name"] for r in rows])
@@ -996,21 +1639,32 @@ def get_inventory_history(sku):
     """Get audit log for a specific product."""
     conn = db()
     q = request.args.get("q", "").lower()
-    rows = conn.execute(
-        "SELECT * FROM inventory_log WHERE sku = ? ORDER BY created DESC", (sku,)
-    ).fetchall()
-    results = [dict(r) for r in rows]
+    sql = "SELECT * FROM inventory_log WHERE sku = ?"
+    params = [sku]
     if q:
-        results = [r for r in results if q in r.get("action", "").lower() or q in r.get("description", "").lower()]
-    return jsonify(results)
+        sql += " AND (LOWER(action) LIKE ? OR LOWER(description) LIKE ?)"
+        params.extend([f"%{q}%", f"%{q}%"])
+    try:
+        rows, page = keyset_page(conn, sql, params, [("created", "created"), ("id", "id")], descending=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return page_response(rows_to_list(rows), page)
 
 
 @app.route("/api/inventory/<sku>/stats", methods=["GET"])
 @login_required
+@cached_response(ttl=30, tags=lambda sku: (sku_sales_tag(sku),))
 def get_inventory_stats(sku):
-    """Get sales statistics for a specific product."""
-    conn = db()
+    """Get sales statistics for a specific product (one query over its daily rollup rows)."""
     today = date.today()
+    sold_by_day = db().execute(
+        """SELECT date, SUM(quantity) as qty FROM product_daily_rollup
+        WHERE sku = ? GROUP BY date HAVING SUM(quantity) > 0 ORDER BY date""",
+        (sku,)
+    ).fetchall()
+
+    def sold_between(start, end=None):
+        return sum(r["qty"] for r in sold_by_day if r["date"] >= start and (end is None or r["date"] < end))
 
     # Monthly sales aggregation (last 12 months)
     months = []
@@ -1022,50 +1676,26 @@ def get_inventory_stats(sku):
             next_month = d.replace(year=d.year + 1, month=1, day=1)
         else:
             next_month = d.replace(month=d.month + 1, day=1)
-        month_end = next_month.isoformat()
-        row = conn.execute(
-            """SELECT COALESCE(SUM(si.quantity), 0) as total_sold
-            FROM sale_items si JOIN sales s ON si.sale_id = s.id
-            WHERE si.sku = ? AND s.date >= ? AND s.date < ? AND s.status != 'Voided'""",
-            (sku, month_start, month_end)
-        ).fetchone()
         months.append({
             "label": d.strftime("%m/%Y"),
-            "sold": row["total_sold"] if row else 0
+            "sold": sold_between(month_start, next_month.isoformat())
         })
 
     # Summary metrics
-    now = today.isoformat()
     d30 = (today - timedelta(days=30)).isoformat()
     d90 = (today - timedelta(days=90)).isoformat()
     d365 = (today - timedelta(days=365)).isoformat()
 
-    def sold_since(since):
-        r = conn.execute(
-            """SELECT COALESCE(SUM(si.quantity), 0) as total
-            FROM sale_items si JOIN sales s ON si.sale_id = s.id
-            WHERE si.sku = ? AND s.date >= ? AND s.status != 'Voided'""",
-            (sku, since)
-        ).fetchone()
-        return r["total"] if r else 0
-
-    last_sold_row = conn.execute(
-        """SELECT s.date FROM sale_items si JOIN sales s ON si.sale_id = s.id
-        WHERE si.sku = ? AND s.status != 'Voided'
-        ORDER BY s.date DESC LIMIT 1""",
-        (sku,)
-    ).fetchone()
-
-    sold_365 = sold_since(d365)
+    sold_365 = sold_between(d365)
     weekly_avg = round(sold_365 / 52, 2) if sold_365 > 0 else 0
 
     return jsonify({
         "months": months,
-        "sold_30": sold_since(d30),
-        "sold_90": sold_since(d90),
+        "sold_30": sold_between(d30),
+        "sold_90": sold_between(d90),
         "sold_365": sold_365,
         "weekly_avg": weekly_avg,
-        "last_sold": last_sold_row["date"] if last_sold_row else "Never"
+        "last_sold": sold_by_day[-1]["date"] if sold_by_day else "Never"
     })
 
 
@@ -1108,14 +1738,14 @@ def add_inventory_purchase(sku):
         )
 
     # Audit log
-    conn.execute(
-        "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
+    log_inventory(conn, [
         (sku, "Purchase",
          f"Purchased {qty} units from {data.get('supplier', 'N/A')} @ ₹{cost:.2f}",
          "", data.get("invoice_number", ""), qty, now_str)
-    )
+    ])
 
     conn.commit()
+    invalidate_caches("inventory", skus=[sku])
     return jsonify({"success": True}), 201
 
 
@@ -1124,16 +1754,19 @@ def add_inventory_purchase(sku):
 def get_inventory_sales(sku):
     """Get all sale transactions for a specific product."""
     conn = db()
-    rows = conn.execute(
-        """SELECT si.*, s.receipt_number, s.date as sale_date, s.status,
-        i.cost_price, i.category
-        FROM sale_items si
-        JOIN sales s ON si.sale_id = s.id
-        JOIN inventory i ON si.sku = i.sku
-        WHERE si.sku = ? AND s.status != 'Voided'
-        ORDER BY s.date DESC""",
-        (sku,)
-    ).fetchall()
+    try:
+        rows, page = keyset_page(
+            conn,
+            """SELECT si.*, s.receipt_number, s.date as sale_date, s.status,
+            i.cost_price, i.category
+            FROM sale_items si
+            JOIN sales s ON si.sale_id = s.id
+            JOIN inventory i ON si.sku = i.sku
+            WHERE si.sku = ? AND s.status != 'Voided'""",
+            [sku], [("s.date", "sale_date"), ("si.id", "id")], descending=True
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     results = []
     for r in rows:
@@ -1149,7 +1782,7 @@ def get_inventory_sales(sku):
         row["markup_pct"] = round(markup, 2)
         results.append(row)
 
-    return jsonify(results)
+    return page_response(results, page)
 
 
 # ---------------------------------------------------------------------------
@@ -1180,27 +1813,28 @@ def get_sales():
         sql += " AND LOWER(cashier) LIKE ?"
         params.append(f"%{cashier.lower()}%")
 
-    sql += " ORDER BY timestamp DESC"
-    sales_rows = db().execute(sql, params).fetchall()
-
-    # Build response with nested items (matching original JSON format)
-    result = []
-    for s in sales_rows:
-        sale = row_to_dict(s)
-        items = db().execute(
-            """SELECT si.*, COALESCE(inv.category, '') as category
-               FROM sale_items si
-               LEFT JOIN inventory inv ON si.sku = inv.sku
-               WHERE si.sale_id = ?""", (sale["id"],)
-        ).fetchall()
-        sale["items"] = rows_to_list(items)
-        # Remove internal sale_id from items
-        for item in sale["items"]:
-            item.pop("id", None)
-            item.pop("sale_id", None)
-        result.append(sale)
+    conn = db()
+    try:
+        rows, page = keyset_page(conn, sql, params, [("timestamp", "timestamp"), ("id", "id")], descending=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result = rows_to_list(rows)
+
+    # Nested items (matching original JSON format), fetched in one set-based
+    # query per chunk of sales. List views can skip them with include_items=false.
+    if request.args.get("include_items", "true").lower() not in ("false", "0", "no"):
+        items = load_children(
+            conn, "sale_items", "sale_id", [sale["id"] for sale in result],
+            columns="c.*, COALESCE(inv.category, '') as category",
+            joins="LEFT JOIN inventory inv ON c.sku = inv.sku",
+        )
+        for sale in result:
+            sale["items"] = items[sale["id"]]
+            for item in sale["items"]:
+                # Remove internal ids from items
+                del item["id"], item["sale_id"]
 
-    return jsonify(result)
+    return page_response(result, page)
 
 
 @app.route("/api/sales", methods=["POST"])
@@ -1208,24 +1842,24 @@ def get_sales():
 def create_sale():
     sale = request.get_json()
     conn = db()
+    today = date.today().isoformat()
+    lines = sale.get("items", [])
 
-    # ---- STOCK VALIDATION ----
-    # Check that we have enough stock for every item BEFORE proceeding
-    stock_errors = []
-    for line in sale.get("items", []):
-        sku = line.get("sku")
-        qty = line.get("quantity", 1)
-        if not sku:
-            continue
-        row = conn.execute("SELECT name, quantity FROM inventory WHERE sku = ?", (sku,)).fetchone()
-        if not row:
-            stock_errors.append(f"Product {sku} not found in inventory")
-        elif row["quantity"] < qty:
-            stock_errors.append(
-                f"{row['name']} — only {row['quantity']} in stock, requested {qty}"
-            )
-
+    # A retried checkout (same key) gets the original receipt instead of a second sale
+    try:
+        key = idempotency_key(sale)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if key:
+        stored = stored_response(conn, "sale", key)
+        if stored:
+            return replayed(stored)
+
+    # ---- STOCK VALIDATION + RESERVATION ----
+    # Validate and decrement every line up front; nothing is kept unless all lines fit
+    stock_errors = reserve_stock(conn, lines, today)
     if stock_errors:
+        conn.rollback()
         return jsonify({
             "error": "Insufficient stock",
             "details": stock_errors
@@ -1237,59 +1871,17 @@ def create_sale():
     sale_date = date.today().isoformat()
 
     # ---- INSERT SALE ----
-    cursor = conn.execute(
-        """INSERT INTO sales
-        (receipt_number, timestamp, date, subtotal, discount_amount,
-         tax_amount, cgst_amount, sgst_amount, grand_total, payment_method, cashier,
-         customer_name, customer_phone, customer_email)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-        (receipt_number, timestamp, sale_date,
-         float(sale.get("subtotal", 0)),
-         float(sale.get("discount_amount", 0)),
-         float(sale.get("tax_amount", 0)),
-         float(sale.get("cgst_amount", 0)),
-         float(sale.get("sgst_amount", 0)),
-         float(sale.get("grand_total", 0)),
-         sale.get("payment_method", ""),
-         sale.get("cashier", ""),
-         sale.get("customer_name", ""),
-         sale.get("customer_phone", ""),
-         sale.get("customer_email", ""))
-    )
-    sale_id = cursor.lastrowid
+    sale_id = conn.execute(SALE_SQL, sale_params(sale, receipt_number, timestamp, sale_date)).lastrowid
 
-    # ---- INSERT ITEMS + DECREMENT STOCK ----
-    today = date.today().isoformat()
-    for line in sale.get("items", []):
-        sku = line.get("sku")
-        qty = line.get("quantity", 1)
+    # ---- INSERT ITEMS (one batch) ----
+    conn.executemany(SALE_ITEM_SQL, [sale_item_params(sale_id, line) for line in lines])
 
-        conn.execute(
-            """INSERT INTO sale_items
-            (sale_id, sku, name, hsn_code, quantity, unit_price, line_total,
-             discount_type, discount_value, discount_amount, final_total)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-            (sale_id, sku, line.get("name", ""), line.get("hsn_code", ""),
-             qty, float(line.get("unit_price", 0)),
-             float(line.get("line_total", 0)),
-             line.get("discount_type", "none"),
-             float(line.get("discount_value", 0)),
-             float(line.get("discount_amount", 0)),
-             float(line.get("final_total", line.get("line_total", 0))))
-        )
-
-        # Atomic stock decrement
-        if sku:
-            conn.execute(
-                "UPDATE inventory SET quantity = MAX(0, quantity - ?), last_updated = ? WHERE sku = ?",
-                (qty, today, sku)
-            )
-            # Audit log: sale
-            conn.execute(
-                "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
-                (sku, "Sale", f"Sold {qty} unit(s) — Receipt {receipt_number}",
-                 "", receipt_number, -qty, timestamp)
-            )
+    stocked = [(line["sku"], line.get("quantity", 1)) for line in lines if line.get("sku")]
+    # Audit log: sale
+    log_inventory(conn, [
+        (sku, "Sale", f"Sold {qty} unit(s) — Receipt {receipt_number}", "", receipt_number, -qty, timestamp)
+        for sku, qty in stocked
+    ])
 
     # ---- AUTO-CREATE CUSTOMER ----
     cust_phone = sale.get("customer_phone", "").strip()
@@ -1313,37 +1905,88 @@ def create_sale():
                 "INSERT INTO customers (phone, name, email, created, last_updated) VALUES (?, ?, ?, ?, ?)",
                 (cust_phone, cust_name, cust_email, now_str, now_str)
             )
+    record_customer_sales(conn, [(sale.get("customer_phone", ""), sale.get("grand_total", 0), timestamp)])
+    record_sale_rollups(conn, [sale_id])
+
+    body = sale_response_body(sale, receipt_number, timestamp, sale_date)
+    if key:
+        try:
+            store_response(conn, "sale", key, 201, body)
+        except Exception:
+            # A concurrent retry with the same key committed first: drop this copy, answer with that one
+            conn.rollback()
+            stored = stored_response(conn, "sale", key)
+            if stored:
+                return replayed(stored)
+            raise
 
     conn.commit()
+    sold = [sku for sku, _ in stocked]
+    invalidate_caches("sales", "inventory", *map(sku_sales_tag, sold), skus=sold)
+    return jsonify(body), 201
 
-    # Build response matching original format
-    sale_response = {
-        "receipt_number": receipt_number,
-        "timestamp": timestamp,
-        "date": sale_date,
-        "subtotal": sale.get("subtotal", 0),
-        "discount_amount": sale.get("discount_amount", 0),
-        "tax_amount": sale.get("tax_amount", 0),
-        "cgst_amount": sale.get("cgst_amount", 0),
-        "sgst_amount": sale.get("sgst_amount", 0),
-        "grand_total": sale.get("grand_total", 0),
-        "payment_method": sale.get("payment_method", ""),
-        "cashier": sale.get("cashier", ""),
-        "customer_name": sale.get("customer_name", ""),
-        "customer_phone": sale.get("customer_phone", ""),
-        "customer_email": sale.get("customer_email", ""),
-        "items": sale.get("items", []),
-    }
 
-    return jsonify({"success": True, "sale": sale_response}), 201
+def write_synced_sales(conn, records, today):
+    """
+    Insert a group of validated offline sales with one batched statement per table; no commit.
+    Raises if anything fails, including another terminal taking the stock first.
+    """
+    sale_ids = conn.insert_many(SALE_SQL, [r["params"] for r in records], returning_ids=True)
+    conn.executemany(SALE_ITEM_SQL, [
+        sale_item_params(sale_id, line) for sale_id, r in zip(sale_ids, records) for line in r["lines"]
+    ])
+    wanted = {}
+    for r in records:
+        for sku, qty in r["wanted"].items():
+            wanted[sku] = wanted.get(sku, 0) + qty
+    if not take_stock(conn, wanted, today):
+        raise RuntimeError("Stock changed on another terminal while syncing — please try again")
+    log_inventory(conn, [
+        (sku, "Sale", f"Sold {qty} unit(s) — Receipt {r['receipt_number']} (offline sync)",
+         "", r["receipt_number"], -qty, r["timestamp"])
+        for r in records for sku, qty in r["stocked"]
+    ])
+
+    # Auto-create customers (first name/email seen per phone)
+    new_customers = {}
+    for r in records:
+        phone = r["sale"].get("customer_phone", "").strip()
+        if phone and phone not in new_customers:
+            new_customers[phone] = (r["sale"].get("customer_name", "").strip(),
+                                    r["sale"].get("customer_email", "").strip())
+    phones = list(new_customers)
+    for i in range(0, len(phones), IN_CLAUSE_CHUNK):
+        chunk = phones[i:i + IN_CLAUSE_CHUNK]
+        for row in conn.execute(
+            f"SELECT phone FROM customers WHERE phone IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall():
+            new_customers.pop(row["phone"], None)
+    now_str = datetime.now().isoformat()
+    conn.executemany(
+        "INSERT INTO customers (phone, name, email, created, last_updated) VALUES (?, ?, ?, ?, ?)",
+        [(phone, name, email, now_str, now_str) for phone, (name, email) in new_customers.items()]
+    )
+
+    record_customer_sales(conn, [
+        (r["sale"].get("customer_phone", ""), r["sale"].get("grand_total", 0), r["timestamp"]) for r in records
+    ])
+    record_sale_rollups(conn, sale_ids)
+    store_responses(conn, "sale", [(r["key"], 201, r["body"]) for r in records if r["key"]])
 
 
 @app.route("/api/sales/batch", methods=["POST"])
 @login_required
 def batch_create_sales():
     """Process multiple offline-queued sales in one request.
-    Accepts: { sales: [ {items, subtotal, ...}, ... ] }
-    Returns: { results: [ {localId, status, receipt_number?, error?}, ... ] }
+    Accepts: { sales: [ {items, subtotal, idempotency_key?, ...}, ... ] }
+    Returns: { results: [ {localId, status, receipt_number?, duplicate?, error?}, ... ] }
+    A sale whose idempotency_key was already used (here or via POST /api/sales) is
+    not recorded again; its original receipt number comes back with duplicate: true.
+
+    Stock for the whole batch is read in one query and the accepted sales are written
+    together with one statement per table, inside a savepoint. If that fails, the sales
+    are retried one by one, each in its own savepoint, so one bad sale can't take the
+    others down or leave half of itself behind. Everything commits once.
     """
     payload = request.get_json()
     sales_list = payload.get("sales", [])
@@ -1351,103 +1994,109 @@ def batch_create_sales():
         return jsonify({"error": "No sales provided"}), 400
 
     conn = db()
-    results = []
+    try:
+        batch_key = idempotency_key(payload)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if batch_key:
+        stored = stored_response(conn, "sales_batch", batch_key)
+        if stored:
+            return replayed(stored)
 
-    for sale in sales_list:
+    today = date.today().isoformat()
+    results = [None] * len(sales_list)
+    records = {}  # index -> prepared sale
+
+    # ---- PREPARE (no queries) ----
+    for i, sale in enumerate(sales_list):
         local_id = sale.get("localId", "")
         try:
-            # ---- STOCK VALIDATION ----
-            stock_errors = []
-            for line in sale.get("items", []):
-                sku = line.get("sku")
-                qty = line.get("quantity", 1)
-                if not sku:
-                    continue
-                row = conn.execute("SELECT name, quantity FROM inventory WHERE sku = ?", (sku,)).fetchone()
-                if not row:
-                    stock_errors.append(f"Product {sku} not found")
-                elif row["quantity"] < qty:
-                    stock_errors.append(f"{row['name']} — only {row['quantity']} in stock, requested {qty}")
-
-            if stock_errors:
-                results.append({"localId": local_id, "status": "error", "error": "; ".join(stock_errors)})
-                continue
-
-            # ---- GENERATE RECEIPT ----
+            key = str(sale.get("idempotency_key") or "").strip()
+            if len(key) > IDEMPOTENCY_KEY_MAX_LEN:
+                raise ValueError(f"Idempotency key longer than {IDEMPOTENCY_KEY_MAX_LEN} characters")
             receipt_number = generate_receipt_number()
             timestamp = sale.get("timestamp") or datetime.now().isoformat()
             sale_date = timestamp[:10]
-
-            # ---- INSERT SALE ----
-            cursor = conn.execute(
-                """INSERT INTO sales
-                (receipt_number, timestamp, date, subtotal, discount_amount,
-                 tax_amount, cgst_amount, sgst_amount, grand_total, payment_method, cashier,
-                 customer_name, customer_phone, customer_email)
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                (receipt_number, timestamp, sale_date,
-                 float(sale.get("subtotal", 0)),
-                 float(sale.get("discount_amount", 0)),
-                 float(sale.get("tax_amount", 0)),
-                 float(sale.get("cgst_amount", 0)),
-                 float(sale.get("sgst_amount", 0)),
-                 float(sale.get("grand_total", 0)),
-                 sale.get("payment_method", ""),
-                 sale.get("cashier", ""),
-                 sale.get("customer_name", ""),
-                 sale.get("customer_phone", ""),
-                 sale.get("customer_email", ""))
-            )
-            sale_id = cursor.lastrowid
-            today = date.today().isoformat()
-
-            for line in sale.get("items", []):
-                sku = line.get("sku")
-                qty = line.get("quantity", 1)
-                conn.execute(
-                    """INSERT INTO sale_items
-                    (sale_id, sku, name, hsn_code, quantity, unit_price, line_total,
-                     discount_type, discount_value, discount_amount, final_total)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-                    (sale_id, sku, line.get("name", ""), line.get("hsn_code", ""),
-                     qty, float(line.get("unit_price", 0)),
-                     float(line.get("line_total", 0)),
-                     line.get("discount_type", "none"),
-                     float(line.get("discount_value", 0)),
-                     float(line.get("discount_amount", 0)),
-                     float(line.get("final_total", line.get("line_total", 0))))
-                )
-                if sku:
-                    conn.execute(
-                        "UPDATE inventory SET quantity = MAX(0, quantity - ?), last_updated = ? WHERE sku = ?",
-                        (qty, today, sku)
-                    )
-                    conn.execute(
-                        "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
-                        (sku, "Sale", f"Sold {qty} unit(s) — Receipt {receipt_number} (offline sync)",
-                         "", receipt_number, -qty, timestamp)
-                    )
-
-            # Auto-create customer
-            cust_phone = sale.get("customer_phone", "").strip()
-            cust_name = sale.get("customer_name", "").strip()
-            cust_email = sale.get("customer_email", "").strip()
-            if cust_phone:
-                existing_cust = conn.execute("SELECT id FROM customers WHERE phone = ?", (cust_phone,)).fetchone()
-                if not existing_cust:
-                    now_str = datetime.now().isoformat()
-                    conn.execute(
-                        "INSERT INTO customers (phone, name, email, created, last_updated) VALUES (?, ?, ?, ?, ?)",
-                        (cust_phone, cust_name, cust_email, now_str, now_str)
-                    )
-
-            results.append({"localId": local_id, "status": "ok", "receipt_number": receipt_number})
-
+            lines = sale.get("items", [])
+            records[i] = {
+                "sale": sale, "local_id": local_id, "key": key,
+                "receipt_number": receipt_number, "timestamp": timestamp, "lines": lines,
+                "params": sale_params(sale, receipt_number, timestamp, sale_date),
+                "wanted": cart_quantities(lines),
+                "stocked": [(line["sku"], line.get("quantity", 1)) for line in lines if line.get("sku")],
+                "body": sale_response_body(sale, receipt_number, timestamp, sale_date),
+            }
+        except Exception as e:
+            results[i] = {"localId": local_id, "status": "error", "error": str(e)}
+
+    # ---- REPLAYS + STOCK VALIDATION (one query each for the whole batch) ----
+    replays = stored_responses(conn, "sale", [r["key"] for r in records.values() if r["key"]])
+    stock = read_stock(conn, {sku for r in records.values() for sku in r["wanted"]})
+    available = {sku: row["quantity"] for sku, row in stock.items()}
+    names = {sku: row["name"] for sku, row in stock.items()}
+    accepted = []
+    first_with_key = {}  # key -> index of the sale in this batch that carries it
+    for i, r in records.items():
+        if r["key"] in replays:
+            results[i] = {"localId": r["local_id"], "status": "ok", "duplicate": True,
+                          "receipt_number": replays[r["key"]][1]["sale"]["receipt_number"]}
+            continue
+        if r["key"] in first_with_key:
+            continue  # resolved once we know whether the first copy was written
+        errors = stock_shortfalls(r["wanted"], available, names)
+        if errors:
+            results[i] = {"localId": r["local_id"], "status": "error", "error": "; ".join(errors)}
+            continue
+        for sku, qty in r["wanted"].items():
+            available[sku] -= qty
+        if r["key"]:
+            first_with_key[r["key"]] = i
+        accepted.append(i)
+
+    # ---- WRITE (batched; per-sale savepoints if the batch fails) ----
+    if accepted:
+        try:
+            with conn.savepoint():
+                write_synced_sales(conn, [records[i] for i in accepted], today)
         except Exception as e:
-            results.append({"localId": local_id, "status": "error", "error": str(e)})
+            print(f"  [WARN] Batch sync of {len(accepted)} sales failed ({e}); retrying one at a time")
+            written = []
+            for i in accepted:
+                try:
+                    with conn.savepoint():
+                        write_synced_sales(conn, [records[i]], today)
+                    written.append(i)
+                except Exception as e:
+                    results[i] = {"localId": records[i]["local_id"], "status": "error", "error": str(e)}
+            accepted = written
+
+    sold_skus = set()
+    for i in accepted:
+        r = records[i]
+        results[i] = {"localId": r["local_id"], "status": "ok", "receipt_number": r["receipt_number"]}
+        sold_skus.update(r["wanted"])
+    for i, r in records.items():
+        if results[i] is None:  # a repeat of a key another sale in this batch carries
+            first = results[first_with_key[r["key"]]]
+            results[i] = ({"localId": r["local_id"], "status": "ok", "duplicate": True,
+                           "receipt_number": first["receipt_number"]}
+                          if first["status"] == "ok" else
+                          {"localId": r["local_id"], "status": "error", "error": first["error"]})
+
+    body = {"results": results}
+    if batch_key:
+        try:
+            store_response(conn, "sales_batch", batch_key, 200, body)
+        except Exception:
+            conn.rollback()
+            stored = stored_response(conn, "sales_batch", batch_key)
+            if stored:
+                return replayed(stored)
+            raise
 
     conn.commit()
-    return jsonify({"results": results})
+    invalidate_caches("sales", "inventory", *map(sku_sales_tag, sold_skus), skus=sold_skus)
+    return jsonify(body)
 
 
 @app.route("/api/sales/<receipt_number>", methods=["GET"])
@@ -1495,19 +2144,18 @@ def void_sale(receipt_number):
     # Restore inventory quantities
     today = date.today().isoformat()
     now_str = datetime.now().isoformat()
-    for item in items:
-        if item["sku"]:
-            conn.execute(
-                "UPDATE inventory SET quantity = quantity + ?, last_updated = ? WHERE sku = ?",
-                (item["quantity"], today, item["sku"])
-            )
-            # Audit log: void refund
-            conn.execute(
-                "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) VALUES (?,?,?,?,?,?,?)",
-                (item["sku"], "Void Refund",
-                 f"Refunded {item['quantity']} unit(s) — Receipt {receipt_number}. Reason: {reason or 'N/A'}",
-                 "", receipt_number, item["quantity"], now_str)
-            )
+    stocked = [item for item in items if item["sku"]]
+    conn.executemany(
+        "UPDATE inventory SET quantity = quantity + ?, last_updated = ? WHERE sku = ?",
+        [(item["quantity"], today, item["sku"]) for item in stocked]
+    )
+    # Audit log: void refund
+    log_inventory(conn, [
+        (item["sku"], "Void Refund",
+         f"Refunded {item['quantity']} unit(s) — Receipt {receipt_number}. Reason: {reason or 'N/A'}",
+         "", receipt_number, item["quantity"], now_str)
+        for item in stocked
+    ])
 
     # Mark sale as voided
     voided_by = session.get("user", {}).get("name", "Unknown")
@@ -1515,7 +2163,11 @@ def void_sale(receipt_number):
         "UPDATE sales SET status = 'Voided', voided_at = ?, voided_by = ?, void_reason = ? WHERE id = ?",
         (datetime.now().isoformat(), voided_by, reason, sale["id"])
     )
+    unrecord_customer_sale(conn, sale.get("customer_phone", ""), sale.get("grand_total", 0))
+    unrecord_sale_rollups(conn, sale)
     conn.commit()
+    refunded = [item["sku"] for item in stocked]
+    invalidate_caches("sales", "inventory", *map(sku_sales_tag, refunded), skus=refunded)
 
     return jsonify({
         "success": True,
@@ -1526,57 +2178,59 @@ def void_sale(receipt_number):
 
 @app.route("/api/sales/dashboard", methods=["GET"])
 @login_required
+@cached_response(ttl=15, tags=("sales", "inventory", "settings"))
 def sales_dashboard():
     conn = db()
     settings = get_all_settings()
     today_str = date.today().isoformat()
     now = datetime.now()
 
-    # Today (exclude voided)
-    row = conn.execute(
-        "SELECT COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total FROM sales WHERE date = ? AND status != 'Voided'",
-        (today_str,)
-    ).fetchone()
+    # All sales figures come from the daily rollups (voided sales are kept apart there)
+    def sales_since(start, end=None):
+        sql = ("SELECT COALESCE(SUM(sale_count), 0) as cnt, COALESCE(SUM(total), 0) as total, "
+               "COALESCE(SUM(void_count), 0) as void_cnt, COALESCE(SUM(void_total), 0) as void_total "
+               "FROM sales_daily_rollup WHERE date >= ?")
+        params = [start]
+        if end:
+            sql += " AND date <= ?"
+            params.append(end)
+        return conn.execute(sql, params).fetchone()
+
+    # Today
+    row = sales_since(today_str, today_str)
     today_count = row["cnt"]
     today_total = row["total"]
 
-    # This week (Mon-Sun, exclude voided)
-    import datetime as dt_mod
-    week_start = (now - dt_mod.timedelta(days=now.weekday())).strftime("%Y-%m-%d")
-    row = conn.execute(
-        "SELECT COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total FROM sales WHERE date >= ? AND status != 'Voided'",
-        (week_start,)
-    ).fetchone()
+    # This week (Mon-Sun)
+    week_start = (now - timedelta(days=now.weekday())).strftime("%Y-%m-%d")
+    row = sales_since(week_start)
     week_count = row["cnt"]
     week_total = row["total"]
 
-    # This month (exclude voided)
+    # This month
     month_start = now.strftime("%Y-%m-01")
-    row = conn.execute(
-        "SELECT COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total FROM sales WHERE date >= ? AND status != 'Voided'",
-        (month_start,)
-    ).fetchone()
-    month_count = row["cnt"]
-    month_total = row["total"]
+    month_row = sales_since(month_start)
+    month_count = month_row["cnt"]
+    month_total = month_row["total"]
 
-    # Top selling products (this month, exclude voided)
+    # Top selling products (this month)
     top_rows = conn.execute(
-        """SELECT si.name, SUM(si.quantity) as qty_sold, SUM(si.final_total) as revenue
-           FROM sale_items si
-           JOIN sales s ON si.sale_id = s.id
-           WHERE s.status != 'Voided' AND s.date >= ?
-           GROUP BY si.sku, si.name
+        """SELECT name, SUM(quantity) as qty_sold, SUM(revenue) as revenue
+           FROM product_daily_rollup
+           WHERE date >= ?
+           GROUP BY sku, name
+           HAVING SUM(quantity) > 0
            ORDER BY qty_sold DESC
            LIMIT 5""",
         (month_start,)
     ).fetchall()
     top_products = [{"name": r["name"], "qty_sold": r["qty_sold"], "revenue": round(r["revenue"], 2)} for r in top_rows]
 
-    # Payment mix (this month, exclude voided)
+    # Payment mix (this month)
     pay_rows = conn.execute(
-        """SELECT payment_method, COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total
-           FROM sales WHERE status != 'Voided' AND date >= ?
-           GROUP BY payment_method ORDER BY total DESC""",
+        """SELECT payment_method, SUM(sale_count) as cnt, COALESCE(SUM(total), 0) as total
+           FROM sales_daily_rollup WHERE date >= ?
+           GROUP BY payment_method HAVING SUM(sale_count) > 0 ORDER BY total DESC""",
         (month_start,)
     ).fetchall()
     payment_mix = [{"method": r["payment_method"], "count": r["cnt"], "total": round(r["total"], 2)} for r in pay_rows]
@@ -1589,28 +2243,19 @@ def sales_dashboard():
     low_stock_items = rows_to_list(low_rows)
     total_inventory = conn.execute("SELECT COUNT(*) as cnt FROM inventory").fetchone()["cnt"]
 
-    # Revenue & Cost — this month (exclude voided)
-    total_revenue_row = conn.execute(
-        "SELECT COALESCE(SUM(grand_total), 0) as total FROM sales WHERE status != 'Voided' AND date >= ?",
-        (month_start,)
-    ).fetchone()
-    total_revenue = total_revenue_row["total"]
-
+    # Revenue & Cost — this month (cost at today's inventory cost price)
+    total_revenue = month_total
     cost_row = conn.execute(
-        """SELECT COALESCE(SUM(si.quantity * COALESCE(inv.cost_price, 0)), 0) as total_cost
-           FROM sale_items si
-           JOIN sales s ON si.sale_id = s.id
-           LEFT JOIN inventory inv ON si.sku = inv.sku
-           WHERE s.status != 'Voided' AND s.date >= ?""",
+        """SELECT COALESCE(SUM(p.quantity * COALESCE(inv.cost_price, 0)), 0) as total_cost
+           FROM product_daily_rollup p
+           LEFT JOIN inventory inv ON p.sku = inv.sku
+           WHERE p.date >= ?""",
         (month_start,)
     ).fetchone()
     total_cost = cost_row["total_cost"]
 
     # Void/refund counts — this month
-    void_row = conn.execute(
-        "SELECT COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total FROM sales WHERE status = 'Voided' AND date >= ?",
-        (month_start,)
-    ).fetchone()
+    void_row = {"cnt": month_row["void_cnt"], "total": month_row["void_total"]}
 
     return jsonify({
         "today_total": round(today_total, 2),
@@ -1639,26 +2284,35 @@ def sales_dashboard():
 @app.route("/api/sales/export", methods=["GET"])
 @login_required
 def export_sales_csv():
-    conn = db()
-    sales_rows = conn.execute("SELECT * FROM sales ORDER BY timestamp DESC").fetchall()
-    if not sales_rows:
+    sql = """SELECT s.*, si.name AS item_name, si.quantity AS item_quantity
+             FROM sales s LEFT JOIN sale_items si ON si.sale_id = s.id
+             WHERE 1=1"""
+    params = []
+    start = request.args.get("start")
+    end = request.args.get("end")
+    if start:
+        sql += " AND s.date >= ?"
+        params.append(start)
+    if end:
+        sql += " AND s.date <= ?"
+        params.append(end)
+    sql += " ORDER BY s.timestamp DESC, s.id DESC, si.id"
+
+    # One joined query; a sale's item rows arrive together and are folded into
+    # items_summary as they stream past.
+    rows = db().iter_rows(sql, params)
+    first = next(rows, None)
+    if first is None:
         return Response("No data", mimetype="text/plain")
 
-    output = io.StringIO()
     fieldnames = [
         "receipt_number", "date", "timestamp", "cashier",
         "subtotal", "discount_amount", "tax_amount", "cgst_amount", "sgst_amount", "grand_total",
         "payment_method", "customer_name", "customer_phone", "items_summary"
     ]
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-
-    for s in sales_rows:
-        sale = row_to_dict(s)
-        items = conn.execute("SELECT name, quantity FROM sale_items WHERE sale_id = ?", (sale["id"],)).fetchall()
-        items_str = "; ".join(f"{i['name']} x{i['quantity']}" for i in items)
 
-        writer.writerow({
+    def sale_record(sale, items):
+        return {
             "receipt_number": sale.get("receipt_number", ""),
             "date": sale.get("date", ""),
             "timestamp": sale.get("timestamp", ""),
@@ -1672,14 +2326,21 @@ def export_sales_csv():
             "payment_method": sale.get("payment_method", ""),
             "customer_name": sale.get("customer_name", ""),
             "customer_phone": sale.get("customer_phone", ""),
-            "items_summary": items_str,
-        })
+            "items_summary": "; ".join(items),
+        }
 
-    return Response(
-        output.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=sales.csv"},
-    )
+    def records():
+        current, items = None, []
+        for r in itertools.chain((first,), rows):
+            if current is None or r["id"] != current["id"]:
+                if current is not None:
+                    yield sale_record(current, items)
+                current, items = row_to_dict(r), []
+            if r["item_name"] is not None:
+                items.append(f"{r['item_name']} x{r['item_quantity']}")
+        yield sale_record(current, items)
+
+    return csv_response(fieldnames, records(), "sales.csv")
 
 
 # ---------------------------------------------------------------------------
@@ -1730,25 +2391,16 @@ def remove_held(hold_id):
 @login_required
 def list_suppliers():
     conn = db()
-    rows = conn.execute("SELECT * FROM suppliers ORDER BY name").fetchall()
-    suppliers = rows_to_list(rows)
-
-    # Count inventory items per supplier
-    # Union of: (a) inventory.supplier matches name, (b) items from PO for this supplier
-    for s in suppliers:
-        count = conn.execute(
-            """SELECT COUNT(DISTINCT sku) as cnt FROM (
-                SELECT sku FROM inventory WHERE LOWER(supplier) = LOWER(?)
-                UNION
-                SELECT poi.sku FROM purchase_order_items poi
-                JOIN purchase_orders po ON poi.order_id = po.id
-                WHERE po.supplier_id = ?
-            ) AS combined""",
-            (s["name"], s["id"])
-        ).fetchone()["cnt"]
-        s["item_count"] = count
-
-    return jsonify(suppliers)
+    # Item count per supplier: SKUs whose inventory.supplier names it plus SKUs
+    # on its purchase orders, both kept in supplier_products.
+    rows = conn.execute(
+        """SELECT s.*, COUNT(DISTINCT sp.sku) AS item_count
+           FROM suppliers s
+           LEFT JOIN supplier_products sp ON sp.supplier_id = s.id
+           GROUP BY s.id
+           ORDER BY s.name"""
+    ).fetchall()
+    return jsonify(rows_to_list(rows))
 
 
 @app.route("/api/suppliers/<int:supplier_id>/items", methods=["GET"])
@@ -1756,22 +2408,15 @@ def list_suppliers():
 def supplier_items(supplier_id):
     """Return all inventory items linked to a supplier (by name match or purchase orders)."""
     conn = db()
-    row = conn.execute("SELECT * FROM suppliers WHERE id = ?", (supplier_id,)).fetchone()
+    row = conn.execute("SELECT id FROM suppliers WHERE id = ?", (supplier_id,)).fetchone()
     if not row:
         return jsonify({"error": "Supplier not found"}), 404
 
-    supplier_name = row["name"]
-
     items = conn.execute(
-        """SELECT DISTINCT i.* FROM inventory i
-           WHERE LOWER(i.supplier) = LOWER(?)
-           UNION
-           SELECT DISTINCT i.* FROM inventory i
-           JOIN purchase_order_items poi ON poi.sku = i.sku
-           JOIN purchase_orders po ON poi.order_id = po.id
-           WHERE po.supplier_id = ?
-           ORDER BY name""",
-        (supplier_name, supplier_id)
+        """SELECT i.* FROM inventory i
+           WHERE i.sku IN (SELECT sku FROM supplier_products WHERE supplier_id = ?)
+           ORDER BY i.name""",
+        (supplier_id,)
     ).fetchall()
 
     return jsonify(rows_to_list(items))
@@ -1797,8 +2442,9 @@ def create_supplier():
              data.get("email", ""), data.get("address", ""), data.get("notes", ""),
              now, now)
         )
-        conn.commit()
         new_id = cursor.lastrowid
+        sync_supplier_name_links(conn, new_id)
+        conn.commit()
         return jsonify({"success": True, "id": new_id, "message": f"Supplier '{name}' created"}), 201
     except Exception as e:
         if "UNIQUE" in str(e):
@@ -1831,6 +2477,8 @@ def update_supplier(supplier_id):
              data.get("notes", row["notes"]),
              now, supplier_id)
         )
+        if name != row["name"]:
+            sync_supplier_name_links(conn, supplier_id)
         conn.commit()
         return jsonify({"success": True, "message": f"Supplier '{name}' updated"})
     except Exception as e:
@@ -1848,6 +2496,7 @@ def delete_supplier(supplier_id):
     if not row:
         return jsonify({"error": "Supplier not found"}), 404
 
+    conn.execute("DELETE FROM supplier_products WHERE supplier_id = ?", (supplier_id,))
     conn.execute("DELETE FROM suppliers WHERE id = ?", (supplier_id,))
     conn.commit()
     return jsonify({"success": True, "message": f"Supplier '{row['name']}' deleted"})
@@ -1861,20 +2510,26 @@ def delete_supplier(supplier_id):
 @login_required
 def list_customers():
     conn = db()
-    rows = conn.execute("SELECT * FROM customers ORDER BY name").fetchall()
+    # Sales per customer (by phone, excluding voided) come from customer_stats,
+    # which the sale and void endpoints keep current.
+    try:
+        rows, page = keyset_page(
+            conn,
+            "SELECT c.*, COALESCE(cs.order_count, 0) AS order_count, "
+            "COALESCE(cs.total_spent, 0) AS total_spent, COALESCE(cs.last_purchase, '') AS last_purchase, "
+            "COALESCE(c.name, '') AS sort_name "
+            "FROM customers c LEFT JOIN customer_stats cs ON cs.phone = c.phone WHERE 1=1",
+            # name is nullable: `name > NULL` matches nothing, so seek on the coalesced value
+            [], [("COALESCE(c.name, '')", "sort_name"), ("c.id", "id")]
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     customers = rows_to_list(rows)
-
-    # Count sales per customer (by phone, exclude voided)
     for c in customers:
-        stats = conn.execute(
-            "SELECT COUNT(*) as cnt, COALESCE(SUM(grand_total), 0) as total "
-            "FROM sales WHERE customer_phone = ? AND status != 'Voided'",
-            (c["phone"],)
-        ).fetchone()
-        c["order_count"] = stats["cnt"]
-        c["total_spent"] = round(stats["total"], 2)
+        del c["sort_name"]
+        c["total_spent"] = round(c["total_spent"], 2)
 
-    return jsonify(customers)
+    return page_response(customers, page)
 
 
 @app.route("/api/customers", methods=["POST"])
@@ -1971,19 +2626,23 @@ def _generate_order_number():
 @admin_required
 def list_orders():
     conn = db()
-    rows = conn.execute(
-        "SELECT * FROM purchase_orders ORDER BY created DESC"
-    ).fetchall()
-    orders = []
-    for r in rows:
-        o = dict(r)
-        items = conn.execute(
-            "SELECT * FROM purchase_order_items WHERE order_id = ?", (o["id"],)
-        ).fetchall()
-        o["items"] = [dict(i) for i in items]
+    sql = "SELECT * FROM purchase_orders WHERE 1=1"
+    params = []
+    statuses = [st.strip() for st in request.args.get("status", "").split(",") if st.strip()]
+    if statuses:  # a blank ?status= (or just commas) means no filter; IN () is invalid on PostgreSQL
+        sql += f" AND status IN ({','.join('?' * len(statuses))})"
+        params.extend(statuses)
+    try:
+        rows, page = keyset_page(conn, sql, params, [("created", "created"), ("id", "id")], descending=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    orders = rows_to_list(rows)
+    items = load_children(conn, "purchase_order_items", "order_id", [o["id"] for o in orders])
+    for o in orders:
+        o["items"] = items[o["id"]]
         o["item_count"] = len(o["items"])
-        orders.append(o)
-    return jsonify(orders)
+    return page_response(orders, page)
 
 
 @app.route("/api/orders", methods=["POST"])
@@ -2020,14 +2679,17 @@ def create_order():
     )
     order_id = cursor.lastrowid
 
+    item_rows = []
     for it in items:
         qty = int(it.get("quantity", 0))
         cost = float(it.get("cost_price", 0))
-        conn.execute(
-            "INSERT INTO purchase_order_items (order_id, sku, product_name, quantity, received_qty, cost_price, line_total) "
-            "VALUES (?,?,?,?,0,?,?)",
-            (order_id, it["sku"], it.get("product_name", ""), qty, cost, qty * cost)
-        )
+        item_rows.append((order_id, it["sku"], it.get("product_name", ""), qty, cost, qty * cost))
+    conn.executemany(
+        "INSERT INTO purchase_order_items (order_id, sku, product_name, quantity, received_qty, cost_price, line_total) "
+        "VALUES (?,?,?,?,0,?,?)",
+        item_rows
+    )
+    sync_order_supplier_links(conn, [supplier_id])
 
     conn.commit()
     return jsonify({"success": True, "order_number": order_number, "id": order_id})
@@ -2080,15 +2742,18 @@ def update_order(order_id):
 
     # Replace items
     conn.execute("DELETE FROM purchase_order_items WHERE order_id = ?", (order_id,))
+    item_rows = []
     for it in items:
         qty = int(it.get("quantity", 0))
         cost = float(it.get("cost_price", 0))
-        conn.execute(
-            "INSERT INTO purchase_order_items (order_id, sku, product_name, quantity, received_qty, cost_price, line_total) "
-            "VALUES (?,?,?,?,?,?,?)",
-            (order_id, it["sku"], it.get("product_name", ""), qty,
-             int(it.get("received_qty", 0)), cost, qty * cost)
-        )
+        item_rows.append((order_id, it["sku"], it.get("product_name", ""), qty,
+                          int(it.get("received_qty", 0)), cost, qty * cost))
+    conn.executemany(
+        "INSERT INTO purchase_order_items (order_id, sku, product_name, quantity, received_qty, cost_price, line_total) "
+        "VALUES (?,?,?,?,?,?,?)",
+        item_rows
+    )
+    sync_order_supplier_links(conn, [row["supplier_id"], supplier_id])
 
     conn.commit()
     return jsonify({"success": True, "message": "Order updated"})
@@ -2108,6 +2773,7 @@ def delete_order(order_id):
 
     conn.execute("DELETE FROM purchase_order_items WHERE order_id = ?", (order_id,))
     conn.execute("DELETE FROM purchase_orders WHERE id = ?", (order_id,))
+    sync_order_supplier_links(conn, [row["supplier_id"]])
     conn.commit()
     return jsonify({"success": True, "message": f"Order {row['order_number']} deleted"})
 
@@ -2131,6 +2797,23 @@ def receive_order(order_id):
     received_items = data.get("items", [])
     cashier = session.get("user", {}).get("name", "system")
 
+    # Preload the order lines and the affected products in two queries
+    # instead of two SELECTs per received line.
+    skus = list({ri.get("sku", "") for ri in received_items if int(ri.get("received_qty", 0)) > 0})
+    po_items = {}
+    products = {}
+    if skus:
+        for poi in conn.execute(
+            "SELECT * FROM purchase_order_items WHERE order_id = ? ORDER BY id", (order_id,)
+        ).fetchall():
+            po_items.setdefault(poi["sku"], dict(poi.items()))
+        placeholders = ",".join("?" * len(skus))
+        for product in conn.execute(
+            f"SELECT sku, quantity, selling_price FROM inventory WHERE sku IN ({placeholders})", skus
+        ).fetchall():
+            products[product["sku"]] = dict(product.items())
+
+    poi_updates, stock_updates, log_entries, purchase_rows = [], [], [], []
     all_received = True
     for ri in received_items:
         sku = ri.get("sku", "")
@@ -2138,11 +2821,7 @@ def receive_order(order_id):
         if recv_qty <= 0:
             continue
 
-        # Update purchase_order_items received_qty
-        poi = conn.execute(
-            "SELECT * FROM purchase_order_items WHERE order_id = ? AND sku = ?",
-            (order_id, sku)
-        ).fetchone()
+        poi = po_items.get(sku)
         if not poi:
             continue
 
@@ -2156,35 +2835,26 @@ def receive_order(order_id):
             continue
 
         new_received = already_received + recv_qty
-        conn.execute(
-            "UPDATE purchase_order_items SET received_qty = ? WHERE id = ?",
-            (new_received, poi["id"])
-        )
+        poi["received_qty"] = new_received
+        poi_updates.append((new_received, poi["id"]))
 
         if new_received < ordered_qty:
             all_received = False
 
         # Update inventory stock
-        product = conn.execute("SELECT * FROM inventory WHERE sku = ?", (sku,)).fetchone()
+        product = products.get(sku)
         if product:
             old_qty = int(product["quantity"])
             new_qty = old_qty + recv_qty
-            conn.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE sku = ?",
-                         (new_qty, now, sku))
+            product["quantity"] = new_qty
+            stock_updates.append((recv_qty, now, sku))
 
-            # Log to inventory_log
-            conn.execute(
-                "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) "
-                "VALUES (?,?,?,?,?,?,?)",
+            log_entries.append(
                 (sku, "PO Received",
                  f"Received {recv_qty} units from PO {row['order_number']}",
                  str(old_qty), str(new_qty), recv_qty, now)
             )
-
-            # Log to purchases table
-            conn.execute(
-                "INSERT INTO purchases (sku, date, supplier, quantity, cost_price, selling_price, "
-                "total_cost, invoice_number, notes, created) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            purchase_rows.append(
                 (sku, now[:10], row["supplier_name"], recv_qty,
                  float(poi.get("cost_price", 0)), float(product.get("selling_price", 0)),
                  recv_qty * float(poi.get("cost_price", 0)),
@@ -2192,6 +2862,16 @@ def receive_order(order_id):
                  data.get("notes", ""), now)
             )
 
+    conn.executemany("UPDATE purchase_order_items SET received_qty = ? WHERE id = ?", poi_updates)
+    conn.executemany("UPDATE inventory SET quantity = quantity + ?, last_updated = ? WHERE sku = ?",
+                     stock_updates)
+    log_inventory(conn, log_entries)
+    conn.executemany(
+        "INSERT INTO purchases (sku, date, supplier, quantity, cost_price, selling_price, "
+        "total_cost, invoice_number, notes, created) VALUES (?,?,?,?,?,?,?,?,?,?)",
+        purchase_rows
+    )
+
     # Update order status
     new_status = "received" if all_received else "partial"
     conn.execute(
@@ -2200,6 +2880,7 @@ def receive_order(order_id):
     )
 
     conn.commit()
+    invalidate_caches("inventory", skus=[sku for _, _, sku in stock_updates])
     return jsonify({"success": True, "message": f"Order {row['order_number']} — {new_status}", "status": new_status})
 
 
@@ -2226,6 +2907,22 @@ def trigger_backup():
     return jsonify({"error": "Backup failed"}), 500
 
 
+@app.route("/api/maintenance/rebuild-stats", methods=["POST"])
+@login_required
+@admin_required
+def rebuild_stats():
+    """Recompute the derived statistics tables from the sales history."""
+    counts = rebuild_derived_tables(db())
+    invalidate_caches(everything=True)
+    return jsonify({"success": True, **counts})
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute the derived statistics tables (flask --app app rebuild-stats)."""
+    rebuild_derived_tables()
+
+
 # ---------------------------------------------------------------------------
 # Data Migration API (export local → import cloud)
 # ---------------------------------------------------------------------------
@@ -2234,7 +2931,12 @@ def trigger_backup():
 @login_required
 @admin_required
 def api_export_data():
-    """Export all data as JSON (for migrating local SQLite → cloud PostgreSQL)."""
+    """Export all data as JSON (for migrating local SQLite → cloud PostgreSQL).
+    ?format=ndjson streams one {"table", "row"} object per line instead (add
+    ?gzip=1 to compress), which keeps memory flat for large stores.
+    """
+    if request.args.get("format") == "ndjson":
+        return ndjson_export_response(request.args.get("gzip") in ("1", "true"))
     try:
         data = export_all_data()
         return jsonify({
@@ -2253,12 +2955,47 @@ def api_export_data():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/api/data/import", methods=["POST"])
-def api_import_data():
-    """Import JSON data into current database (used to seed cloud PostgreSQL).
-    Allows unauthenticated access only if the database has zero users (first-time setup).
-    """
-    # Check if this is first-time setup (empty database)
+EXPORT_FORMAT_VERSION = 1
+
+
+def iter_ndjson_export(conn):
+    """NDJSON lines: a header, one {"table", "row"} per record, then a {"summary"} line."""
+    yield json.dumps({"format": "nlf-pos-export", "version": EXPORT_FORMAT_VERSION,
+                      "engine": "PostgreSQL" if USE_POSTGRES else "SQLite",
+                      "exported": datetime.now().isoformat()}) + "\n"
+    counts = defaultdict(int)
+    for table, rec in iter_export(conn):
+        counts[table] += 1
+        yield json.dumps({"table": table, "row": rec}, default=str, separators=(",", ":")) + "\n"
+    yield json.dumps({"summary": counts}) + "\n"
+
+
+def ndjson_export_response(compress):
+    def generate():
+        buf, size = [], 0
+        gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 → gzip container
+        for line in iter_ndjson_export(db()):
+            buf.append(line)
+            size += len(line)
+            if size >= STREAM_FLUSH_BYTES:
+                chunk = "".join(buf).encode("utf-8")
+                buf, size = [], 0
+                chunk = gz.compress(chunk) if gz else chunk
+                if chunk:
+                    yield chunk
+        chunk = "".join(buf).encode("utf-8")
+        yield (gz.compress(chunk) + gz.flush()) if gz else chunk
+
+    filename = "nlf_export.ndjson.gz" if compress else "nlf_export.ndjson"
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+def _import_auth_error():
+    """Imports are open only while the database has zero users (first-time setup); after that, admin only."""
     user_count = db().execute("SELECT COUNT(*) as cnt FROM users").fetchone()["cnt"]
 
     if user_count > 0:
@@ -2267,18 +3004,142 @@ def api_import_data():
             return jsonify({"error": "Unauthorized — database already has users. Login as admin first."}), 401
         if session["user"].get("role") != "admin":
             return jsonify({"error": "Admin access required"}), 403
+    return None
+
+
+@app.route("/api/data/import", methods=["POST"])
+def api_import_data():
+    """Import JSON data into current database (used to seed cloud PostgreSQL).
+    Allows unauthenticated access only if the database has zero users (first-time setup).
+    ?mode=bulk uses the staging-table bulk loader and reports per-table throughput.
+    """
+    error = _import_auth_error()
+    if error:
+        return error
 
     data = request.get_json()
     if not data or "data" not in data:
         return jsonify({"error": "No data provided. Send {data: {...}}"}), 400
 
     try:
+        if request.args.get("mode") == "bulk":
+            imported, throughput = bulk_import_data(data["data"])
+            invalidate_caches(everything=True)
+            return jsonify({"success": True, "imported": imported, "throughput": throughput})
         imported = import_all_data(data["data"])
+        invalidate_caches(everything=True)
         return jsonify({"success": True, "imported": imported})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# ---------------------------------------------------------------------------
+# Resumable chunked import (migrate_to_cloud.py upload)
+# ---------------------------------------------------------------------------
+# The client opens a session, then PUTs each table in offset-numbered chunks
+# (optionally gzip-compressed). A session opened on an empty database is a
+# bootstrap session: its token alone authorizes the remaining chunks even after
+# the users chunk has made the database non-empty. Any other session also needs
+# the admin login on every write. Sessions expire IMPORT_SESSION_TTL_HOURS after
+# they were opened.
+
+IMPORT_MAX_BODY = 64 * 1024 * 1024  # decompressed bytes per chunk
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def import_session_required(f):
+    """Require the X-Import-Token issued when the session was opened (and the admin login for writes)."""
+    @functools.wraps(f)
+    def decorated(session_id, *args, **kwargs):
+        row = db().execute("SELECT token_hash, status, bootstrap, created FROM import_sessions WHERE id = ?",
+                           (session_id,)).fetchone()
+        token = request.headers.get("X-Import-Token", "")
+        if not row or not token or not hmac.compare_digest(row["token_hash"], _token_hash(token)):
+            return jsonify({"error": "Unknown import session or invalid token"}), 401
+        status = row["status"]
+        if status == "open" and import_session_expired(row["created"]):
+            expire_import_session(db(), session_id)
+            status = "expired"
+        if request.method != "GET":
+            if status == "expired":
+                return jsonify({"error": "Import session has expired — open a new one"}), 410
+            if status != "open":
+                return jsonify({"error": "Import session is already complete"}), 409
+            if not row["bootstrap"]:
+                error = _import_auth_error()
+                if error:
+                    return error
+        return f(session_id, *args, **kwargs)
+    return decorated
+
+
+def _request_json_body():
+    """Parse the JSON request body, accepting Content-Encoding: gzip."""
+    raw = request.get_data()
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        d = zlib.decompressobj(31)
+        raw = d.decompress(raw, IMPORT_MAX_BODY)
+        if d.unconsumed_tail:
+            raise ValueError("Chunk too large")
+    return json.loads(raw)
+
+
+@app.route("/api/data/import/sessions", methods=["POST"])
+def open_import_session():
+    """Open a resumable import session. Same access rule as /api/data/import."""
+    error = _import_auth_error()
+    if error:
+        return error
+    bootstrap = db().execute("SELECT COUNT(*) as cnt FROM users").fetchone()["cnt"] == 0
+    token = secrets.token_urlsafe(32)
+    session_id = create_import_session(db(), _token_hash(token), bootstrap)
+    print(f"  [IMPORT] Opened import session {session_id}")
+    return jsonify({"success": True, "session_id": session_id, "token": token, "tables": list(EXPORT_TABLES)}), 201
+
+
+@app.route("/api/data/import/sessions/<session_id>", methods=["GET"])
+@import_session_required
+def get_import_session(session_id):
+    """Which chunks the server has acknowledged, so an interrupted upload can resume."""
+    row = db().execute("SELECT status, bootstrap, created, last_updated FROM import_sessions WHERE id = ?",
+                       (session_id,)).fetchone()
+    return jsonify({"session_id": session_id, **row_to_dict(row), "tables": import_session_status(db(), session_id)})
+
+
+@app.route("/api/data/import/sessions/<session_id>/chunks/<table>/<int:offset>", methods=["PUT"])
+@import_session_required
+def put_import_chunk(session_id, table, offset):
+    """Import one chunk ({"records": [...]}) of a table. Resending an acknowledged chunk is a no-op."""
+    if table not in EXPORT_TABLES:
+        return jsonify({"error": f"Unknown table: {table}"}), 400
+    try:
+        body = _request_json_body()
+    except (ValueError, zlib.error) as e:
+        return jsonify({"error": f"Invalid chunk body: {e}"}), 400
+    records = body.get("records") if isinstance(body, dict) else None
+    if not isinstance(records, list):
+        return jsonify({"error": "No records provided. Send {records: [...]}"}), 400
+
+    try:
+        ack, duplicate = import_session_chunk(db(), session_id, table, offset, records)
+    except Exception as e:
+        print(f"  [WARN] Import chunk {table}@{offset} failed: {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"success": True, "duplicate": duplicate, **ack})
+
+
+@app.route("/api/data/import/sessions/<session_id>/finish", methods=["POST"])
+@import_session_required
+def finish_import(session_id):
+    """Close the session and rebuild derived tables."""
+    counts = finish_import_session(db(), session_id)
+    invalidate_caches(everything=True)
+    return jsonify({"success": True, "tables": import_session_status(db(), session_id), "derived": counts})
+
+
 @app.route("/api/health", methods=["GET"])
 def health_check():
     """Health check endpoint for monitoring and platform health checks."""
@@ -2290,6 +3151,11 @@ def health_check():
             "status": "healthy",
             "engine": engine,
             "users": user_count,
+            "pool": pool_stats(),
+            "sql_translation": sql_translation_stats(),
+            "response_cache": response_cache.stats(),
+            "product_cache": product_cache.stats(),
+            "audit_writer": audit_writer.stats() if audit_writer else None,
             "timestamp": datetime.now().isoformat(),
         })
     except Exception as e:
@@ -2304,6 +3170,7 @@ def health_check():
 # Initialize database on import (for gunicorn)
 init_db()
 migrate_from_json()
+close_db()
 
 if __name__ == "__main__":
     if not USE_POSTGRES:
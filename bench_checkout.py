@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+bench_checkout.py — Concurrent checkout benchmark / oversell check
+
+Creates a throwaway product with a small stock, then fires many parallel
+one-unit checkouts at it from separate threads (like several terminals selling
+the last units at once) and checks that exactly `stock` of them succeed and
+the product never goes below zero.
+
+Usage:
+  python3 bench_checkout.py http://localhost:5000 [--checkouts 50] [--stock 10] [--threads 25]
+
+Run it against a test instance: the sales and the product it creates are real.
+Exits with status 1 if stock was oversold.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _request(url, payload=None, cookie="", method="GET"):
+    """Send a JSON request; returns (status, decoded body, Set-Cookie header)."""
+    headers = {"Cookie": cookie} if cookie else {}
+    body = None
+    if payload is not None:
+        body = json.dumps(payload).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    try:
+        resp = urllib.request.urlopen(req, timeout=60)
+    except urllib.error.HTTPError as e:
+        resp = e
+    return resp.status, json.loads(resp.read() or b"null"), resp.headers.get("Set-Cookie", "")
+
+
+def _login(base_url):
+    username = input("Username: ").strip()
+    password = input("Password: ").strip()
+    status, body, cookie = _request(f"{base_url}/api/auth/login",
+                                    {"username": username, "password": password}, method="POST")
+    if status != 200:
+        print(f"Login failed: {body}")
+        sys.exit(1)
+    return cookie.split(";")[0]
+
+
+def run(base_url, checkouts, stock, threads):
+    cookie = _login(base_url)
+
+    status, body, _ = _request(f"{base_url}/api/inventory", {
+        "name": f"Checkout benchmark {int(time.time())}",
+        "selling_price": 1, "cost_price": 1, "quantity": stock,
+    }, cookie, "POST")
+    if status != 201:
+        print(f"Could not create benchmark product: {body}")
+        sys.exit(1)
+    sku = body["product"]["sku"]
+    print(f"Product {sku} created with {stock} in stock; firing {checkouts} checkouts on {threads} threads...")
+
+    sale = {
+        "items": [{"sku": sku, "name": "Checkout benchmark", "quantity": 1,
+                   "unit_price": 1, "line_total": 1, "final_total": 1}],
+        "subtotal": 1, "grand_total": 1, "payment_method": "Cash", "cashier": "bench",
+    }
+    start = threading.Barrier(min(threads, checkouts))
+
+    def checkout(i):
+        if i < start.parties:
+            start.wait()  # release the first wave together
+        t0 = time.perf_counter()
+        status, _, _ = _request(f"{base_url}/api/sales", sale, cookie, "POST")
+        return status, time.perf_counter() - t0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(checkout, range(checkouts)))
+    elapsed = time.perf_counter() - started
+
+    sold = sum(1 for status, _ in results if status == 201)
+    refused = sum(1 for status, _ in results if status == 400)
+    other = checkouts - sold - refused
+    _, product, _ = _request(f"{base_url}/api/inventory/{sku}", cookie=cookie)
+    left = product["quantity"]
+    latencies = sorted(t for _, t in results)
+
+    print(f"\n  Sold:     {sold}")
+    print(f"  Refused:  {refused} (insufficient stock)")
+    if other:
+        print(f"  Errors:   {other}")
+    print(f"  Left:     {left}")
+    print(f"  Time:     {elapsed:.2f}s ({checkouts / elapsed:.0f} checkouts/s)")
+    print(f"  Latency:  p50 {statistics.median(latencies) * 1000:.0f}ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms")
+
+    ok = sold <= stock and left == stock - sold and left >= 0
+    print("\nOK: no oversell" if ok else "\nFAIL: stock was oversold or lost")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent checkout benchmark / oversell check")
+    parser.add_argument("url", help="Base URL of a running POS, e.g. http://localhost:5000")
+    parser.add_argument("--checkouts", type=int, default=50, help="checkouts to attempt (default 50)")
+    parser.add_argument("--stock", type=int, default=10, help="units of stock to start with (default 10)")
+    parser.add_argument("--threads", type=int, default=25, help="parallel terminals (default 25)")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.url.rstrip("/"), args.checkouts, args.stock, args.threads) else 1)
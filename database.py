@@ -7,13 +7,20 @@ When DATABASE_URL is set and starts with "postgres", uses PostgreSQL.
 Otherwise, falls back to local SQLite file.
 """
 
+import io
+import atexit
 import json
 import os
+import queue
 import random
 import re
 import sqlite3
 import threading
-from datetime import datetime, date
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -30,22 +37,129 @@ USE_POSTGRES = DATABASE_URL.startswith("postgres")
 
 if USE_POSTGRES:
     import psycopg2
+    import psycopg2.extensions
     import psycopg2.extras
 
+try:
+    import fcntl
+except ImportError:  # Windows: the audit journal is then only locked within the process
+    fcntl = None
+
+# Connection pool sizing (both engines)
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN", "1"))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+POOL_PING_AFTER = 30.0      # re-validate connections idle longer than this (seconds)
+POOL_RECYCLE = 1800.0       # replace connections older than this (seconds)
+
+# Write-behind audit log (see AuditWriter); off by default
+AUDIT_ASYNC = os.environ.get("AUDIT_ASYNC", "").lower() in ("1", "true", "yes", "on")
+AUDIT_QUEUE_MAX = int(os.environ.get("AUDIT_QUEUE_MAX", "10000"))
+AUDIT_JOURNAL = Path(os.environ.get("AUDIT_JOURNAL", str(DATA_DIR / "audit_journal.jsonl")))
+SQLITE_STATEMENT_CACHE = 256   # prepared statements kept per SQLite connection
+SQL_TRANSLATION_CACHE_SIZE = 512   # translated PostgreSQL statements kept per process
+BATCH_PAGE_SIZE = 500   # rows per round-trip for executemany / insert_many on PostgreSQL
+
 # Thread-local storage for connections
 _local = threading.local()
 
 
+# ---------------------------------------------------------------------------
+# Result rows — one compact row type for both engines
+# ---------------------------------------------------------------------------
+
+class _Columns:
+    """Column names of one result set plus a name → position index, shared by all its rows."""
+
+    __slots__ = ("names", "index")
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+
+class Row:
+    """
+    Tuple-backed result row with O(1) access by position (row[0]) or by
+    column name (row["sku"]), plus the read-only dict methods app.py uses
+    (get, keys, items, values). Iterates over column names like a dict.
+    """
+
+    __slots__ = ("_cols", "_values")
+
+    def __init__(self, cols, values):
+        self._cols = cols
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return self._values[key]
+        return self._values[self._cols.index[key]]
+
+    def get(self, key, default=None):
+        i = self._cols.index.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return list(self._cols.names)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._cols.names, self._values))
+
+    def __contains__(self, key):
+        return key in self._cols.index
+
+    def __iter__(self):
+        return iter(self._cols.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._cols.names == other._cols.names and tuple(self._values) == tuple(other._values)
+        if isinstance(other, dict):
+            return self._asdict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"Row({self._asdict()!r})"
+
+    def _asdict(self):
+        return dict(zip(self._cols.names, self._values))
+
+
+# Column index of the most recent SQLite statement. sqlite3 keeps one
+# cursor.description object per execute(), so an identity check is enough
+# to reuse the index for every row of that statement.
+_sqlite_last_cols = (None, None)
+
+
+def _sqlite_row_factory(cursor, values):
+    """sqlite3 row_factory producing Row objects."""
+    global _sqlite_last_cols
+    desc = cursor.description
+    cached_desc, cols = _sqlite_last_cols
+    if cached_desc is not desc:
+        cols = _Columns(d[0] for d in desc)
+        _sqlite_last_cols = (desc, cols)
+    return Row(cols, values)
+
+
 # ---------------------------------------------------------------------------
 # PostgreSQL wrapper — makes psycopg2 behave like sqlite3 for app.py
 # ---------------------------------------------------------------------------
 
 class PgCursorWrapper:
-    """Wraps a psycopg2 RealDictCursor to behave like sqlite3.Cursor."""
+    """Wraps a psycopg2 tuple cursor to behave like sqlite3.Cursor, yielding Row objects."""
 
     def __init__(self, real_cursor):
         self._cur = real_cursor
         self._lastrowid = None
+        self._cols = None
 
     @property
     def lastrowid(self):
@@ -59,27 +173,40 @@ class PgCursorWrapper:
     def description(self):
         return self._cur.description
 
+    def _columns(self):
+        if self._cols is None:
+            self._cols = _Columns(d[0] for d in self._cur.description)
+        return self._cols
+
     def fetchone(self):
         row = self._cur.fetchone()
         if row is None:
             return None
-        return DictRow(row)
+        return Row(self._columns(), row)
 
     def fetchall(self):
         rows = self._cur.fetchall()
-        return [DictRow(r) for r in rows]
+        if not rows:
+            return []
+        cols = self._columns()
+        return [Row(cols, r) for r in rows]
+
+    def fetchmany(self, size):
+        rows = self._cur.fetchmany(size)
+        if not rows:
+            return []
+        cols = self._columns()
+        return [Row(cols, r) for r in rows]
 
     def __iter__(self):
         return iter(self.fetchall())
 
 
-class DictRow(dict):
-    """A dict that also supports integer index access like sqlite3.Row."""
-
-    def __getitem__(self, key):
-        if isinstance(key, int):
-            return list(self.values())[key]
-        return super().__getitem__(key)
+def _copy_value(v):
+    """Encode one value for COPY text format."""
+    if v is None:
+        return "\\N"
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
 
 
 class PgConnectionWrapper:
@@ -90,6 +217,8 @@ class PgConnectionWrapper:
 
     def __init__(self, real_conn):
         self._conn = real_conn
+        self._savepoints = 0
+        self._after_commit = []
 
     def _translate_sql(self, sql):
         """Convert SQLite SQL dialect to PostgreSQL."""
@@ -138,17 +267,47 @@ class PgConnectionWrapper:
     # Only tables where id is auto-generated — NOT inventory (sku PK), users (text PK), settings (key PK)
     _SERIAL_TABLES = {"suppliers", "customers", "sales", "sale_items", "inventory_log", "purchases", "purchase_orders", "purchase_order_items", "categories"}
 
-    def execute(self, sql, params=None):
-        """Execute SQL with automatic dialect translation."""
-        original_sql = sql
-
+    # Translation cache shared by all connections: original SQL → (translated, translated_returning_id).
+    # Statement shapes vary (IN lists of every chunk size, CASE lists in take_stock,
+    # keyset seek predicates), so the key space isn't small; the
+    # SQL_TRANSLATION_CACHE_SIZE LRU bound keeps it from growing without limit.
+    _translation_cache = OrderedDict()
+    _translation_lock = threading.Lock()
+    _translation_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _prepare(self, sql):
+        """
+        Return (translated_sql, returning_sql) for `sql`, memoized per statement text.
+        returning_sql is the same statement with RETURNING id for inserts into SERIAL
+        tables (so lastrowid works), else None.
+        """
+        cache = self._translation_cache
+        with self._translation_lock:
+            entry = cache.get(sql)
+            if entry is not None:
+                cache.move_to_end(sql)
+                self._translation_stats["hits"] += 1
+                return entry
+            self._translation_stats["misses"] += 1
+
+        entry = self._translate_full(sql)
+
+        with self._translation_lock:
+            cache[sql] = entry
+            if len(cache) > SQL_TRANSLATION_CACHE_SIZE:
+                cache.popitem(last=False)
+                self._translation_stats["evictions"] += 1
+        return entry
+
+    def _translate_full(self, sql):
+        """Uncached translation: dialect rewrite plus INSERT OR IGNORE / RETURNING id handling."""
         # Handle INSERT OR IGNORE specifically
         is_ignore = bool(re.search(r"INSERT\s+OR\s+IGNORE", sql, re.IGNORECASE))
 
         translated = self._translate_sql(sql)
         if translated is None:
             # PRAGMA or other no-op for PostgreSQL
-            return PgCursorWrapper(self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor))
+            return None, None
 
         sql = translated
 
@@ -156,19 +315,32 @@ class PgConnectionWrapper:
         if is_ignore and "ON CONFLICT" not in sql.upper():
             sql = sql.rstrip().rstrip(";") + " ON CONFLICT DO NOTHING"
 
-        # Handle RETURNING id for INSERT statements to support lastrowid
-        # Only add RETURNING id for tables with SERIAL id columns
-        needs_lastrowid = False
-        if sql.strip().upper().startswith("INSERT") and "RETURNING" not in sql.upper():
+        # Handle RETURNING id for INSERT ... VALUES statements to support lastrowid
+        # Only add RETURNING id for tables with SERIAL id columns; INSERT ... SELECT
+        # may touch thousands of rows and nobody reads lastrowid for those.
+        returning_sql = None
+        if sql.strip().upper().startswith("INSERT") and "RETURNING" not in sql.upper() \
+                and re.search(r"\bVALUES\b", sql, re.IGNORECASE):
             # Extract table name from INSERT INTO <table>
             table_match = re.search(r"INSERT\s+INTO\s+(\w+)", sql, re.IGNORECASE)
             table_name = table_match.group(1).lower() if table_match else ""
             if table_name in self._SERIAL_TABLES:
-                needs_lastrowid = True
-                sql = sql.rstrip().rstrip(";") + " RETURNING id"
+                returning_sql = sql.rstrip().rstrip(";") + " RETURNING id"
+
+        return sql, returning_sql
+
+    def execute(self, sql, params=None):
+        """Execute SQL with automatic dialect translation."""
+        sql, returning_sql = self._prepare(sql)
+        needs_lastrowid = returning_sql is not None
+        if needs_lastrowid:
+            sql = returning_sql
+        if sql is None:
+            # PRAGMA or other no-op for PostgreSQL
+            return PgCursorWrapper(self._conn.cursor())
 
         try:
-            cur = self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            cur = self._conn.cursor()
             if params:
                 cur.execute(sql, params)
             else:
@@ -180,19 +352,97 @@ class PgConnectionWrapper:
                 try:
                     row = cur.fetchone()
                     if row:
-                        wrapper._lastrowid = row.get("id")
+                        wrapper._lastrowid = row[0]
                 except Exception:
                     pass
 
             return wrapper
 
-        except Exception as e:
-            # Use savepoint rollback (not full transaction rollback) to preserve prior inserts
+        except Exception:
+            self._abort()
+            raise
+
+    def executemany(self, sql, seq_of_params, page_size=BATCH_PAGE_SIZE):
+        """Execute one statement for many parameter tuples in as few round-trips as possible."""
+        sql, _ = self._prepare(sql)
+        seq_of_params = list(seq_of_params)
+        cur = self._conn.cursor()
+        if sql is None or not seq_of_params:
+            return PgCursorWrapper(cur)
+        try:
+            psycopg2.extras.execute_batch(cur, sql, seq_of_params, page_size=page_size)
+        except Exception:
+            self._abort()
+            raise
+        return PgCursorWrapper(cur)
+
+    _VALUES_RE = re.compile(r"^(.*?\bVALUES\s*)(\((?:[^()]|\([^()]*\))*\))(.*)$", re.IGNORECASE | re.DOTALL)
+
+    def insert_many(self, sql, seq_of_params, returning_ids=False, page_size=BATCH_PAGE_SIZE):
+        """
+        Multi-row INSERT ... VALUES via execute_values (one statement per page).
+        With returning_ids=True, returns the new ids in input order. Conflict-ignoring
+        inserts only return ids for rows actually inserted, so don't combine the two.
+        """
+        translated, _ = self._prepare(sql)
+        m = self._VALUES_RE.match(translated)
+        if not m:
+            raise ValueError("insert_many() needs an INSERT ... VALUES (...) statement")
+        sql = m.group(1) + "%s" + m.group(3).rstrip().rstrip(";")
+        if returning_ids:
+            sql += " RETURNING id"
+        seq_of_params = list(seq_of_params)
+        if not seq_of_params:
+            return [] if returning_ids else None
+        cur = self._conn.cursor()
+        try:
+            rows = psycopg2.extras.execute_values(
+                cur, sql, seq_of_params, template=m.group(2),
+                page_size=page_size, fetch=returning_ids,
+            )
+        except Exception:
+            self._abort()
+            raise
+        if returning_ids:
+            return [r[0] for r in rows]
+        return None
+
+    def copy_rows(self, table, columns, rows):
+        """Bulk-load tuples into `table` with COPY ... FROM STDIN (text format). Returns the row count."""
+        buf = io.StringIO()
+        for row in rows:
+            buf.write("\t".join(_copy_value(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        cur = self._conn.cursor()
+        try:
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+        except Exception:
+            self._abort()
+            raise
+        return cur.rowcount
+
+    def iter_rows(self, sql, params=(), size=BATCH_PAGE_SIZE):
+        """
+        Yield the rows of a large SELECT through a server-side (named) cursor,
+        fetching `size` rows per round-trip so memory stays flat.
+        """
+        sql, _ = self._prepare(sql)
+        cur = self._conn.cursor(name=f"stream_{uuid.uuid4().hex[:12]}")
+        cur.itersize = size
+        try:
+            cur.execute(sql, params or None)
+            wrapped = PgCursorWrapper(cur)
+            while True:
+                rows = wrapped.fetchmany(size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
             try:
-                self._conn.rollback()
+                cur.close()
             except Exception:
                 pass
-            raise
 
     def executescript(self, sql):
         """Execute multiple SQL statements."""
@@ -200,17 +450,390 @@ class PgConnectionWrapper:
         cur.execute(sql)
         return cur
 
+    def _abort(self):
+        """After a failed statement: roll back, unless an open savepoint() will undo just its own work."""
+        if self._savepoints:
+            return
+        self._after_commit.clear()
+        try:
+            self._conn.rollback()
+        except Exception:
+            pass
+
+    def after_commit(self, fn):
+        """Call fn() once the current transaction commits; dropped if it rolls back."""
+        self._after_commit.append(fn)
+
+    @contextmanager
+    def savepoint(self):
+        """Run the block in a SAVEPOINT; if it raises, only the block's work is rolled back."""
+        name = f"sp_{self._savepoints}"
+        cur = self._conn.cursor()
+        cur.execute(f"SAVEPOINT {name}")
+        self._savepoints += 1
+        pending = len(self._after_commit)
+        try:
+            yield
+            cur.execute(f"RELEASE SAVEPOINT {name}")
+        except BaseException:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            del self._after_commit[pending:]
+            raise
+        finally:
+            self._savepoints -= 1
+
     def commit(self):
         self._conn.commit()
+        _run_after_commit(self)
 
     def rollback(self):
+        self._after_commit.clear()
         self._conn.rollback()
 
     def close(self):
         self._conn.close()
 
     def cursor(self):
-        return PgCursorWrapper(self._conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor))
+        return PgCursorWrapper(self._conn.cursor())
+
+
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+
+class ConnectionPool:
+    """
+    Thread-safe pool of reusable database connections.
+
+    connect()     → opens a new connection
+    ping(conn)    → True if an idle connection is still usable
+    reset(conn)   → clears transaction state on return; False means discard
+    """
+
+    def __init__(self, connect, ping, reset, min_size=1, max_size=10,
+                 timeout=30.0, ping_after=30.0, recycle=1800.0):
+        self._connect = connect
+        self._ping = ping
+        self._reset = reset
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.recycle = recycle
+
+        self._cond = threading.Condition()
+        self._idle = deque()      # (conn, created_at, last_used) — LIFO
+        self._in_use = {}         # id(conn) -> created_at
+        self._size = 0            # idle + in use + being opened
+        self._stats = {"checkouts": 0, "created": 0, "discarded": 0,
+                       "waits": 0, "wait_time": 0.0, "timeouts": 0}
+
+        for _ in range(self.min_size):
+            self._size += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                print(f"[DB] Pool warm-up failed: {e}")
+                break
+            self._idle.append((conn, time.monotonic(), time.monotonic()))
+
+    def _open(self):
+        """Open a connection for a slot already counted in _size."""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def checkout(self):
+        """Borrow a connection, waiting up to `timeout` seconds if the pool is exhausted."""
+        deadline = None
+        while True:
+            entry = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    now = time.monotonic()
+                    if deadline is None:
+                        deadline = now + self.timeout
+                        self._stats["waits"] += 1
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        self._stats["wait_time"] += self.timeout
+                        raise RuntimeError(
+                            f"Database pool exhausted: no connection available within {self.timeout:g}s"
+                        )
+                    self._cond.wait(remaining)
+                if deadline is not None:
+                    self._stats["wait_time"] += time.monotonic() - (deadline - self.timeout)
+                    deadline = None
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if entry is None:
+                conn = self._open()
+                created = time.monotonic()
+            else:
+                conn, created, last_used = entry
+                now = time.monotonic()
+                if now - created > self.recycle:
+                    self._discard(conn)
+                    continue
+                if now - last_used > self.ping_after and not self._ping(conn):
+                    self._discard(conn)
+                    continue
+
+            with self._cond:
+                self._in_use[id(conn)] = created
+                self._stats["checkouts"] += 1
+            return conn
+
+    def checkin(self, conn):
+        """Return a borrowed connection; it is reset or discarded if broken."""
+        with self._cond:
+            created = self._in_use.pop(id(conn), None)
+        if created is None:
+            # Not ours (e.g. opened before a fork) — just close it
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        try:
+            healthy = self._reset(conn)
+        except Exception:
+            healthy = False
+        if not healthy:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        """Snapshot of pool usage for monitoring."""
+        with self._cond:
+            s = dict(self._stats)
+            s.update({
+                "size": self._size,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            })
+        s["wait_time_ms"] = round(s.pop("wait_time") * 1000, 1)
+        return s
+
+
+def _pg_connect():
+    url = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    raw_conn = psycopg2.connect(url)
+    raw_conn.autocommit = False
+    return PgConnectionWrapper(raw_conn)
+
+
+def _pg_ping(conn):
+    """Round-trip a trivial query to detect connections dropped by the server."""
+    raw = conn._conn
+    if raw.closed:
+        return False
+    try:
+        cur = raw.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        raw.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _pg_reset(conn):
+    """Roll back any transaction left open by the previous borrower."""
+    raw = conn._conn
+    conn._after_commit.clear()
+    if raw.closed:
+        return False
+    if raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        raw.rollback()
+    return raw.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class SqliteConnection(sqlite3.Connection):
+    """sqlite3 connection with the batch helpers PgConnectionWrapper also provides."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after_commit = []
+
+    def after_commit(self, fn):
+        """Call fn() once the current transaction commits; dropped if it rolls back."""
+        self._after_commit.append(fn)
+
+    def commit(self):
+        super().commit()
+        _run_after_commit(self)
+
+    def rollback(self):
+        self._after_commit.clear()
+        super().rollback()
+
+    def insert_many(self, sql, seq_of_params, returning_ids=False):
+        """
+        Insert many rows. With returning_ids=True, returns the new ids in input order
+        (rows are inserted one by one, which is cheap in-process).
+        """
+        if not returning_ids:
+            self.executemany(sql, seq_of_params)
+            return None
+        ids = []
+        for params in seq_of_params:
+            ids.append(self.execute(sql, params).lastrowid)
+        return ids
+
+    def copy_rows(self, table, columns, rows):
+        """Bulk-load tuples into `table` (executemany; same API as the PostgreSQL COPY path)."""
+        rows = list(rows)
+        self.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+        )
+        return len(rows)
+
+    def iter_rows(self, sql, params=(), size=BATCH_PAGE_SIZE):
+        """Yield the rows of a large SELECT `size` rows at a time (same API as the PostgreSQL wrapper)."""
+        cur = self.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            yield from rows
+
+    _savepoints = 0
+
+    @contextmanager
+    def savepoint(self):
+        """Run the block in a SAVEPOINT; if it raises, only the block's work is rolled back."""
+        # A SAVEPOINT outside a transaction would start one that its RELEASE commits
+        if not self.in_transaction:
+            self.execute("BEGIN")
+        name = f"sp_{self._savepoints}"
+        self.execute(f"SAVEPOINT {name}")
+        self._savepoints += 1
+        pending = len(self._after_commit)
+        try:
+            yield
+            self.execute(f"RELEASE SAVEPOINT {name}")
+        except BaseException:
+            self.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            del self._after_commit[pending:]
+            raise
+        finally:
+            self._savepoints -= 1
+
+
+def _run_after_commit(conn):
+    callbacks, conn._after_commit = conn._after_commit, []
+    for fn in callbacks:
+        try:
+            fn()
+        except Exception as e:
+            print(f"  [WARN] after-commit callback failed: {e}")
+
+
+def _sqlite_connect():
+    """Open a SQLite connection with PRAGMAs applied once for its lifetime."""
+    DATA_DIR.mkdir(exist_ok=True)
+    # check_same_thread=False: pooled connections move between request threads,
+    # but only ever one borrower at a time.
+    conn = sqlite3.connect(str(DB_PATH), timeout=10, check_same_thread=False,
+                           cached_statements=SQLITE_STATEMENT_CACHE, factory=SqliteConnection)
+    conn.row_factory = _sqlite_row_factory
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _sqlite_ping(conn):
+    try:
+        conn.execute("SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+def _sqlite_reset(conn):
+    """Hand the next borrower a connection with no open transaction."""
+    if conn.in_transaction:
+        conn.rollback()
+    conn._after_commit.clear()
+    conn.row_factory = _sqlite_row_factory
+    return True
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Return this process's pool, creating it on first use (and after a fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                # Connections inherited across a fork share sockets with the parent — abandon them
+                _local.conn = None
+                if USE_POSTGRES:
+                    _pool = ConnectionPool(
+                        _pg_connect, _pg_ping, _pg_reset,
+                        min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                        ping_after=POOL_PING_AFTER, recycle=POOL_RECYCLE,
+                    )
+                else:
+                    # Local file: nothing goes stale, so never ping or recycle
+                    _pool = ConnectionPool(
+                        _sqlite_connect, _sqlite_ping, _sqlite_reset,
+                        min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                        ping_after=float("inf"), recycle=float("inf"),
+                    )
+                _pool_pid = pid
+    return _pool
+
+
+def sql_translation_stats():
+    """Hit/miss counters for the PostgreSQL dialect translation cache (None on SQLite)."""
+    if not USE_POSTGRES:
+        return None
+    with PgConnectionWrapper._translation_lock:
+        stats = dict(PgConnectionWrapper._translation_stats)
+        stats["size"] = len(PgConnectionWrapper._translation_cache)
+    stats["max_size"] = SQL_TRANSLATION_CACHE_SIZE
+    return stats
+
+
+def pool_stats():
+    """Connection pool statistics (None until the pool is first used)."""
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.stats()
 
 
 # ---------------------------------------------------------------------------
@@ -218,44 +841,50 @@ class PgConnectionWrapper:
 # ---------------------------------------------------------------------------
 
 def get_db():
-    """Get a thread-local database connection."""
-    if not hasattr(_local, "conn") or _local.conn is None:
-        if USE_POSTGRES:
-            url = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-            raw_conn = psycopg2.connect(url)
-            raw_conn.autocommit = False
-            _local.conn = PgConnectionWrapper(raw_conn)
-        else:
-            DATA_DIR.mkdir(exist_ok=True)
-            _local.conn = sqlite3.connect(str(DB_PATH), timeout=10)
-            _local.conn.row_factory = sqlite3.Row
-            _local.conn.execute("PRAGMA journal_mode=WAL")
-            _local.conn.execute("PRAGMA foreign_keys=ON")
-            _local.conn.execute("PRAGMA busy_timeout=5000")
+    """Get the pooled database connection bound to the current thread."""
+    pool = _get_pool()
+    if getattr(_local, "conn", None) is None:
+        _local.conn = pool.checkout()
     return _local.conn
 
 
 def close_db():
-    """Close the thread-local connection."""
+    """Release the thread's connection back to the pool."""
     conn = getattr(_local, "conn", None)
     if conn is not None:
-        try:
-            conn.close()
-        except Exception:
-            pass
         _local.conn = None
+        _get_pool().checkin(conn)
+
+
+def load_children(conn, table, fk, parent_ids, columns="c.*", joins="", chunk_size=BATCH_PAGE_SIZE):
+    """
+    Load child rows for many parents with one IN query per chunk; returns {parent_id: [dict, ...]}.
+    The child table is aliased `c`; `columns` and `joins` can add columns from other tables.
+    """
+    children = {pid: [] for pid in parent_ids}
+    ids = list(children)
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT {columns} FROM {table} c {joins} WHERE c.{fk} IN ({placeholders}) ORDER BY c.{fk}, c.id",
+            chunk
+        ).fetchall()
+        for r in rows:
+            children[r[fk]].append(r._asdict())
+    return children
 
 
 def row_to_dict(row):
     """Convert a database row to a plain dict."""
     if row is None:
         return None
-    return dict(row)
+    return row._asdict()
 
 
 def rows_to_list(rows):
-    """Convert a list of database rows to a list of dicts."""
-    return [dict(r) for r in rows]
+    """Convert a list of database rows to a list of dicts (one dict per row, no intermediate copies)."""
+    return [r._asdict() for r in rows]
 
 
 # ---------------------------------------------------------------------------
@@ -434,16 +1063,97 @@ CREATE TABLE IF NOT EXISTS categories (
     last_updated TEXT NOT NULL
 );
 
+CREATE TABLE IF NOT EXISTS customer_stats (
+    phone TEXT PRIMARY KEY,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    total_spent REAL NOT NULL DEFAULT 0,
+    last_purchase TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS supplier_products (
+    supplier_id INTEGER NOT NULL,
+    sku TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (supplier_id, sku, source)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+    date TEXT NOT NULL,
+    payment_method TEXT NOT NULL DEFAULT '',
+    sale_count INTEGER NOT NULL DEFAULT 0,
+    total REAL NOT NULL DEFAULT 0,
+    void_count INTEGER NOT NULL DEFAULT 0,
+    void_total REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, payment_method)
+);
+
+CREATE TABLE IF NOT EXISTS product_daily_rollup (
+    date TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    name TEXT NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, sku, name)
+);
+
+CREATE TABLE IF NOT EXISTS code_reservations (
+    kind TEXT NOT NULL,
+    code TEXT NOT NULL,
+    batch TEXT NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (kind, code)
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    response TEXT NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+
+CREATE TABLE IF NOT EXISTS import_sessions (
+    id TEXT PRIMARY KEY,
+    token_hash TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    bootstrap INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL,
+    last_updated TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS import_chunks (
+    session_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    chunk_offset INTEGER NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    inserted INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL,
+    PRIMARY KEY (session_id, table_name, chunk_offset)
+);
+
 CREATE INDEX IF NOT EXISTS idx_sales_date ON sales(date);
 CREATE INDEX IF NOT EXISTS idx_sales_receipt ON sales(receipt_number);
 CREATE INDEX IF NOT EXISTS idx_sale_items_sale_id ON sale_items(sale_id);
+CREATE INDEX IF NOT EXISTS idx_sale_items_sku ON sale_items(sku);
+CREATE INDEX IF NOT EXISTS idx_code_reservations_batch ON code_reservations(batch);
+CREATE INDEX IF NOT EXISTS idx_code_reservations_created ON code_reservations(created);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created);
+CREATE INDEX IF NOT EXISTS idx_product_daily_rollup_sku ON product_daily_rollup(sku, date);
 CREATE INDEX IF NOT EXISTS idx_inventory_category ON inventory(category);
 CREATE INDEX IF NOT EXISTS idx_inventory_quantity ON inventory(quantity);
 CREATE INDEX IF NOT EXISTS idx_inventory_log_sku ON inventory_log(sku);
 CREATE INDEX IF NOT EXISTS idx_purchases_sku ON purchases(sku);
 CREATE INDEX IF NOT EXISTS idx_po_supplier ON purchase_orders(supplier_id);
 CREATE INDEX IF NOT EXISTS idx_po_status ON purchase_orders(status);
+CREATE INDEX IF NOT EXISTS idx_po_created_id ON purchase_orders(created, id);
 CREATE INDEX IF NOT EXISTS idx_poi_order ON purchase_order_items(order_id);
+CREATE INDEX IF NOT EXISTS idx_sales_customer_phone ON sales(customer_phone);
+CREATE INDEX IF NOT EXISTS idx_supplier_products_sku ON supplier_products(sku);
+CREATE INDEX IF NOT EXISTS idx_sales_timestamp_id ON sales(timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_name_sku ON inventory(name, sku);
+CREATE INDEX IF NOT EXISTS idx_customers_name_id ON customers(name, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_log_sku_created ON inventory_log(sku, created, id);
 """
 
 PG_SCHEMA = """
@@ -617,16 +1327,97 @@ CREATE TABLE IF NOT EXISTS categories (
     last_updated TEXT NOT NULL
 );
 
+CREATE TABLE IF NOT EXISTS customer_stats (
+    phone TEXT PRIMARY KEY,
+    order_count INTEGER NOT NULL DEFAULT 0,
+    total_spent DOUBLE PRECISION NOT NULL DEFAULT 0,
+    last_purchase TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS supplier_products (
+    supplier_id INTEGER NOT NULL,
+    sku TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (supplier_id, sku, source)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+    date TEXT NOT NULL,
+    payment_method TEXT NOT NULL DEFAULT '',
+    sale_count INTEGER NOT NULL DEFAULT 0,
+    total DOUBLE PRECISION NOT NULL DEFAULT 0,
+    void_count INTEGER NOT NULL DEFAULT 0,
+    void_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, payment_method)
+);
+
+CREATE TABLE IF NOT EXISTS product_daily_rollup (
+    date TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    name TEXT NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, sku, name)
+);
+
+CREATE TABLE IF NOT EXISTS code_reservations (
+    kind TEXT NOT NULL,
+    code TEXT NOT NULL,
+    batch TEXT NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (kind, code)
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    response TEXT NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+
+CREATE TABLE IF NOT EXISTS import_sessions (
+    id TEXT PRIMARY KEY,
+    token_hash TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    bootstrap INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL,
+    last_updated TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS import_chunks (
+    session_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    chunk_offset INTEGER NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    inserted INTEGER NOT NULL DEFAULT 0,
+    created TEXT NOT NULL,
+    PRIMARY KEY (session_id, table_name, chunk_offset)
+);
+
 CREATE INDEX IF NOT EXISTS idx_sales_date ON sales(date);
 CREATE INDEX IF NOT EXISTS idx_sales_receipt ON sales(receipt_number);
 CREATE INDEX IF NOT EXISTS idx_sale_items_sale_id ON sale_items(sale_id);
+CREATE INDEX IF NOT EXISTS idx_sale_items_sku ON sale_items(sku);
+CREATE INDEX IF NOT EXISTS idx_code_reservations_batch ON code_reservations(batch);
+CREATE INDEX IF NOT EXISTS idx_code_reservations_created ON code_reservations(created);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created);
+CREATE INDEX IF NOT EXISTS idx_product_daily_rollup_sku ON product_daily_rollup(sku, date);
 CREATE INDEX IF NOT EXISTS idx_inventory_category ON inventory(category);
 CREATE INDEX IF NOT EXISTS idx_inventory_quantity ON inventory(quantity);
 CREATE INDEX IF NOT EXISTS idx_inventory_log_sku ON inventory_log(sku);
 CREATE INDEX IF NOT EXISTS idx_purchases_sku ON purchases(sku);
 CREATE INDEX IF NOT EXISTS idx_po_supplier ON purchase_orders(supplier_id);
 CREATE INDEX IF NOT EXISTS idx_po_status ON purchase_orders(status);
+CREATE INDEX IF NOT EXISTS idx_po_created_id ON purchase_orders(created, id);
 CREATE INDEX IF NOT EXISTS idx_poi_order ON purchase_order_items(order_id);
+CREATE INDEX IF NOT EXISTS idx_sales_customer_phone ON sales(customer_phone);
+CREATE INDEX IF NOT EXISTS idx_supplier_products_sku ON supplier_products(sku);
+CREATE INDEX IF NOT EXISTS idx_sales_timestamp_id ON sales(timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_name_sku ON inventory(name, sku);
+CREATE INDEX IF NOT EXISTS idx_customers_name_id ON customers(name, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_log_sku_created ON inventory_log(sku, created, id);
 """
 
 
@@ -643,15 +1434,21 @@ def init_db():
         cur.execute(PG_SCHEMA)
         conn._conn.commit()
         _run_pg_migrations(conn)
+        _init_pg_search(conn)
         engine = "PostgreSQL"
         db_loc = DATABASE_URL.split("@")[-1].split("/")[0] if "@" in DATABASE_URL else "cloud"
     else:
         conn.executescript(SQLITE_SCHEMA)
         conn.commit()
         _run_sqlite_migrations(conn)
+        _init_sqlite_search(conn)
         engine = "SQLite"
         db_loc = str(DB_PATH)
 
+    _backfill_derived_tables(conn)
+    purge_idempotency_keys(conn)
+    purge_code_reservations(conn)
+
     print(f"[DB] Engine: {engine} | {db_loc}")
 
 
@@ -743,29 +1540,20 @@ def _run_sqlite_migrations(conn):
         conn.execute("ALTER TABLE sales ADD COLUMN sgst_amount REAL DEFAULT 0")
         print("[DB] Migration: added column sales.sgst_amount")
 
-    # Collect all existing barcodes to avoid duplicates
-    existing_barcodes = {r[0] for r in conn.execute(
-        "SELECT barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != ''"
-    ).fetchall()}
-
-    def _gen_random_barcode(used):
-        """Generate a unique random 6-digit barcode."""
-        while True:
-            code = str(random.randint(100000, 999999))
-            if code not in used:
-                used.add(code)
-                return code
+    # Migration: add bootstrap flag to import_sessions
+    is_cols = {row[1] for row in conn.execute("PRAGMA table_info(import_sessions)").fetchall()}
+    if 'bootstrap' not in is_cols:
+        conn.execute("ALTER TABLE import_sessions ADD COLUMN bootstrap INTEGER NOT NULL DEFAULT 0")
+        print("[DB] Migration: added column import_sessions.bootstrap")
 
     # Re-randomize barcodes that aren't 6 digits (from old migrations)
     sequential_rows = conn.execute(
         "SELECT sku, barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != '' AND LENGTH(barcode) != 6"
     ).fetchall()
     if sequential_rows:
-        for row in sequential_rows:
-            old_bc = row[1]
-            new_bc = _gen_random_barcode(existing_barcodes)
-            conn.execute("UPDATE inventory SET barcode = ? WHERE sku = ?", (new_bc, row[0]))
-            existing_barcodes.discard(old_bc)
+        new_codes = allocate_codes(conn, "barcode", len(sequential_rows))
+        conn.executemany("UPDATE inventory SET barcode = ? WHERE sku = ?",
+                         [(bc, row[0]) for bc, row in zip(new_codes, sequential_rows)])
         print(f"[DB] Migration: re-randomized {len(sequential_rows)} sequential barcodes")
 
     # Auto-generate random 6-digit barcodes for products that don't have one
@@ -773,9 +1561,9 @@ def _run_sqlite_migrations(conn):
         "SELECT sku FROM inventory WHERE barcode IS NULL OR barcode = '' ORDER BY date_added, sku"
     ).fetchall()
     if empty_barcode_rows:
-        for row in empty_barcode_rows:
-            new_bc = _gen_random_barcode(existing_barcodes)
-            conn.execute("UPDATE inventory SET barcode = ? WHERE sku = ?", (new_bc, row[0]))
+        new_codes = allocate_codes(conn, "barcode", len(empty_barcode_rows))
+        conn.executemany("UPDATE inventory SET barcode = ? WHERE sku = ?",
+                         [(bc, row[0]) for bc, row in zip(new_codes, empty_barcode_rows)])
         print(f"[DB] Migration: auto-generated barcodes for {len(empty_barcode_rows)} products")
 
     # Create unique index on barcode (ignore if exists)
@@ -796,18 +1584,11 @@ def _run_sqlite_migrations(conn):
         # Temporarily disable FK constraints for the migration
         if not USE_POSTGRES:
             conn.execute("PRAGMA foreign_keys = OFF")
-        used_skus = {r[0] for r in conn.execute(
-            "SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''"
-        ).fetchall()}
-        for row in old_sku_rows:
+        new_skus = allocate_codes(conn, "sku", len(old_sku_rows))
+        for row, new_sku in zip(old_sku_rows, new_skus):
             old_sku = row[0]
-            while True:
-                new_sku = str(random.randint(100000, 999999))
-                if new_sku not in used_skus:
-                    break
-            used_skus.add(new_sku)
             # Update all referencing tables first, then the parent
-            for tbl in ("sale_items", "inventory_log", "purchase_order_items"):
+            for tbl in ("sale_items", "inventory_log", "purchase_order_items", "supplier_products"):
                 try:
                     conn.execute(f"UPDATE {tbl} SET sku = ? WHERE sku = ?", (new_sku, old_sku))
                 except Exception:
@@ -936,34 +1717,28 @@ def _run_pg_migrations(conn):
         conn._conn.commit()
         print("[DB] PG Migration: added column sales.sgst_amount")
 
-    # Collect existing barcodes to avoid duplicates
-    cur.execute("SELECT barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != ''")
-    existing_barcodes = {r[0] for r in cur.fetchall()}
-
-    def _gen_random_barcode(used):
-        while True:
-            code = str(random.randint(100000, 999999))
-            if code not in used:
-                used.add(code)
-                return code
+    # Migration: add bootstrap flag to import_sessions
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'import_sessions' AND column_name = 'bootstrap'")
+    if not cur.fetchone():
+        cur.execute("ALTER TABLE import_sessions ADD COLUMN bootstrap INTEGER NOT NULL DEFAULT 0")
+        conn._conn.commit()
+        print("[DB] PG Migration: added column import_sessions.bootstrap")
 
     # Re-randomize barcodes that aren't 6 digits (from old migrations)
     cur.execute("SELECT sku, barcode FROM inventory WHERE barcode IS NOT NULL AND barcode != '' AND LENGTH(barcode) != 6")
     sequential_rows = cur.fetchall()
     if sequential_rows:
-        for row in sequential_rows:
-            old_bc = row[1]
-            new_bc = _gen_random_barcode(existing_barcodes)
+        new_codes = allocate_codes(conn, "barcode", len(sequential_rows))
+        for new_bc, row in zip(new_codes, sequential_rows):
             cur.execute("UPDATE inventory SET barcode = %s WHERE sku = %s", (new_bc, row[0]))
-            existing_barcodes.discard(old_bc)
         print(f"[DB] PG Migration: re-randomized {len(sequential_rows)} barcodes")
 
     # Auto-generate random 6-digit barcodes for products that don't have one
     cur.execute("SELECT sku FROM inventory WHERE barcode IS NULL OR barcode = '' ORDER BY date_added, sku")
     empty_rows = cur.fetchall()
     if empty_rows:
-        for row in empty_rows:
-            new_bc = _gen_random_barcode(existing_barcodes)
+        new_codes = allocate_codes(conn, "barcode", len(empty_rows))
+        for new_bc, row in zip(new_codes, empty_rows):
             cur.execute("UPDATE inventory SET barcode = %s WHERE sku = %s", (new_bc, row[0]))
         print(f"[DB] PG Migration: auto-generated barcodes for {len(empty_rows)} products")
 
@@ -1003,7 +1778,7 @@ def _run_pg_migrations(conn):
     if old_sku_rows:
         # Temporarily disable FK triggers so we can update parent + child tables
         # Use savepoints so a missing table doesn't abort the transaction
-        child_tables = ("inventory_log", "sale_items", "purchase_order_items")
+        child_tables = ("inventory_log", "sale_items", "purchase_order_items", "supplier_products")
         for tbl in child_tables + ("inventory",):
             cur.execute(f"SAVEPOINT sp_{tbl}")
             try:
@@ -1011,15 +1786,9 @@ def _run_pg_migrations(conn):
             except Exception:
                 cur.execute(f"ROLLBACK TO SAVEPOINT sp_{tbl}")
 
-        cur.execute("SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''")
-        used_skus = {r[0] for r in cur.fetchall()}
-        for row in old_sku_rows:
+        new_skus = allocate_codes(conn, "sku", len(old_sku_rows))
+        for row, new_sku in zip(old_sku_rows, new_skus):
             old_sku = row[0]
-            while True:
-                new_sku = str(random.randint(100000, 999999))
-                if new_sku not in used_skus:
-                    break
-            used_skus.add(new_sku)
             # Update all tables that reference this SKU
             for tbl in child_tables:
                 cur.execute(f"SAVEPOINT sp_upd_{tbl}")
@@ -1060,6 +1829,416 @@ def _run_pg_migrations(conn):
         print(f"[DB] PG Migration: seeded {len(all_cats)} categories")
 
 
+# ---------------------------------------------------------------------------
+# Code allocation (auto-generated SKUs and barcodes)
+# ---------------------------------------------------------------------------
+# Auto-generated SKUs and barcodes are random 6-digit numbers. Candidates are
+# checked against inventory through its indexes and claimed by inserting them
+# into code_reservations, whose primary key makes a code impossible to hand
+# out twice (even across workers). Each call tags its rows with a batch id and
+# reads back exactly the codes it won, retrying with fresh candidates for any
+# that were taken. Reservations are part of the caller's transaction.
+# Once that transaction commits, the inventory row guards the code, so
+# reservations are pruned after CODE_RESERVATION_TTL_MINUTES. The window only
+# has to outlast a transaction that checked inventory before the code was committed.
+
+_CODE_COLUMNS = {"sku": "sku", "barcode": "barcode"}  # kind -> inventory column
+_CODE_ATTEMPTS = 20
+CODE_RESERVATION_TTL_MINUTES = 60
+CODE_RESERVATION_PURGE_INTERVAL = 3600
+_reservations_last_purge = 0.0
+
+
+def allocate_codes(conn, kind, count, exclude=()):
+    """Reserve `count` unused 6-digit codes of `kind` ("sku" or "barcode"); no commit.
+    `exclude` holds codes that must not be returned (e.g. ones already in an import file).
+    """
+    column = _CODE_COLUMNS[kind]
+    exclude = set(exclude)
+    batch = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    won = []
+    for _ in range(_CODE_ATTEMPTS):
+        need = count - len(won)
+        if need <= 0:
+            break
+        candidates = list({str(random.randint(100000, 999999)) for _ in range(need + need // 4 + 1)}
+                          - exclude - set(won))
+        for i in range(0, len(candidates), BATCH_PAGE_SIZE):
+            chunk = candidates[i:i + BATCH_PAGE_SIZE]
+            taken = {r[0] for r in conn.execute(
+                f"SELECT {column} FROM inventory WHERE {column} IN ({_in_clause(chunk)})", chunk
+            ).fetchall()}
+            free = [c for c in chunk if c not in taken][:count - len(won)]
+            conn.executemany(
+                "INSERT OR IGNORE INTO code_reservations (kind, code, batch, created) VALUES (?,?,?,?)",
+                [(kind, c, batch, now) for c in free]
+            )
+            won = [r[0] for r in conn.execute(
+                "SELECT code FROM code_reservations WHERE batch = ?", (batch,)
+            ).fetchall()]
+            if len(won) >= count:
+                break
+    if len(won) < count:
+        raise RuntimeError(f"Could not allocate {count} unique {kind} codes")
+    if time.monotonic() - _reservations_last_purge >= CODE_RESERVATION_PURGE_INTERVAL:
+        conn.after_commit(lambda: _maybe_purge_code_reservations(conn))
+    return won
+
+
+def allocate_code(conn, kind):
+    """Reserve one unused 6-digit code of `kind`; no commit."""
+    return allocate_codes(conn, kind, 1)[0]
+
+
+def purge_code_reservations(conn):
+    """Delete reservations older than CODE_RESERVATION_TTL_MINUTES and commit. Returns how many were removed."""
+    global _reservations_last_purge
+    _reservations_last_purge = time.monotonic()
+    cutoff = (datetime.now() - timedelta(minutes=CODE_RESERVATION_TTL_MINUTES)).isoformat()
+    removed = conn.execute("DELETE FROM code_reservations WHERE created < ?", (cutoff,)).rowcount
+    conn.commit()
+    if removed:
+        print(f"[DB] Pruned {removed} old code reservations")
+    return removed
+
+
+def _maybe_purge_code_reservations(conn):
+    """Prune in its own transaction, at most once per CODE_RESERVATION_PURGE_INTERVAL per worker."""
+    if time.monotonic() - _reservations_last_purge >= CODE_RESERVATION_PURGE_INTERVAL:
+        purge_code_reservations(conn)
+
+
+# ---------------------------------------------------------------------------
+# Product search
+# ---------------------------------------------------------------------------
+# SQLite: FTS5 table inventory_fts indexes the searchable inventory columns as
+# external content keyed by inventory's rowid, kept in sync by triggers.
+# PostgreSQL: GIN index over a weighted tsvector of the same columns. Both
+# match every word of the query as a prefix and rank by relevance. When the
+# index finds nothing (or is unavailable) the substring LIKE search runs, so
+# mid-word matches such as part of a SKU still work.
+
+SEARCH_MAX_RESULTS = 50
+_fts_available = False
+
+SQLITE_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS inventory_fts USING fts5(
+    name, sku, brand, description, barcode, hsn_code,
+    content='inventory', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS inventory_fts_ai AFTER INSERT ON inventory BEGIN
+    INSERT INTO inventory_fts (rowid, name, sku, brand, description, barcode, hsn_code)
+    VALUES (new.rowid, new.name, new.sku, new.brand, new.description, new.barcode, new.hsn_code);
+END;
+
+CREATE TRIGGER IF NOT EXISTS inventory_fts_ad AFTER DELETE ON inventory BEGIN
+    INSERT INTO inventory_fts (inventory_fts, rowid, name, sku, brand, description, barcode, hsn_code)
+    VALUES ('delete', old.rowid, old.name, old.sku, old.brand, old.description, old.barcode, old.hsn_code);
+END;
+
+CREATE TRIGGER IF NOT EXISTS inventory_fts_au AFTER UPDATE OF name, sku, brand, description, barcode, hsn_code
+ON inventory BEGIN
+    INSERT INTO inventory_fts (inventory_fts, rowid, name, sku, brand, description, barcode, hsn_code)
+    VALUES ('delete', old.rowid, old.name, old.sku, old.brand, old.description, old.barcode, old.hsn_code);
+    INSERT INTO inventory_fts (rowid, name, sku, brand, description, barcode, hsn_code)
+    VALUES (new.rowid, new.name, new.sku, new.brand, new.description, new.barcode, new.hsn_code);
+END;
+"""
+
+# Must match the idx_inventory_search expression exactly for the index to be used
+_PG_SEARCH_VECTOR = (
+    "(setweight(to_tsvector('simple', COALESCE({p}name, '')), 'A') || "
+    "setweight(to_tsvector('simple', COALESCE({p}sku, '') || ' ' || COALESCE({p}barcode, '')), 'A') || "
+    "setweight(to_tsvector('simple', COALESCE({p}brand, '') || ' ' || COALESCE({p}hsn_code, '')), 'B') || "
+    "setweight(to_tsvector('simple', COALESCE({p}description, '')), 'D'))"
+)
+
+# bm25 column weights: name, sku, brand, description, barcode, hsn_code
+_FTS_RANK = "bm25(inventory_fts, 10.0, 8.0, 4.0, 1.0, 8.0, 2.0)"
+
+
+def _init_sqlite_search(conn):
+    """Create the FTS5 index and triggers; rebuild the index if it is new or out of sync."""
+    global _fts_available
+    try:
+        conn.executescript(SQLITE_SEARCH_SCHEMA)
+    except sqlite3.OperationalError as e:
+        print(f"[DB] Search: FTS5 unavailable ({e}), using LIKE search")
+        _fts_available = False
+        return
+    try:
+        # Implicit rowids can change (e.g. VACUUM), so verify against inventory on startup
+        conn.execute("INSERT INTO inventory_fts (inventory_fts, rank) VALUES ('integrity-check', 1)")
+    except sqlite3.DatabaseError:
+        conn.execute("INSERT INTO inventory_fts (inventory_fts) VALUES ('rebuild')")
+        print("[DB] Search: rebuilt inventory_fts index")
+    conn.commit()
+    _fts_available = True
+
+
+def _init_pg_search(conn):
+    """Create the GIN index behind search_inventory()."""
+    global _fts_available
+    cur = conn._conn.cursor()
+    try:
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_inventory_search ON inventory USING GIN ("
+            + _PG_SEARCH_VECTOR.format(p="") + ")"
+        )
+        conn._conn.commit()
+        _fts_available = True
+    except Exception as e:
+        conn._conn.rollback()
+        print(f"[DB] Search: could not create search index ({e}), using LIKE search")
+        _fts_available = False
+
+
+def _like_search(conn, q, where, params, limit):
+    like = f"%{q.lower()}%"
+    return conn.execute(
+        "SELECT i.* FROM inventory i WHERE (LOWER(i.name) LIKE ? OR LOWER(i.sku) LIKE ? OR LOWER(i.brand) LIKE ? "
+        "OR LOWER(i.description) LIKE ? OR LOWER(i.barcode) LIKE ? OR LOWER(i.hsn_code) LIKE ?)"
+        f"{where} ORDER BY i.name, i.sku LIMIT ?",
+        [like] * 6 + list(params) + [limit]
+    ).fetchall()
+
+
+def search_inventory(conn, q, where="", params=(), limit=SEARCH_MAX_RESULTS):
+    """
+    Products matching every word of `q` as a prefix, best match first, at most
+    `limit` rows. `where` is extra " AND ..." SQL on alias i with `params`.
+    """
+    terms = re.findall(r"\w+", q.lower())
+    rows = []
+    if terms and _fts_available:
+        if USE_POSTGRES:
+            tsquery = " & ".join(f"{t}:*" for t in terms)
+            vector = _PG_SEARCH_VECTOR.format(p="i.")
+            rows = conn.execute(
+                f"SELECT i.* FROM inventory i WHERE {vector} @@ to_tsquery('simple', ?){where} "
+                f"ORDER BY ts_rank({vector}, to_tsquery('simple', ?)) DESC, i.name, i.sku LIMIT ?",
+                [tsquery] + list(params) + [tsquery, limit]
+            ).fetchall()
+        else:
+            match = " ".join(f'"{t}"*' for t in terms)
+            rows = conn.execute(
+                "SELECT i.* FROM inventory_fts JOIN inventory i ON i.rowid = inventory_fts.rowid "
+                f"WHERE inventory_fts MATCH ?{where} ORDER BY {_FTS_RANK}, i.name, i.sku LIMIT ?",
+                [match] + list(params) + [limit]
+            ).fetchall()
+    return rows or _like_search(conn, q, where, params, limit)
+
+
+# ---------------------------------------------------------------------------
+# Derived tables (kept current by the sales endpoints, rebuildable from sales)
+# ---------------------------------------------------------------------------
+
+CUSTOMER_STATS_UPSERT = (
+    "INSERT INTO customer_stats (phone, order_count, total_spent, last_purchase) VALUES (?, 1, ?, ?) "
+    "ON CONFLICT (phone) DO UPDATE SET "
+    "order_count = customer_stats.order_count + 1, "
+    "total_spent = customer_stats.total_spent + excluded.total_spent, "
+    "last_purchase = MAX(customer_stats.last_purchase, excluded.last_purchase)"
+)
+
+
+def record_customer_sales(conn, sales):
+    """Count completed sales in customer_stats. `sales` is [(phone, grand_total, timestamp), ...]; no commit."""
+    rows = [(phone, float(total or 0), ts or "") for phone, total, ts in sales if phone]
+    if rows:
+        conn.executemany(CUSTOMER_STATS_UPSERT, rows)
+
+
+def unrecord_customer_sale(conn, phone, total):
+    """Take a voided sale back out of customer_stats. Call after the sale is marked Voided; no commit."""
+    if not phone:
+        return
+    conn.execute(
+        "UPDATE customer_stats SET order_count = order_count - 1, total_spent = total_spent - ?, "
+        "last_purchase = COALESCE((SELECT MAX(timestamp) FROM sales "
+        "WHERE customer_phone = ? AND status != 'Voided'), '') WHERE phone = ?",
+        (float(total or 0), phone, phone)
+    )
+
+
+def rebuild_customer_stats(conn=None):
+    """Recompute customer_stats from the sales table. Returns the number of customers."""
+    conn = conn or get_db()
+    conn.execute("DELETE FROM customer_stats")
+    conn.execute(
+        "INSERT INTO customer_stats (phone, order_count, total_spent, last_purchase) "
+        "SELECT customer_phone, COUNT(*), COALESCE(SUM(grand_total), 0), MAX(timestamp) "
+        "FROM sales WHERE customer_phone != '' AND status != 'Voided' GROUP BY customer_phone"
+    )
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM customer_stats").fetchone()[0]
+    print(f"[DB] Rebuilt customer_stats: {count} customers")
+    return count
+
+
+# supplier_products links a supplier to the SKUs it supplies, either because
+# inventory.supplier names it (source 'inventory', case-insensitive) or because
+# one of its purchase orders contains the SKU (source 'order').
+
+def _in_clause(values):
+    return ",".join("?" * len(values))
+
+
+def sync_inventory_supplier_links(conn, skus):
+    """Refresh the 'inventory' links for these SKUs after inventory.supplier may have changed; no commit."""
+    skus = [s for s in set(skus) if s]
+    for i in range(0, len(skus), BATCH_PAGE_SIZE):
+        chunk = skus[i:i + BATCH_PAGE_SIZE]
+        conn.execute(
+            f"DELETE FROM supplier_products WHERE source = 'inventory' AND sku IN ({_in_clause(chunk)})", chunk
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO supplier_products (supplier_id, sku, source) "
+            "SELECT s.id, i.sku, 'inventory' FROM inventory i "
+            "JOIN suppliers s ON LOWER(s.name) = LOWER(i.supplier) "
+            f"WHERE i.sku IN ({_in_clause(chunk)})", chunk
+        )
+
+
+def sync_supplier_name_links(conn, supplier_id):
+    """Refresh the 'inventory' links of one supplier after it was created or renamed; no commit."""
+    conn.execute("DELETE FROM supplier_products WHERE source = 'inventory' AND supplier_id = ?", (supplier_id,))
+    conn.execute(
+        "INSERT OR IGNORE INTO supplier_products (supplier_id, sku, source) "
+        "SELECT s.id, i.sku, 'inventory' FROM suppliers s "
+        "JOIN inventory i ON LOWER(i.supplier) = LOWER(s.name) WHERE s.id = ?",
+        (supplier_id,)
+    )
+
+
+def sync_order_supplier_links(conn, supplier_ids):
+    """Refresh the 'order' links of these suppliers after their purchase orders changed; no commit."""
+    for supplier_id in {sid for sid in supplier_ids if sid}:
+        conn.execute("DELETE FROM supplier_products WHERE source = 'order' AND supplier_id = ?", (supplier_id,))
+        conn.execute(
+            "INSERT OR IGNORE INTO supplier_products (supplier_id, sku, source) "
+            "SELECT DISTINCT po.supplier_id, poi.sku, 'order' FROM purchase_order_items poi "
+            "JOIN purchase_orders po ON poi.order_id = po.id WHERE po.supplier_id = ?",
+            (supplier_id,)
+        )
+
+
+def rebuild_supplier_products(conn=None):
+    """Recompute supplier_products from inventory and purchase orders. Returns the number of links."""
+    conn = conn or get_db()
+    conn.execute("DELETE FROM supplier_products")
+    conn.execute(
+        "INSERT OR IGNORE INTO supplier_products (supplier_id, sku, source) "
+        "SELECT s.id, i.sku, 'inventory' FROM inventory i "
+        "JOIN suppliers s ON LOWER(s.name) = LOWER(i.supplier)"
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO supplier_products (supplier_id, sku, source) "
+        "SELECT DISTINCT po.supplier_id, poi.sku, 'order' FROM purchase_order_items poi "
+        "JOIN purchase_orders po ON poi.order_id = po.id"
+    )
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM supplier_products").fetchone()[0]
+    print(f"[DB] Rebuilt supplier_products: {count} links")
+    return count
+
+
+# sales_daily_rollup and product_daily_rollup hold per-day totals of completed
+# sales (by payment method / by product) plus per-day voids, so the dashboard
+# reads a few rows per day instead of scanning the sales history.
+
+_NO_SKU = "COALESCE(si.sku, '')"
+_NO_NAME = "COALESCE(si.name, '')"
+_NO_METHOD = "COALESCE(payment_method, '')"
+
+
+def record_sale_rollups(conn, sale_ids):
+    """Add these (just inserted) sales to the daily rollups; no commit."""
+    sale_ids = list(sale_ids)
+    for i in range(0, len(sale_ids), BATCH_PAGE_SIZE):
+        chunk = sale_ids[i:i + BATCH_PAGE_SIZE]
+        conn.execute(
+            "INSERT INTO sales_daily_rollup (date, payment_method, sale_count, total) "
+            f"SELECT date, {_NO_METHOD}, COUNT(*), COALESCE(SUM(grand_total), 0) FROM sales "
+            f"WHERE id IN ({_in_clause(chunk)}) AND status != 'Voided' GROUP BY date, {_NO_METHOD} "
+            "ON CONFLICT (date, payment_method) DO UPDATE SET "
+            "sale_count = sales_daily_rollup.sale_count + excluded.sale_count, "
+            "total = sales_daily_rollup.total + excluded.total", chunk
+        )
+        conn.execute(
+            "INSERT INTO product_daily_rollup (date, sku, name, quantity, revenue) "
+            f"SELECT s.date, {_NO_SKU}, {_NO_NAME}, SUM(si.quantity), COALESCE(SUM(si.final_total), 0) "
+            "FROM sale_items si JOIN sales s ON s.id = si.sale_id "
+            f"WHERE si.sale_id IN ({_in_clause(chunk)}) AND s.status != 'Voided' "
+            f"GROUP BY s.date, {_NO_SKU}, {_NO_NAME} "
+            "ON CONFLICT (date, sku, name) DO UPDATE SET "
+            "quantity = product_daily_rollup.quantity + excluded.quantity, "
+            "revenue = product_daily_rollup.revenue + excluded.revenue", chunk
+        )
+
+
+def unrecord_sale_rollups(conn, sale):
+    """Move a voided sale (dict with id, date, payment_method, grand_total) from sales to voids; no commit."""
+    total = float(sale.get("grand_total") or 0)
+    conn.execute(
+        "UPDATE sales_daily_rollup SET sale_count = sale_count - 1, total = total - ?, "
+        "void_count = void_count + 1, void_total = void_total + ? WHERE date = ? AND payment_method = ?",
+        (total, total, sale["date"], sale.get("payment_method") or "")
+    )
+    items = conn.execute(
+        f"SELECT {_NO_SKU} AS sku, {_NO_NAME} AS name, SUM(si.quantity) AS qty, "
+        "COALESCE(SUM(si.final_total), 0) AS revenue FROM sale_items si WHERE si.sale_id = ? "
+        f"GROUP BY {_NO_SKU}, {_NO_NAME}", (sale["id"],)
+    ).fetchall()
+    conn.executemany(
+        "UPDATE product_daily_rollup SET quantity = quantity - ?, revenue = revenue - ? "
+        "WHERE date = ? AND sku = ? AND name = ?",
+        [(r["qty"], r["revenue"], sale["date"], r["sku"], r["name"]) for r in items]
+    )
+
+
+def rebuild_sales_rollups(conn=None):
+    """Recompute both daily rollups from the sales history. Returns the number of days."""
+    conn = conn or get_db()
+    conn.execute("DELETE FROM sales_daily_rollup")
+    conn.execute("DELETE FROM product_daily_rollup")
+    conn.execute(
+        "INSERT INTO sales_daily_rollup (date, payment_method, sale_count, total, void_count, void_total) "
+        f"SELECT date, {_NO_METHOD}, "
+        "SUM(CASE WHEN status != 'Voided' THEN 1 ELSE 0 END), "
+        "COALESCE(SUM(CASE WHEN status != 'Voided' THEN grand_total ELSE 0 END), 0), "
+        "SUM(CASE WHEN status = 'Voided' THEN 1 ELSE 0 END), "
+        "COALESCE(SUM(CASE WHEN status = 'Voided' THEN grand_total ELSE 0 END), 0) "
+        f"FROM sales GROUP BY date, {_NO_METHOD}"
+    )
+    conn.execute(
+        "INSERT INTO product_daily_rollup (date, sku, name, quantity, revenue) "
+        f"SELECT s.date, {_NO_SKU}, {_NO_NAME}, SUM(si.quantity), COALESCE(SUM(si.final_total), 0) "
+        "FROM sale_items si JOIN sales s ON s.id = si.sale_id WHERE s.status != 'Voided' "
+        f"GROUP BY s.date, {_NO_SKU}, {_NO_NAME}"
+    )
+    conn.commit()
+    count = conn.execute("SELECT COUNT(DISTINCT date) FROM sales_daily_rollup").fetchone()[0]
+    print(f"[DB] Rebuilt sales rollups: {count} days")
+    return count
+
+
+def _backfill_derived_tables(conn):
+    """Populate derived tables the first time they exist alongside older data."""
+    if not conn.execute("SELECT 1 FROM customer_stats LIMIT 1").fetchone() and \
+            conn.execute("SELECT 1 FROM sales WHERE customer_phone != '' LIMIT 1").fetchone():
+        rebuild_customer_stats(conn)
+    if not conn.execute("SELECT 1 FROM supplier_products LIMIT 1").fetchone() and \
+            conn.execute("SELECT 1 FROM suppliers LIMIT 1").fetchone():
+        rebuild_supplier_products(conn)
+    if not conn.execute("SELECT 1 FROM sales_daily_rollup LIMIT 1").fetchone() and \
+            conn.execute("SELECT 1 FROM sales LIMIT 1").fetchone():
+        rebuild_sales_rollups(conn)
+
+
 # ---------------------------------------------------------------------------
 # Migration from JSON files (SQLite only, local dev)
 # ---------------------------------------------------------------------------
@@ -1122,20 +2301,13 @@ def migrate_from_json():
 
     inv_file = json_files["inventory"]
     if inv_file.exists():
-        import random as _rnd
         inventory = _read_json(inv_file)
-        _used_skus = {r[0] for r in conn.execute(
-            "SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''"
-        ).fetchall()}
+        given = {(p.get("sku") or "").strip() for p in inventory} - {""}
+        new_skus = iter(allocate_codes(
+            conn, "sku", sum(1 for p in inventory if not (p.get("sku") or "").strip()), exclude=given
+        ))
         for p in inventory:
-            sku = (p.get("sku") or "").strip()
-            if not sku:
-                while True:
-                    candidate = str(_rnd.randint(100000, 999999))
-                    if candidate not in _used_skus:
-                        sku = candidate
-                        break
-            _used_skus.add(sku)
+            sku = (p.get("sku") or "").strip() or next(new_skus)
             try:
                 conn.execute(
                     """INSERT OR IGNORE INTO inventory
@@ -1204,6 +2376,8 @@ def migrate_from_json():
         conn.commit()
         sales_file.rename(sales_file.with_suffix(".json.bak"))
         print(f"  Migrated {len(sales)} sales")
+        rebuild_customer_stats(conn)
+        rebuild_sales_rollups(conn)
 
     print("[DB] Migration complete!")
     return True
@@ -1252,283 +2426,830 @@ def create_backup():
 # Data Export (SQLite → JSON for cloud migration)
 # ---------------------------------------------------------------------------
 
-def export_all_data():
-    """Export all data from current database to a JSON-serializable dict."""
-    conn = get_db()
-    data = {}
+# Tables in export/import order (parents before the rows that reference them).
+EXPORT_TABLES = (
+    "users", "settings", "inventory", "suppliers", "customers", "sales",
+    "inventory_log", "purchases", "purchase_orders", "categories",
+)
 
-    rows = conn.execute("SELECT * FROM users").fetchall()
-    data["users"] = [dict(r) for r in rows]
 
-    rows = conn.execute("SELECT * FROM settings").fetchall()
-    data["settings"] = {}
+def _attach_children(conn, parents, child_table, fk):
+    """Attach child rows to a batch of id-ordered parents with one id-range query."""
+    by_parent = {p["id"]: [] for p in parents}
+    rows = conn.execute(
+        f"SELECT * FROM {child_table} WHERE {fk} BETWEEN ? AND ? ORDER BY {fk}, id",
+        (parents[0]["id"], parents[-1]["id"])
+    ).fetchall()
     for r in rows:
-        data["settings"][r["key"]] = r["value"]
+        if r[fk] in by_parent:
+            by_parent[r[fk]].append(r._asdict())
+    for p in parents:
+        p["items"] = by_parent[p["id"]]
+    return parents
 
-    rows = conn.execute("SELECT * FROM inventory").fetchall()
-    data["inventory"] = [dict(r) for r in rows]
 
-    rows = conn.execute("SELECT * FROM suppliers").fetchall()
-    data["suppliers"] = [dict(r) for r in rows]
+def _iter_with_children(conn, parent_table, child_table, fk, batch_size):
+    batch = []
+    for row in conn.iter_rows(f"SELECT * FROM {parent_table} ORDER BY id", (), batch_size):
+        batch.append(row._asdict())
+        if len(batch) >= batch_size:
+            yield from _attach_children(conn, batch, child_table, fk)
+            batch = []
+    if batch:
+        yield from _attach_children(conn, batch, child_table, fk)
 
-    rows = conn.execute("SELECT * FROM customers").fetchall()
-    data["customers"] = [dict(r) for r in rows]
 
-    sales_rows = conn.execute("SELECT * FROM sales").fetchall()
-    sales_list = []
-    for s in sales_rows:
-        sale = dict(s)
-        items = conn.execute("SELECT * FROM sale_items WHERE sale_id = ?", (sale["id"],)).fetchall()
-        sale["items"] = [dict(i) for i in items]
-        sales_list.append(sale)
-    data["sales"] = sales_list
+def iter_export(conn=None, batch_size=BATCH_PAGE_SIZE):
+    """
+    Yield (table, record) for every exportable row, table by table in
+    EXPORT_TABLES order. Rows are read through iter_rows() (server-side cursors
+    on PostgreSQL); sales and purchase orders carry their items, loaded per
+    batch of parents by id range. Settings are yielded as {"key", "value"}.
+    """
+    conn = conn or get_db()
+    for table in EXPORT_TABLES:
+        if table == "sales":
+            records = _iter_with_children(conn, "sales", "sale_items", "sale_id", batch_size)
+        elif table == "purchase_orders":
+            records = _iter_with_children(conn, "purchase_orders", "purchase_order_items", "order_id", batch_size)
+        else:
+            order = "key" if table == "settings" else "name" if table == "categories" else \
+                "sku" if table == "inventory" else "id"
+            records = (r._asdict() for r in conn.iter_rows(f"SELECT * FROM {table} ORDER BY {order}", (), batch_size))
+        for rec in records:
+            yield table, rec
 
-    rows = conn.execute("SELECT * FROM inventory_log ORDER BY created DESC").fetchall()
-    data["inventory_log"] = [dict(r) for r in rows]
 
-    rows = conn.execute("SELECT * FROM purchases ORDER BY date DESC").fetchall()
-    data["purchases"] = [dict(r) for r in rows]
+def export_all_data():
+    """Export all data from current database to a JSON-serializable dict."""
+    data = {table: [] for table in EXPORT_TABLES}
+    data["settings"] = {}
+    for table, rec in iter_export():
+        if table == "settings":
+            data["settings"][rec["key"]] = rec["value"]
+        else:
+            data[table].append(rec)
+    return data
 
-    # Purchase orders + items
-    po_rows = conn.execute("SELECT * FROM purchase_orders ORDER BY created DESC").fetchall()
-    po_list = []
-    for po in po_rows:
-        order = dict(po)
-        items = conn.execute("SELECT * FROM purchase_order_items WHERE order_id = ?", (order["id"],)).fetchall()
-        order["items"] = [dict(i) for i in items]
-        po_list.append(order)
-    data["purchase_orders"] = po_list
 
-    rows = conn.execute("SELECT * FROM categories ORDER BY name").fetchall()
-    data["categories"] = [dict(r) for r in rows]
+# ---------------------------------------------------------------------------
+# Data Import (JSON → current database)
+# ---------------------------------------------------------------------------
 
-    return data
+# Columns written for each imported table, in the order _IMPORT_ROW builds them.
+# Child tables leave out their parent id, which is assigned on import.
+_IMPORT_COLUMNS = {
+    "users": ("id", "name", "username", "password", "role", "phone", "active", "created"),
+    "settings": ("key", "value"),
+    "inventory": ("sku", "barcode", "hsn_code", "name", "category", "brand", "description", "cost_price",
+                  "purchase_gst_pct", "selling_price", "quantity", "reorder_level", "dimensions", "weight",
+                  "color", "image_path", "supplier", "date_added", "last_updated"),
+    "suppliers": ("name", "contact_person", "phone", "email", "address", "notes", "created", "last_updated"),
+    "customers": ("phone", "name", "email", "address", "notes", "created", "last_updated"),
+    "sales": ("receipt_number", "timestamp", "date", "subtotal", "discount_amount", "tax_amount",
+              "cgst_amount", "sgst_amount", "grand_total", "payment_method", "cashier", "customer_name",
+              "customer_phone", "customer_email", "status", "voided_at", "voided_by", "void_reason"),
+    "sale_items": ("sku", "name", "hsn_code", "quantity", "unit_price", "line_total",
+                   "discount_type", "discount_value", "discount_amount", "final_total"),
+    "inventory_log": ("sku", "action", "description", "old_value", "new_value", "qty_change", "created"),
+    "purchases": ("sku", "date", "supplier", "quantity", "cost_price", "selling_price", "total_cost",
+                  "invoice_number", "notes", "created"),
+    "purchase_orders": ("order_number", "invoice_number", "supplier_id", "supplier_name", "order_date",
+                        "expected_date", "status", "notes", "total_amount", "received_date", "received_by",
+                        "receive_notes", "created", "last_updated"),
+    "purchase_order_items": ("sku", "product_name", "quantity", "received_qty", "cost_price", "line_total"),
+    "categories": ("name", "created", "last_updated"),
+}
+
+# Parent table → (child table, parent id column on the child, parent natural key)
+_IMPORT_CHILDREN = {
+    "sales": ("sale_items", "sale_id", "receipt_number"),
+    "purchase_orders": ("purchase_order_items", "order_id", "order_number"),
+}
+
+_IMPORT_ROW = {
+    "users": lambda u, now: (
+        u["id"], u.get("name", ""), u["username"], u["password"],
+        u.get("role", "staff"), u.get("phone", ""),
+        1 if u.get("active", True) in (True, 1, "true") else 0,
+        u.get("created", now)),
+    "settings": lambda kv, now: (
+        kv["key"], kv["value"] if isinstance(kv["value"], str) else json.dumps(kv["value"])),
+    "inventory": lambda p, now: (
+        p["sku"], p.get("barcode") or "", p.get("hsn_code", ""), p["name"], p.get("category", ""),
+        p.get("brand", ""), p.get("description", ""), float(p.get("cost_price", 0)),
+        float(p.get("purchase_gst_pct") or 0), float(p.get("selling_price", 0)),
+        int(p.get("quantity", 0)), int(p.get("reorder_level", 3)), p.get("dimensions", ""),
+        float(p.get("weight", 0)), p.get("color", ""), p.get("image_path", ""), p.get("supplier", ""),
+        p.get("date_added", now), p.get("last_updated", now)),
+    "suppliers": lambda s, now: (
+        s["name"], s.get("contact_person", ""), s.get("phone", ""), s.get("email", ""),
+        s.get("address", ""), s.get("notes", ""), s.get("created", now), s.get("last_updated", now)),
+    "customers": lambda c, now: (
+        c["phone"], c.get("name", ""), c.get("email", ""), c.get("address", ""), c.get("notes", ""),
+        c.get("created", now), c.get("last_updated", now)),
+    "sales": lambda s, now: (
+        s["receipt_number"], s.get("timestamp", ""), s.get("date", ""),
+        float(s.get("subtotal", 0)), float(s.get("discount_amount", 0)),
+        float(s.get("tax_amount", 0)), float(s.get("cgst_amount", 0)),
+        float(s.get("sgst_amount", 0)), float(s.get("grand_total", 0)),
+        s.get("payment_method", ""), s.get("cashier", ""),
+        s.get("customer_name", ""), s.get("customer_phone", ""),
+        s.get("customer_email", ""), s.get("status", "Complete"),
+        s.get("voided_at", ""), s.get("voided_by", ""), s.get("void_reason", "")),
+    "sale_items": lambda i, now: (
+        i.get("sku", ""), i.get("name", ""), i.get("hsn_code", ""),
+        int(i.get("quantity", 1)), float(i.get("unit_price", 0)),
+        float(i.get("line_total", 0)), i.get("discount_type", "none"),
+        float(i.get("discount_value", 0)), float(i.get("discount_amount", 0)),
+        float(i.get("final_total", i.get("line_total", 0)))),
+    "inventory_log": lambda l, now: (
+        l["sku"], l["action"], l.get("description", ""), l.get("old_value", ""), l.get("new_value", ""),
+        float(l.get("qty_change", 0)), l.get("created", now)),
+    "purchases": lambda p, now: (
+        p["sku"], p["date"], p.get("supplier", ""), int(p.get("quantity", 0)),
+        float(p.get("cost_price", 0)), float(p.get("selling_price", 0)),
+        float(p.get("total_cost", 0)), p.get("invoice_number", ""),
+        p.get("notes", ""), p.get("created", now)),
+    "purchase_orders": lambda po, now: (
+        po["order_number"], po.get("invoice_number", ""),
+        int(po.get("supplier_id", 0)), po.get("supplier_name", ""),
+        po["order_date"], po.get("expected_date", ""), po.get("status", "draft"),
+        po.get("notes", ""), float(po.get("total_amount", 0)),
+        po.get("received_date", ""), po.get("received_by", ""),
+        po.get("receive_notes", ""), po.get("created", now), po.get("last_updated", now)),
+    "purchase_order_items": lambda i, now: (
+        i.get("sku", ""), i.get("product_name", ""),
+        int(i.get("quantity", 0)), int(i.get("received_qty", 0)),
+        float(i.get("cost_price", 0)), float(i.get("line_total", 0))),
+    "categories": lambda c, now: (c["name"], c.get("created", now), c.get("last_updated", now)),
+}
+
+
+def _insert_sql(table, verb="INSERT", extra=()):
+    cols = tuple(extra) + _IMPORT_COLUMNS[table]
+    return f"{verb} INTO {table} ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})"
+
+
+def _table_records(data, table):
+    """Records for `table` from an export dict; settings become {"key", "value"} records."""
+    records = data.get(table) or []
+    if table == "settings" and isinstance(records, dict):
+        return [{"key": k, "value": v} for k, v in records.items()]
+    return records
+
+
+def _fill_missing_codes(conn, products):
+    """Copy products, giving any without a SKU or barcode a freshly allocated one."""
+    filled = [dict(p) for p in products]
+    for kind in ("sku", "barcode"):
+        given = {str(p.get(kind) or "").strip() for p in filled} - {""}
+        missing = [p for p in filled if not str(p.get(kind) or "").strip()]
+        for p, code in zip(missing, allocate_codes(conn, kind, len(missing), exclude=given) if missing else ()):
+            p[kind] = code
+        for p in filled:
+            p[kind] = str(p[kind]).strip()
+    return filled
+
+
+def rebuild_derived_tables(conn=None):
+    """Recompute every derived table from the base tables. Returns row counts."""
+    conn = conn or get_db()
+    return {
+        "customers": rebuild_customer_stats(conn),
+        "supplier_links": rebuild_supplier_products(conn),
+        "sales_days": rebuild_sales_rollups(conn),
+    }
+
+
+def _import_rows(conn, label, sql, records, to_params, describe):
+    """
+    Insert records as one batch and commit. If the batch fails, fall back to
+    row-by-row inserts so a single bad record only costs itself.
+    Returns the number of rows accepted.
+    """
+    params = []
+    for rec in records:
+        try:
+            params.append(to_params(rec))
+        except Exception as e:
+            print(f"  [WARN] {label} {describe(rec)}: {e}")
+    try:
+        conn.executemany(sql, params)
+        conn.commit()
+        return len(params)
+    except Exception as e:
+        print(f"  [WARN] {label}: batch insert failed ({e}), retrying row by row")
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    count = 0
+    for row in params:
+        try:
+            conn.execute(sql, row)
+            conn.commit()
+            count += 1
+        except Exception as e:
+            print(f"  [WARN] {label}: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+    return count
+
+
+def _import_parents(conn, label, table, records, now):
+    """Insert parent records with their items, committing each so one bad record only costs itself."""
+    child, fk, key = _IMPORT_CHILDREN[table]
+    count = 0
+    for rec in records:
+        try:
+            parent_id = conn.execute(_insert_sql(table), _IMPORT_ROW[table](rec, now)).lastrowid
+            if parent_id:
+                conn.executemany(
+                    _insert_sql(child, extra=(fk,)),
+                    [(parent_id,) + _IMPORT_ROW[child](item, now) for item in rec.get("items", [])]
+                )
+            conn.commit()
+            count += 1
+        except Exception as e:
+            print(f"  [WARN] {label} {rec.get(key)}: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+    return count
 
 
 def import_all_data(data):
     """Import a JSON data dict into the current database (works on both engines).
     Commits after each section so a failure in one table doesn't lose others.
+    For large stores see bulk_import_data().
     """
     conn = get_db()
     now = datetime.now().isoformat()
     imported = {"users": 0, "settings": 0, "inventory": 0, "suppliers": 0, "customers": 0, "sales": 0}
-
-    # --- Users ---
-    for u in data.get("users", []):
-        try:
-            conn.execute(
-                "INSERT OR IGNORE INTO users (id, name, username, password, role, phone, active, created) VALUES (?,?,?,?,?,?,?,?)",
-                (u["id"], u.get("name", ""), u["username"], u["password"],
-                 u.get("role", "staff"), u.get("phone", ""),
-                 1 if u.get("active", True) in (True, 1, "true") else 0,
-                 u.get("created", now))
+    labels = {"users": ("User", "Users", "username"), "settings": ("Setting", "Settings", "key"),
+              "inventory": ("Inventory", "Inventory", "sku"), "suppliers": ("Supplier", "Suppliers", "name"),
+              "customers": ("Customer", "Customers", "phone"), "sales": ("Sale", "Sales", None),
+              "inventory_log": ("Inventory log", "Inventory log", "sku"),
+              "purchases": ("Purchase", "Purchases", "sku"),
+              "purchase_orders": ("Purchase order", "Purchase orders", None),
+              "categories": ("Category", "Categories", "name")}
+
+    for table in EXPORT_TABLES:
+        label, plural, key = labels[table]
+        records = _table_records(data, table)
+        if table == "inventory":
+            records = _fill_missing_codes(conn, records)
+        if table in _IMPORT_CHILDREN:
+            imported[table] = _import_parents(conn, label, table, records, now)
+        else:
+            verb = "INSERT OR REPLACE" if table == "settings" else \
+                "INSERT" if table in ("inventory_log", "purchases") else "INSERT OR IGNORE"
+            imported[table] = _import_rows(
+                conn, label, _insert_sql(table, verb), records,
+                lambda rec, t=table: _IMPORT_ROW[t](rec, now),
+                lambda rec, k=key: rec.get(k),
             )
-            imported["users"] += 1
-        except Exception as e:
-            print(f"  [WARN] User {u.get('username')}: {e}")
-    conn.commit()
-    print(f"  [IMPORT] Users: {imported['users']}")
+        print(f"  [IMPORT] {plural}: {imported[table]}")
+
+    rebuild_derived_tables(conn)
+    return imported
 
-    # --- Settings ---
-    for key, value in data.get("settings", {}).items():
+
+# ---------------------------------------------------------------------------
+# Bulk import (staging tables + set-based merges)
+# ---------------------------------------------------------------------------
+# Records are loaded into TEMP staging tables (COPY on PostgreSQL, executemany
+# on SQLite) and merged with one INSERT ... SELECT per table, so a chunk of
+# thousands of rows costs a handful of statements and one commit. Sales and
+# purchase orders are matched to their items through a staging id and get
+# their real ids by natural key (receipt_number / order_number) in bulk.
+
+BULK_CHUNK_ROWS = 5000
+
+
+def _create_stage(conn, stage, table, columns, *extra):
+    conn.execute(f"DROP TABLE IF EXISTS {stage}")
+    conn.execute(
+        f"CREATE TEMP TABLE {stage} AS SELECT "
+        + ", ".join(f"0 AS {c}" for c in ("stage_id",) + extra)
+        + f", {', '.join(columns)} FROM {table} WHERE 1=0"
+    )
+
+
+def _merge_table(conn, table, stage, cols):
+    c = ", ".join(cols)
+    if table == "settings":
+        # Last value wins, like sequential INSERT OR REPLACE
+        sql = (f"INSERT INTO settings ({c}) SELECT {c} FROM {stage} "
+               f"WHERE stage_id IN (SELECT MAX(stage_id) FROM {stage} GROUP BY key) "
+               "ON CONFLICT (key) DO UPDATE SET value = excluded.value")
+    elif table in ("inventory_log", "purchases"):
+        # Skip rows for unknown products instead of failing the chunk on the FK
+        sql = (f"INSERT INTO {table} ({c}) SELECT {c} FROM {stage} st "
+               "WHERE EXISTS (SELECT 1 FROM inventory i WHERE i.sku = st.sku) ORDER BY stage_id")
+    else:
+        sql = f"INSERT OR IGNORE INTO {table} ({c}) SELECT {c} FROM {stage} ORDER BY stage_id"
+    return conn.execute(sql).rowcount
+
+
+def _merge_parents(conn, table, stage, cols, child_stage, child_cols):
+    child, fk, key = _IMPORT_CHILDREN[table]
+    if table == "purchase_orders":
+        # Supplier ids differ between databases; resolve them by name
+        conn.execute(
+            f"UPDATE {stage} SET supplier_id = COALESCE("
+            f"(SELECT s.id FROM suppliers s WHERE s.name = {stage}.supplier_name), supplier_id)"
+        )
+    keep = [
+        f"stage_id IN (SELECT MIN(stage_id) FROM {stage} GROUP BY {key})",
+        f"NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{key} = {stage}.{key})",
+    ]
+    if table == "purchase_orders":
+        keep.append(f"EXISTS (SELECT 1 FROM suppliers s WHERE s.id = {stage}.supplier_id)")
+        keep.append(
+            f"NOT EXISTS (SELECT 1 FROM {child_stage} c WHERE c.parent_stage_id = {stage}.stage_id "
+            "AND NOT EXISTS (SELECT 1 FROM inventory i WHERE i.sku = c.sku))"
+        )
+    conn.execute(f"UPDATE {stage} SET keep = 1 WHERE " + " AND ".join(keep))
+
+    c = ", ".join(cols)
+    inserted = conn.execute(
+        f"INSERT INTO {table} ({c}) SELECT {c} FROM {stage} WHERE keep = 1 ORDER BY stage_id"
+    ).rowcount
+    conn.execute(
+        f"INSERT INTO {child} ({fk}, {', '.join(child_cols)}) "
+        f"SELECT p.id, {', '.join('c.' + col for col in child_cols)} FROM {child_stage} c "
+        f"JOIN {stage} st ON st.stage_id = c.parent_stage_id "
+        f"JOIN {table} p ON p.{key} = st.{key} "
+        "WHERE st.keep = 1 ORDER BY c.stage_id"
+    )
+    return inserted
+
+
+def bulk_import_rows(conn, table, records, now=None):
+    """
+    Stage and merge one chunk of records for `table` (EXPORT_TABLES shape).
+    Does not commit. Returns the number of rows inserted; duplicates and rows
+    referencing unknown products/suppliers are skipped.
+    """
+    now = now or datetime.now().isoformat()
+    if table == "inventory":
+        records = _fill_missing_codes(conn, records)
+    cols = _IMPORT_COLUMNS[table]
+    child = _IMPORT_CHILDREN.get(table)
+    child_cols = _IMPORT_COLUMNS[child[0]] if child else ()
+
+    rows, child_rows = [], []
+    for i, rec in enumerate(records):
         try:
-            conn.execute(
-                "INSERT OR REPLACE INTO settings (key, value) VALUES (?,?)",
-                (key, value if isinstance(value, str) else json.dumps(value))
-            )
-            imported["settings"] += 1
-        except Exception as e:
-            print(f"  [WARN] Setting {key}: {e}")
-    conn.commit()
-    print(f"  [IMPORT] Settings: {imported['settings']}")
-
-    # --- Inventory ---
-    import random as _rnd
-    _used_skus = {r[0] for r in conn.execute(
-        "SELECT sku FROM inventory WHERE sku IS NOT NULL AND sku != ''"
-    ).fetchall()}
-    for p in data.get("inventory", []):
-        sku = (p.get("sku") or "").strip()
-        if not sku:
-            while True:
-                candidate = str(_rnd.randint(100000, 999999))
-                if candidate not in _used_skus:
-                    sku = candidate
-                    break
-        _used_skus.add(sku)
+            row = (i,) + _IMPORT_ROW[table](rec, now)
+            items = [(i,) + _IMPORT_ROW[child[0]](item, now) for item in rec.get("items", [])] if child else []
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"  [WARN] {table} record {i}: {e}")
+            continue
+        rows.append(row)
+        child_rows.extend(items)
+
+    stage = f"_stage_{table}"
+    _create_stage(conn, stage, table, cols, "keep")
+    try:
+        conn.copy_rows(stage, ("stage_id",) + cols, rows)
+        if not child:
+            return _merge_table(conn, table, stage, cols)
+        child_stage = f"_stage_{child[0]}"
+        _create_stage(conn, child_stage, child[0], child_cols, "parent_stage_id")
         try:
-            conn.execute(
-                "INSERT OR IGNORE INTO inventory (sku, hsn_code, name, category, brand, description, cost_price, selling_price, "
-                "quantity, reorder_level, dimensions, weight, color, image_path, supplier, date_added, last_updated) "
-                "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (sku, p.get("hsn_code", ""), p["name"], p.get("category", ""), p.get("brand", ""),
-                 p.get("description", ""), float(p.get("cost_price", 0)),
-                 float(p.get("selling_price", 0)), int(p.get("quantity", 0)),
-                 int(p.get("reorder_level", 3)), p.get("dimensions", ""),
-                 float(p.get("weight", 0)), p.get("color", ""),
-                 p.get("image_path", ""), p.get("supplier", ""),
-                 p.get("date_added", now), p.get("last_updated", now))
-            )
-            imported["inventory"] += 1
-        except Exception as e:
-            print(f"  [WARN] Inventory {p.get('sku')}: {e}")
+            conn.copy_rows(child_stage, ("stage_id", "parent_stage_id") + child_cols,
+                           [(n,) + r for n, r in enumerate(child_rows)])
+            return _merge_parents(conn, table, stage, cols, child_stage, child_cols)
+        finally:
+            conn.execute(f"DROP TABLE IF EXISTS {child_stage}")
+    finally:
+        conn.execute(f"DROP TABLE IF EXISTS {stage}")
+
+
+def _print_progress(table, done, total):
+    print(f"  [IMPORT] {table}: {done}/{total}")
+
+
+def bulk_import_data(data, progress=_print_progress, chunk_rows=BULK_CHUNK_ROWS):
+    """
+    Bulk-import an export dict: each table in chunks of `chunk_rows`, one
+    transaction per chunk. `progress(table, done, total)` is called after each
+    chunk. Returns (imported counts, per-table throughput).
+    """
+    conn = get_db()
+    now = datetime.now().isoformat()
+    imported, throughput = {}, {}
+    for table in EXPORT_TABLES:
+        records = _table_records(data, table)
+        inserted, started = 0, time.perf_counter()
+        for offset in range(0, len(records), chunk_rows):
+            chunk = records[offset:offset + chunk_rows]
+            try:
+                inserted += bulk_import_rows(conn, table, chunk, now)
+                conn.commit()
+            except Exception as e:
+                print(f"  [WARN] {table} rows {offset}-{offset + len(chunk) - 1}: {e}")
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            if progress:
+                progress(table, offset + len(chunk), len(records))
+        elapsed = time.perf_counter() - started
+        rate = round(len(records) / elapsed) if elapsed > 0 else len(records)
+        imported[table] = inserted
+        throughput[table] = {"rows": len(records), "inserted": inserted,
+                             "seconds": round(elapsed, 3), "rows_per_sec": rate}
+        print(f"  [IMPORT] {table}: {inserted}/{len(records)} rows in {elapsed:.2f}s ({rate} rows/s)")
+
+    rebuild_derived_tables(conn)
+    return imported, throughput
+
+
+# ---------------------------------------------------------------------------
+# Resumable import sessions (chunked uploads from migrate_to_cloud.py)
+# ---------------------------------------------------------------------------
+# Each chunk is identified by (session, table, offset) and acknowledged in
+# import_chunks in the same transaction that imports it, so a client that
+# lost the response can resend it and the rows are only imported once.
+
+IMPORT_SESSION_TTL_HOURS = 6  # an upload still running after this must open a new session
+
+
+def create_import_session(conn, token_hash, bootstrap=False):
+    """Open a new import session. bootstrap marks one opened on an empty database. Returns its id."""
+    session_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    conn.execute(
+        "INSERT INTO import_sessions (id, token_hash, status, bootstrap, created, last_updated) "
+        "VALUES (?,?,'open',?,?,?)",
+        (session_id, token_hash, 1 if bootstrap else 0, now, now)
+    )
     conn.commit()
-    print(f"  [IMPORT] Inventory: {imported['inventory']}")
+    return session_id
 
-    # --- Suppliers ---
-    for s in data.get("suppliers", []):
-        try:
-            conn.execute(
-                "INSERT OR IGNORE INTO suppliers (name, contact_person, phone, email, address, notes, created, last_updated) "
-                "VALUES (?,?,?,?,?,?,?,?)",
-                (s["name"], s.get("contact_person", ""), s.get("phone", ""),
-                 s.get("email", ""), s.get("address", ""), s.get("notes", ""),
-                 s.get("created", now), s.get("last_updated", now))
-            )
-            imported["suppliers"] += 1
-        except Exception as e:
-            print(f"  [WARN] Supplier {s.get('name')}: {e}")
+
+def import_session_expired(created):
+    """Whether a session opened at `created` is past IMPORT_SESSION_TTL_HOURS."""
+    return created < (datetime.now() - timedelta(hours=IMPORT_SESSION_TTL_HOURS)).isoformat()
+
+
+def expire_import_session(conn, session_id):
+    """Close an open session that has outlived IMPORT_SESSION_TTL_HOURS."""
+    conn.execute(
+        "UPDATE import_sessions SET status = 'expired', last_updated = ? WHERE id = ? AND status = 'open'",
+        (datetime.now().isoformat(), session_id)
+    )
     conn.commit()
-    print(f"  [IMPORT] Suppliers: {imported['suppliers']}")
 
-    # --- Customers ---
-    for c in data.get("customers", []):
-        try:
-            conn.execute(
-                "INSERT OR IGNORE INTO customers (phone, name, email, address, notes, created, last_updated) "
-                "VALUES (?,?,?,?,?,?,?)",
-                (c["phone"], c.get("name", ""), c.get("email", ""),
-                 c.get("address", ""), c.get("notes", ""),
-                 c.get("created", now), c.get("last_updated", now))
-            )
-            imported["customers"] += 1
-        except Exception as e:
-            print(f"  [WARN] Customer {c.get('phone')}: {e}")
+
+def import_session_status(conn, session_id):
+    """Acknowledged chunks per table: {table: {"offsets": [...], "rows": n, "inserted": n}}."""
+    tables = {}
+    for r in conn.execute(
+        "SELECT table_name, chunk_offset, row_count, inserted FROM import_chunks "
+        "WHERE session_id = ? ORDER BY table_name, chunk_offset", (session_id,)
+    ).fetchall():
+        t = tables.setdefault(r["table_name"], {"offsets": [], "rows": 0, "inserted": 0})
+        t["offsets"].append(r["chunk_offset"])
+        t["rows"] += r["row_count"]
+        t["inserted"] += r["inserted"]
+    return tables
+
+
+def _chunk_ack(conn, session_id, table, offset):
+    row = conn.execute(
+        "SELECT row_count, inserted FROM import_chunks WHERE session_id = ? AND table_name = ? AND chunk_offset = ?",
+        (session_id, table, offset)
+    ).fetchone()
+    return {"table": table, "offset": offset, "rows": row["row_count"], "inserted": row["inserted"]} if row else None
+
+
+def import_session_chunk(conn, session_id, table, offset, records):
+    """
+    Import one chunk of a session exactly once. Returns (ack, duplicate):
+    a chunk that was already acknowledged is not imported again.
+    """
+    ack = _chunk_ack(conn, session_id, table, offset)
+    if ack:
+        return ack, True
+    now = datetime.now().isoformat()
+    try:
+        # Claim the chunk first: a concurrent retry of the same chunk fails on the primary key
+        conn.execute(
+            "INSERT INTO import_chunks (session_id, table_name, chunk_offset, row_count, inserted, created) "
+            "VALUES (?,?,?,?,0,?)", (session_id, table, offset, len(records), now)
+        )
+        inserted = bulk_import_rows(conn, table, records, now)
+        conn.execute(
+            "UPDATE import_chunks SET inserted = ? WHERE session_id = ? AND table_name = ? AND chunk_offset = ?",
+            (inserted, session_id, table, offset)
+        )
+        conn.execute("UPDATE import_sessions SET last_updated = ? WHERE id = ?", (now, session_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        ack = _chunk_ack(conn, session_id, table, offset)
+        if ack:
+            return ack, True
+        raise
+    return {"table": table, "offset": offset, "rows": len(records), "inserted": inserted}, False
+
+
+def finish_import_session(conn, session_id):
+    """Close a session and rebuild the derived tables once for the whole import."""
+    counts = rebuild_derived_tables(conn)
+    conn.execute(
+        "UPDATE import_sessions SET status = 'complete', last_updated = ? WHERE id = ?",
+        (datetime.now().isoformat(), session_id)
+    )
+    conn.commit()
+    return counts
+
+
+# ---------------------------------------------------------------------------
+# Idempotency keys (retried / replayed sales)
+# ---------------------------------------------------------------------------
+# A client sends the same key with every retry of one request. The response
+# is stored under (scope, key) in the transaction that does the work, so a
+# replay is answered from one primary-key lookup, and a concurrent duplicate
+# fails on the primary key and is answered from the winner's row instead.
+
+IDEMPOTENCY_KEY_MAX_LEN = 128
+IDEMPOTENCY_TTL_DAYS = 30        # offline terminals can sit on queued sales for a while
+IDEMPOTENCY_PURGE_INTERVAL = 3600
+_idempotency_last_purge = 0.0
+
+
+def stored_response(conn, scope, key):
+    """(status_code, body) stored for this key, or None if the key is new."""
+    row = conn.execute(
+        "SELECT status_code, response FROM idempotency_keys WHERE scope = ? AND key = ?", (scope, key)
+    ).fetchone()
+    return (row["status_code"], json.loads(row["response"])) if row else None
+
+
+def stored_responses(conn, scope, keys):
+    """{key: (status_code, body)} for the keys that were already used, in one query per chunk."""
+    keys = list(dict.fromkeys(keys))
+    found = {}
+    for i in range(0, len(keys), BATCH_PAGE_SIZE):
+        chunk = keys[i:i + BATCH_PAGE_SIZE]
+        for row in conn.execute(
+            f"SELECT key, status_code, response FROM idempotency_keys WHERE scope = ? AND key IN ({_in_clause(chunk)})",
+            [scope] + chunk
+        ).fetchall():
+            found[row["key"]] = (row["status_code"], json.loads(row["response"]))
+    return found
+
+
+def store_response(conn, scope, key, status_code, body):
+    """Record the response for a key in the caller's transaction; no commit.
+    Raises (IntegrityError) if another request already stored this key."""
+    store_responses(conn, scope, [(key, status_code, body)])
+
+
+def store_responses(conn, scope, entries):
+    """store_response for many (key, status_code, body) entries in one batch; no commit."""
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "INSERT INTO idempotency_keys (scope, key, status_code, response, created) VALUES (?,?,?,?,?)",
+        [(scope, key, status_code, json.dumps(body, default=str), now) for key, status_code, body in entries]
+    )
+    if time.monotonic() - _idempotency_last_purge >= IDEMPOTENCY_PURGE_INTERVAL:
+        # After the sale commits, in its own transaction: a table-wide DELETE
+        # inside the sale's transaction would hold its write lock that much longer
+        conn.after_commit(lambda: _maybe_purge_idempotency_keys(conn))
+
+
+def purge_idempotency_keys(conn):
+    """Delete keys older than IDEMPOTENCY_TTL_DAYS and commit. Returns how many were removed."""
+    global _idempotency_last_purge
+    _idempotency_last_purge = time.monotonic()
+    cutoff = (datetime.now() - timedelta(days=IDEMPOTENCY_TTL_DAYS)).isoformat()
+    removed = conn.execute("DELETE FROM idempotency_keys WHERE created < ?", (cutoff,)).rowcount
     conn.commit()
-    print(f"  [IMPORT] Customers: {imported['customers']}")
+    if removed:
+        print(f"[DB] Purged {removed} expired idempotency keys")
+    return removed
+
 
-    # --- Sales + Items ---
-    for s in data.get("sales", []):
+def _maybe_purge_idempotency_keys(conn):
+    """Expire old keys in their own transaction, at most once per IDEMPOTENCY_PURGE_INTERVAL per worker."""
+    if time.monotonic() - _idempotency_last_purge >= IDEMPOTENCY_PURGE_INTERVAL:
+        purge_idempotency_keys(conn)
+
+
+# ---------------------------------------------------------------------------
+# Write-behind audit log (AUDIT_ASYNC=1)
+# ---------------------------------------------------------------------------
+# Audit rows are handed over once the request's transaction commits, queued
+# in memory, and written by a background thread in batches on its own pooled
+# connection, so checkout doesn't pay for them. Failure handling:
+#   - queue full: the rows go straight to the journal file (never dropped;
+#     the request only waits if a journal replay is in progress)
+#   - database write fails: the batch goes to the journal, which is replayed
+#     ahead of the next batch that writes successfully
+#   - a row the database rejects (e.g. its product was deleted meanwhile) is
+#     dropped with a warning rather than blocking the rest
+#   - shutdown: an atexit hook drains the queue; whatever can't be written,
+#     or is still queued when the drain times out, lands in the journal
+#   - hard kill or power loss: rows still in memory (at most the last
+#     AUDIT_FLUSH_INTERVAL seconds) are lost
+# Journal replay is at-least-once: a crash between the insert and truncating
+# the journal can repeat those rows.
+
+AUDIT_FLUSH_ROWS = 500       # rows per INSERT batch
+AUDIT_FLUSH_INTERVAL = 1.0   # seconds a row can wait in memory
+
+
+_journal_lock = threading.Lock()  # request threads append overflow while the writer thread replays
+
+
+@contextmanager
+def _locked(f):
+    """Exclusive lock on an open journal file across threads and, with fcntl, worker processes."""
+    with _journal_lock:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
         try:
-            cursor = conn.execute(
-                "INSERT INTO sales (receipt_number, timestamp, date, subtotal, discount_amount, "
-                "tax_amount, cgst_amount, sgst_amount, grand_total, payment_method, cashier, customer_name, customer_phone, "
-                "customer_email, status, voided_at, voided_by, void_reason) "
-                "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (s["receipt_number"], s.get("timestamp", ""), s.get("date", ""),
-                 float(s.get("subtotal", 0)), float(s.get("discount_amount", 0)),
-                 float(s.get("tax_amount", 0)), float(s.get("cgst_amount", 0)),
-                 float(s.get("sgst_amount", 0)), float(s.get("grand_total", 0)),
-                 s.get("payment_method", ""), s.get("cashier", ""),
-                 s.get("customer_name", ""), s.get("customer_phone", ""),
-                 s.get("customer_email", ""), s.get("status", "Complete"),
-                 s.get("voided_at", ""), s.get("voided_by", ""), s.get("void_reason", ""))
-            )
-            sale_id = cursor.lastrowid
-            if sale_id:
-                for item in s.get("items", []):
-                    conn.execute(
-                        "INSERT INTO sale_items (sale_id, sku, name, hsn_code, quantity, unit_price, line_total, "
-                        "discount_type, discount_value, discount_amount, final_total) "
-                        "VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                        (sale_id, item.get("sku", ""), item.get("name", ""), item.get("hsn_code", ""),
-                         int(item.get("quantity", 1)), float(item.get("unit_price", 0)),
-                         float(item.get("line_total", 0)), item.get("discount_type", "none"),
-                         float(item.get("discount_value", 0)), float(item.get("discount_amount", 0)),
-                         float(item.get("final_total", item.get("line_total", 0))))
-                    )
-            conn.commit()
-            imported["sales"] += 1
-        except Exception as e:
-            print(f"  [WARN] Sale {s.get('receipt_number')}: {e}")
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-    print(f"  [IMPORT] Sales: {imported['sales']}")
+            yield f
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class AuditWriter:
+    """Bounded queue + background thread that writes audit rows with `sql` in batches."""
+
+    def __init__(self, sql, journal=AUDIT_JOURNAL, max_queue=AUDIT_QUEUE_MAX,
+                 flush_rows=AUDIT_FLUSH_ROWS, flush_interval=AUDIT_FLUSH_INTERVAL):
+        self.sql = sql
+        self.journal = Path(journal)
+        self.max_queue = max_queue
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats = {"submitted": 0, "written": 0, "journaled": 0, "replayed": 0, "dropped": 0}
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        """Start the writer thread in this process (threads don't survive a gunicorn fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, rows):
+        """Queue committed audit rows; never blocks. Overflow goes to the journal."""
+        rows = [tuple(r) for r in rows]
+        if not rows:
+            return
+        self._ensure_started()
+        self._count(submitted=len(rows))
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self._to_journal(rows)
 
-    # --- Inventory Log ---
-    imported["inventory_log"] = 0
-    for l in data.get("inventory_log", []):
+    def _take(self, timeout):
+        """Up to flush_rows queued rows, waiting at most `timeout` for the first."""
+        rows = []
         try:
-            conn.execute(
-                "INSERT INTO inventory_log (sku, action, description, old_value, new_value, qty_change, created) "
-                "VALUES (?,?,?,?,?,?,?)",
-                (l["sku"], l["action"], l.get("description", ""),
-                 l.get("old_value", ""), l.get("new_value", ""),
-                 float(l.get("qty_change", 0)), l.get("created", now))
-            )
-            imported["inventory_log"] += 1
-        except Exception as e:
-            print(f"  [WARN] Inventory log: {e}")
-    conn.commit()
-    print(f"  [IMPORT] Inventory log: {imported['inventory_log']}")
+            rows.extend(self._queue.get(timeout=timeout))
+            while len(rows) < self.flush_rows:
+                rows.extend(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return rows
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            rows = self._take(self.flush_interval)
+            if rows or self._journal_pending():
+                self._flush(rows)
 
-    # --- Purchases ---
-    imported["purchases"] = 0
-    for p in data.get("purchases", []):
+    def _flush(self, rows):
+        conn = get_db()
         try:
-            conn.execute(
-                "INSERT INTO purchases (sku, date, supplier, quantity, cost_price, selling_price, total_cost, "
-                "invoice_number, notes, created) VALUES (?,?,?,?,?,?,?,?,?,?)",
-                (p["sku"], p["date"], p.get("supplier", ""), int(p.get("quantity", 0)),
-                 float(p.get("cost_price", 0)), float(p.get("selling_price", 0)),
-                 float(p.get("total_cost", 0)), p.get("invoice_number", ""),
-                 p.get("notes", ""), p.get("created", now))
-            )
-            imported["purchases"] += 1
+            self._replay_journal(conn)
+            self._write(conn, rows)
         except Exception as e:
-            print(f"  [WARN] Purchase: {e}")
-    conn.commit()
-    print(f"  [IMPORT] Purchases: {imported['purchases']}")
+            if rows:
+                print(f"  [WARN] Audit writer: {len(rows)} rows to journal ({e})")
+                self._to_journal(rows)
+            else:
+                print(f"  [WARN] Audit writer: journal replay failed ({e})")
+        finally:
+            close_db()
+
+    def _write(self, conn, rows):
+        """Insert and commit rows in one batch."""
+        if not rows:
+            return
+        dropped = self._insert(conn, rows)
+        conn.commit()
+        self._count(written=len(rows) - dropped, dropped=dropped)
 
-    # --- Purchase Orders + Items ---
-    imported["purchase_orders"] = 0
-    for po in data.get("purchase_orders", []):
+    def _insert(self, conn, rows):
+        """Insert rows without committing; rows the database rejects are dropped one by one.
+        Returns how many were dropped."""
+        dropped = 0
         try:
-            cursor = conn.execute(
-                "INSERT INTO purchase_orders (order_number, invoice_number, supplier_id, supplier_name, order_date, "
-                "expected_date, status, notes, total_amount, received_date, received_by, receive_notes, "
-                "created, last_updated) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                (po["order_number"], po.get("invoice_number", ""),
-                 int(po.get("supplier_id", 0)), po.get("supplier_name", ""),
-                 po["order_date"], po.get("expected_date", ""), po.get("status", "draft"),
-                 po.get("notes", ""), float(po.get("total_amount", 0)),
-                 po.get("received_date", ""), po.get("received_by", ""),
-                 po.get("receive_notes", ""), po.get("created", now), po.get("last_updated", now))
-            )
-            order_id = cursor.lastrowid
-            if order_id:
-                for item in po.get("items", []):
-                    conn.execute(
-                        "INSERT INTO purchase_order_items (order_id, sku, product_name, quantity, "
-                        "received_qty, cost_price, line_total) VALUES (?,?,?,?,?,?,?)",
-                        (order_id, item.get("sku", ""), item.get("product_name", ""),
-                         int(item.get("quantity", 0)), int(item.get("received_qty", 0)),
-                         float(item.get("cost_price", 0)), float(item.get("line_total", 0)))
-                    )
-            conn.commit()
-            imported["purchase_orders"] += 1
-        except Exception as e:
-            print(f"  [WARN] Purchase order {po.get('order_number')}: {e}")
+            with conn.savepoint():
+                conn.executemany(self.sql, rows)
+        except Exception:
+            for row in rows:
+                try:
+                    with conn.savepoint():
+                        conn.execute(self.sql, row)
+                except Exception as e:
+                    if not _is_integrity_error(e):
+                        raise
+                    dropped += 1
+                    print(f"  [WARN] Audit writer: dropped row for {row[0]} ({e})")
+        return dropped
+
+    def _to_journal(self, rows):
+        if not rows:
+            return
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.journal, "a", encoding="utf-8") as f, _locked(f):
+            f.write("".join(json.dumps(list(r), default=str) + "\n" for r in rows))
+            f.flush()  # before the lock is released, not when the file closes
+        self._count(journaled=len(rows))
+
+    def _journal_pending(self):
+        try:
+            return self.journal.stat().st_size > 0
+        except FileNotFoundError:
+            return False
+
+    def _replay_journal(self, conn):
+        """Write journaled rows to the database, then empty the journal. Raises if the write fails."""
+        if not self._journal_pending():
+            return
+        # One transaction for the whole journal: if any batch fails, nothing is
+        # committed and the journal is kept intact, so no row is written twice.
+        # Truncated rather than deleted: another worker may be waiting on the lock to append
+        with open(self.journal, "r+", encoding="utf-8") as f, _locked(f):
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+            dropped = 0
             try:
-                conn.rollback()
+                for i in range(0, len(rows), self.flush_rows):
+                    dropped += self._insert(conn, rows[i:i + self.flush_rows])
+                conn.commit()
             except Exception:
-                pass
-    print(f"  [IMPORT] Purchase orders: {imported['purchase_orders']}")
-
-    # --- Categories ---
-    cat_count = 0
-    for cat in data.get("categories", []):
+                conn.rollback()
+                raise
+            f.truncate(0)
+        if rows:
+            self._count(written=len(rows) - dropped, dropped=dropped, replayed=len(rows))
+            print(f"  [AUDIT] Replayed {len(rows)} journaled audit rows")
+
+    def close(self, timeout=10.0):
+        """Flush everything queued (atexit). Rows that can't be written go to the journal."""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        # If the thread is still writing (slow or unreachable database), it keeps
+        # the batch it holds; everything still queued is journaled for the next start.
+        leftover = []
         try:
-            conn.execute(
-                "INSERT OR IGNORE INTO categories (name, created, last_updated) VALUES (?,?,?)",
-                (cat["name"], cat.get("created", now), cat.get("last_updated", now))
-            )
-            cat_count += 1
-        except Exception as e:
-            print(f"  [WARN] Category {cat.get('name')}: {e}")
-    conn.commit()
-    print(f"  [IMPORT] Categories: {cat_count}")
+            while True:
+                leftover.extend(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        self._to_journal(leftover)
 
-    return imported
+    def _count(self, **counts):
+        with self._lock:
+            for key, n in counts.items():
+                self._stats[key] += n
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._stats)
+        return {**counts, "queued": self._queue.qsize() if self._queue else 0}
+
+
+def _is_integrity_error(e):
+    if isinstance(e, sqlite3.IntegrityError):
+        return True
+    return USE_POSTGRES and isinstance(e, psycopg2.IntegrityError)
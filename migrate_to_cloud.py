@@ -10,6 +10,9 @@ Usage:
   2. Run to upload to cloud:
      python3 migrate_to_cloud.py upload https://your-app.railway.app
 
+     Uploads are chunked and resumable: if one is interrupted, run the same
+     command again and it continues from the last acknowledged chunk.
+
   Or do both in one step:
      python3 migrate_to_cloud.py migrate https://your-app.railway.app
 """
@@ -59,23 +62,90 @@ def export_local():
     return data
 
 
-def upload_to_cloud(cloud_url, data=None):
-    """Upload exported data to the cloud instance."""
+# ---------------------------------------------------------------------------
+# Chunked upload
+# ---------------------------------------------------------------------------
+# Each table is sent in CHUNK_ROWS-record chunks, gzip-compressed, to an import
+# session on the server. The session and its token are saved in STATE_FILE, so
+# re-running the upload after an interruption skips every chunk the server has
+# already acknowledged.
+
+CHUNK_ROWS = 2000
+MAX_RETRIES = 5
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "upload_state.json")
+
+
+def _request(url, payload=None, headers=None, method="GET", timeout=120, compress=False):
+    """Send a JSON request; returns the decoded JSON response. Raises urllib errors."""
+    import gzip
     import urllib.request
+
+    headers = dict(headers or {})
+    body = None
+    if payload is not None:
+        body = json.dumps(payload, default=str).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+        if compress:
+            body = gzip.compress(body, 6)
+            headers["Content-Encoding"] = "gzip"
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    resp = urllib.request.urlopen(req, timeout=timeout)
+    return json.loads(resp.read()), len(body or b"")
+
+
+def _request_with_retry(url, **kwargs):
+    """_request with exponential backoff on network errors and 5xx responses."""
+    import time
     import urllib.error
 
-    if data is None:
-        export_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "export_for_cloud.json")
-        if not os.path.exists(export_file):
-            print("ERROR: No export file found. Run 'export' first.")
-            sys.exit(1)
-        with open(export_file, "r") as f:
-            data = json.load(f)
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return _request(url, **kwargs)
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == MAX_RETRIES:
+                raise
+            print(f"\n  Server error {e.code}, retrying ({attempt}/{MAX_RETRIES})...")
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"\n  Connection problem ({e}), retrying ({attempt}/{MAX_RETRIES})...")
+        time.sleep(min(2 ** attempt, 30))
 
-    cloud_url = cloud_url.rstrip("/")
 
-    # Step 1: Login as admin to get session
-    print(f"\nConnecting to cloud: {cloud_url}")
+def _table_records(data, table):
+    records = data.get(table) or []
+    if table == "settings" and isinstance(records, dict):
+        return [{"key": k, "value": v} for k, v in records.items()]
+    return records
+
+
+def _fingerprint(data):
+    import hashlib
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _load_state(cloud_url, fingerprint):
+    """Saved session for this server and export, if any."""
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("cloud_url") != cloud_url or state.get("fingerprint") != fingerprint:
+        return None
+    return state
+
+
+def _save_state(state):
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, "w") as f:
+        json.dump(state, f)
+
+
+def _login(cloud_url):
+    """Prompt for admin credentials. Returns a Cookie header value ('' for first-time setup)."""
+    import urllib.error
+
     username = input("Admin username: ").strip()
     password = input("Admin password: ").strip()
 
@@ -87,9 +157,7 @@ def upload_to_cloud(cloud_url, data=None):
 
         # Try health check first
         try:
-            req = urllib.request.Request(f"{cloud_url}/api/health")
-            resp = urllib.request.urlopen(req, timeout=10)
-            health = json.loads(resp.read())
+            health, _ = _request(f"{cloud_url}/api/health", timeout=10)
             print(f"Cloud status: {health.get('status')} ({health.get('engine')})")
 
             if health.get("users", 0) > 0:
@@ -97,67 +165,128 @@ def upload_to_cloud(cloud_url, data=None):
                 sys.exit(1)
         except Exception as e:
             print(f"WARNING: Could not check health: {e}")
+        return ""
 
-        # Direct import for empty database
-        payload = json.dumps({"data": data}).encode("utf-8")
-        req = urllib.request.Request(
-            f"{cloud_url}/api/data/import",
-            data=payload,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
+    import urllib.request
+    login_payload = json.dumps({"username": username, "password": password}).encode("utf-8")
+    req = urllib.request.Request(
+        f"{cloud_url}/api/auth/login",
+        data=login_payload,
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    try:
+        resp = urllib.request.urlopen(req, timeout=10)
+        cookies = resp.headers.get_all("Set-Cookie")
+        cookie_str = "; ".join(c.split(";")[0] for c in cookies) if cookies else ""
+        login_result = json.loads(resp.read())
+        if not login_result.get("success"):
+            print(f"Login failed: {login_result.get('error')}")
+            sys.exit(1)
+        print(f"Logged in as: {login_result['user']['name']} ({login_result['user']['role']})")
+        return cookie_str
+    except urllib.error.HTTPError as e:
+        print(f"Login failed: {e.code} {e.read().decode()}")
+        sys.exit(1)
 
-    else:
-        # Login
-        login_payload = json.dumps({"username": username, "password": password}).encode("utf-8")
-        req = urllib.request.Request(
-            f"{cloud_url}/api/auth/login",
-            data=login_payload,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
 
-        try:
-            resp = urllib.request.urlopen(req, timeout=10)
-            cookies = resp.headers.get_all("Set-Cookie")
-            cookie_str = "; ".join(c.split(";")[0] for c in cookies) if cookies else ""
-            login_result = json.loads(resp.read())
-            if not login_result.get("success"):
-                print(f"Login failed: {login_result.get('error')}")
-                sys.exit(1)
-            print(f"Logged in as: {login_result['user']['name']} ({login_result['user']['role']})")
-        except urllib.error.HTTPError as e:
-            print(f"Login failed: {e.code} {e.read().decode()}")
+def upload_to_cloud(cloud_url, data=None, chunk_rows=CHUNK_ROWS):
+    """Upload exported data to the cloud instance in resumable, compressed chunks."""
+    import time
+    import urllib.error
+
+    if data is None:
+        export_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "export_for_cloud.json")
+        if not os.path.exists(export_file):
+            print("ERROR: No export file found. Run 'export' first.")
             sys.exit(1)
+        with open(export_file, "r") as f:
+            data = json.load(f)
 
-        # Upload
-        payload = json.dumps({"data": data}).encode("utf-8")
-        req = urllib.request.Request(
-            f"{cloud_url}/api/data/import",
-            data=payload,
-            headers={
-                "Content-Type": "application/json",
-                "Cookie": cookie_str,
-            },
-            method="POST"
-        )
+    cloud_url = cloud_url.rstrip("/")
+    fingerprint = _fingerprint(data)
+    print(f"\nConnecting to cloud: {cloud_url}")
 
     try:
-        print(f"\nUploading data ({len(payload) / 1024:.1f} KB)...")
-        resp = urllib.request.urlopen(req, timeout=60)
-        result = json.loads(resp.read())
-
-        if result.get("success"):
-            print("\n--- Import Summary ---")
-            for table, count in result.get("imported", {}).items():
-                print(f"  {table}: {count} records")
-            print("\nMigration complete! Your cloud POS is ready.")
-        else:
-            print(f"Import failed: {result.get('error')}")
+        state = _load_state(cloud_url, fingerprint)
+        acked = {}
+        cookie_str = ""
+        if state:
+            # Resume: ask the server which chunks it already has
+            try:
+                status, _ = _request_with_retry(
+                    f"{cloud_url}/api/data/import/sessions/{state['session_id']}",
+                    headers={"X-Import-Token": state["token"]},
+                )
+            except urllib.error.HTTPError as e:
+                if e.code not in (401, 404):
+                    raise
+                status = {}
+            if status.get("status") == "open":
+                acked = {t: set(v["offsets"]) for t, v in status.get("tables", {}).items()}
+                done = sum(len(v) for v in acked.values())
+                print(f"Resuming import session {state['session_id']} ({done} chunks already uploaded)")
+                if not status.get("bootstrap"):
+                    cookie_str = _login(cloud_url)  # admin-opened sessions need the login on every chunk
+            else:
+                state = None
+        if not state:
+            cookie_str = _login(cloud_url)
+            opened, _ = _request_with_retry(
+                f"{cloud_url}/api/data/import/sessions",
+                payload={}, headers={"Cookie": cookie_str} if cookie_str else {}, method="POST",
+            )
+            state = {"cloud_url": cloud_url, "fingerprint": fingerprint, "session_id": opened["session_id"],
+                     "token": opened["token"], "tables": opened["tables"]}
+            _save_state(state)
+            print(f"Opened import session {state['session_id']}")
+
+        headers = {"X-Import-Token": state["token"]}
+        if cookie_str:
+            headers["Cookie"] = cookie_str
+        session_url = f"{cloud_url}/api/data/import/sessions/{state['session_id']}"
+        started = time.perf_counter()
+        total_rows = total_bytes = 0
+
+        print("\nUploading data...")
+        for table in state["tables"]:
+            records = _table_records(data, table)
+            sent_any = False
+            for offset in range(0, len(records), chunk_rows):
+                if offset in acked.get(table, ()):
+                    continue
+                chunk = records[offset:offset + chunk_rows]
+                ack, sent = _request_with_retry(
+                    f"{session_url}/chunks/{table}/{offset}",
+                    payload={"records": chunk}, headers=headers, method="PUT", compress=True,
+                )
+                sent_any = True
+                total_rows += len(chunk)
+                total_bytes += sent
+                elapsed = max(time.perf_counter() - started, 1e-6)
+                print(f"\r  {table}: {min(offset + chunk_rows, len(records))}/{len(records)} rows "
+                      f"| {total_rows / elapsed:,.0f} rows/s, {total_bytes / 1024 / elapsed:,.1f} KB/s",
+                      end="", flush=True)
+            if sent_any:
+                print()
+
+        result, _ = _request_with_retry(f"{session_url}/finish", payload={}, headers=headers, method="POST")
     except urllib.error.HTTPError as e:
-        print(f"Import failed: {e.code} {e.read().decode()}")
+        print(f"\nImport failed: {e.code} {e.read().decode()}")
+        sys.exit(1)
+    except (urllib.error.URLError, OSError) as e:
+        print(f"\nImport interrupted: {e}")
+        print("Run the same command again to resume where it stopped.")
         sys.exit(1)
 
+    os.remove(STATE_FILE)
+    elapsed = time.perf_counter() - started
+    print(f"\nUploaded {total_rows} rows ({total_bytes / 1024:.1f} KB compressed) in {elapsed:.1f}s")
+    print("\n--- Import Summary ---")
+    for table, info in result.get("tables", {}).items():
+        print(f"  {table}: {info['inserted']} of {info['rows']} records imported")
+    print("\nMigration complete! Your cloud POS is ready.")
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
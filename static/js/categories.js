@@ -25,14 +25,8 @@ const Categories = {
 
   async loadProductCounts() {
     try {
-      const res = await fetch('/api/inventory?limit=99999');
-      const data = await res.json();
-      const products = data.items || data || [];
-      this.productCounts = {};
-      products.forEach(p => {
-        const cat = p.category || '';
-        if (cat) this.productCounts[cat] = (this.productCounts[cat] || 0) + 1;
-      });
+      const res = await fetch('/api/categories/counts');
+      this.productCounts = await res.json();
     } catch (e) {
       this.productCounts = {};
     }
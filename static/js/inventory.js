@@ -163,7 +163,17 @@ const Inventory = {
       try {
         const res = await fetch('/api/inventory/import', { method: 'POST', body: form });
         const data = await res.json();
-        App.toast(`Imported ${data.added} products`);
+        if (!res.ok) {
+          App.toast(data.error || 'Import failed');
+        } else {
+          let msg = `Imported ${data.added} products`;
+          if (data.updated) msg += `, updated ${data.updated}`;
+          if (data.failed) {
+            msg += `, ${data.failed} rows failed`;
+            console.warn('CSV import errors:', data.errors);
+          }
+          App.toast(msg, data.failed ? 5000 : 2500);
+        }
         await this.loadProducts();
         this.render();
       } catch (err) {
@@ -1020,6 +1020,8 @@ const POS = {
       customer_name: document.getElementById('custName')?.value || '',
       customer_phone: document.getElementById('custPhone')?.value || '',
       customer_email: document.getElementById('custEmail')?.value || '',
+      // Same key on every retry / offline replay, so the server records this sale once
+      idempotency_key: this._newIdempotencyKey(),
     };
 
     // --- Offline detection: queue sale if no network ---
@@ -1031,7 +1033,7 @@ const POS = {
     try {
       const res = await fetch('/api/sales', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': sale.idempotency_key },
         body: JSON.stringify(sale),
       });
       const data = await res.json();
@@ -1079,6 +1081,13 @@ const POS = {
     }
   },
 
+  _newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    // randomUUID needs a secure context; plain-HTTP LAN access falls back to getRandomValues
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    return Array.from(bytes, (b) => b.toString(16).padStart(2, '0')).join('');
+  },
+
   // --- Offline Sale Queuing ---
 
   async _queueOfflineSale(sale) {
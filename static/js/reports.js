@@ -20,7 +20,12 @@ const Reports = {
   bindEvents() {
     document.getElementById('btnRunReport').onclick = () => this.runReport();
     document.getElementById('btnExportReport').onclick = () => {
-      window.location.href = '/api/sales/export';
+      const params = new URLSearchParams();
+      const start = document.getElementById('rptStart').value;
+      const end = document.getElementById('rptEnd').value;
+      if (start) params.set('start', start);
+      if (end) params.set('end', end);
+      window.location.href = `/api/sales/export?${params}`;
     };
     document.getElementById('btnPrintReport').onclick = () => window.print();
     document.getElementById('reportType').onchange = () => this.runReport();
@@ -99,7 +99,7 @@ const Sales = {
     try {
       // Cache sales data so dropdown changes don't re-fetch
       if (!this._chartSales) {
-        const res = await fetch('/api/sales');
+        const res = await fetch('/api/sales?include_items=false');
         this._chartSales = (await res.json()).filter(s => (s.status || 'Complete') !== 'Voided');
       }
       const sales = this._chartSales;